@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+from benchmarks.stub_server import StubServer
+from models.batch import run_batch
+from models.engine import Job
+from models.resilience import DeadLetterQueue
+
+TEMPLATE = "Answer YES or NO.\n\nContext:\n{context}"
+
+
+def check_batch_roundtrip(n_jobs=50, answer="YES", error_rate=0.0):
+    """Run run_batch end to end against the fake batch API of StubServer.
+
+    Parameters
+    ----------
+    n_jobs : int
+        Number of jobs in the batch.
+    answer : str
+        Answer of the stub server.
+    error_rate : float
+        Fraction of the requests the stub batch fails.
+
+    Returns
+    -------
+    dict
+        Number of jobs, answered rows, failed reports, dead letters read
+        from the error file and whether every row holds the stub answer.
+
+    """
+    jobs = [
+        Job(i, "question", f"Narrative of report {i}.", TEMPLATE)
+        for i in range(n_jobs)
+    ]
+    server = StubServer(answer=answer, error_rate=error_rate, seed=0)
+    with server, tempfile.TemporaryDirectory() as tmp:
+        dead_letters = DeadLetterQueue(os.path.join(tmp, "dead_letters.jsonl"))
+        rows, failed = run_batch(
+            jobs,
+            "gpt-4o-mini",
+            "roundtrip",
+            work_dir=tmp,
+            base_url=server.url + "/v1",
+            poll_interval=0.01,
+            dead_letters=dead_letters,
+            api_key="stub",
+        )
+        n_dead_letters = len(dead_letters.entries())
+    return {
+        "jobs": n_jobs,
+        "rows": len(rows),
+        "failed": len(failed),
+        "dead_letters": n_dead_letters,
+        "consistent": all(row[2] == answer for row in rows),
+    }
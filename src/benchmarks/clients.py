@@ -0,0 +1,71 @@
+import time
+
+from benchmarks.stub_server import MODELS, StubServer
+from models.llm import _build_llm, _render_prompt, clear_clients, get_response
+
+CONTEXT = "The helicopter lost engine power during cruise flight."
+TEMPLATE = "Answer YES or NO.\n\nContext:\n{context}"
+
+
+def benchmark_client_reuse(n_calls=200, model_type="ollama", gpt_model=None):
+    """Compare per-call overhead of building a client per query (the old
+    behaviour of get_response) against the shared client registry.
+
+    Parameters
+    ----------
+    n_calls : int
+        Number of queries per variant.
+    model_type : str
+        ollama or gpt.
+    gpt_model : str, optional
+        Model name sent to the stub server, MODELS[model_type] by default.
+
+    Returns
+    -------
+    dict
+        Milliseconds per call and TCP connections opened for both variants.
+
+    """
+    gpt_model = gpt_model or MODELS[model_type]
+    # The stub ignores the key, but the OpenAI client refuses to start without
+    options = {"api_key": "stub"} if model_type != "ollama" else {}
+    results = {}
+
+    with StubServer() as server:
+        base_url = server.url if model_type == "ollama" else server.url + "/v1"
+
+        # Warm up both code paths
+        _build_llm(gpt_model, model_type, base_url, **options).complete(
+            "warm up"
+        )
+        server.reset_counters()
+
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            llm = _build_llm(gpt_model, model_type, base_url, **options)
+            llm.complete(prompt=_render_prompt(CONTEXT, TEMPLATE))
+        elapsed = time.perf_counter() - start
+        results["fresh_ms_per_call"] = 1000 * elapsed / n_calls
+        results["fresh_connections"] = server.connections
+
+        clear_clients()
+        server.reset_counters()
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            get_response(
+                gpt_model,
+                CONTEXT,
+                TEMPLATE,
+                model_type=model_type,
+                base_url=base_url,
+                **options,
+            )
+        elapsed = time.perf_counter() - start
+        results["pooled_ms_per_call"] = 1000 * elapsed / n_calls
+        results["pooled_connections"] = server.connections
+        clear_clients()
+
+    results["saved_ms_per_call"] = (
+        results["fresh_ms_per_call"] - results["pooled_ms_per_call"]
+    )
+    return results
@@ -0,0 +1,164 @@
+import json
+import os
+import random
+import tempfile
+import time
+from collections import deque
+
+from benchmarks.throughput import _version
+from data.corpus import Corpus, compile_corpus
+from data.preprocess import clean_contexts
+
+RESULTS_PATH = "data/benchmarks/preprocess.jsonl"
+
+_PARAGRAPH = "&#x0D;\n"
+
+
+def legacy_clean_context(context):
+    """The cleaning before markup and entities were decoded, the baseline."""
+    context = context.strip()
+    context = context.replace("&#x0D;", "")
+    return "\n".join([line for line in context.splitlines() if line.strip()])
+
+
+def synthetic_raw_corpus(n_reports, narratives, seed=0):
+    """Raw narratives assembled from the paragraphs of real reports.
+
+    Unlike synthetic_corpus of the throughput benchmark, the paragraphs keep
+    the entities, line breaks and whitespace of the export, which is what
+    the cleaning works on.
+
+    Parameters
+    ----------
+    n_reports : int
+        Number of narratives to generate.
+    narratives : list
+        Raw narratives, None for reports without one.
+    seed : int
+        Seed of the generator.
+
+    Returns
+    -------
+    list
+        The synthetic narratives.
+
+    """
+    reports = [
+        narrative.split(_PARAGRAPH) for narrative in narratives if narrative
+    ]
+    paragraphs = [paragraph for report in reports for paragraph in report]
+    lengths = [len(report) for report in reports]
+    rng = random.Random(seed)
+    return [
+        _PARAGRAPH.join(rng.choices(paragraphs, k=rng.choice(lengths)))
+        for _ in range(n_reports)
+    ]
+
+
+def _consume(results):
+    """Exhaust an iterator without keeping the results."""
+    deque(results, maxlen=0)
+
+
+def _timed(corpus, stage, processes, narratives, run):
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    size = sum(len(narrative.encode("utf-8")) for narrative in narratives)
+    return {
+        "version": _version(),
+        "time": time.time(),
+        "corpus": corpus,
+        "reports": len(narratives),
+        "stage": stage,
+        "processes": processes or os.cpu_count(),
+        "seconds": elapsed,
+        "reports_per_second": len(narratives) / elapsed,
+        "mb_per_second": size / 2**20 / elapsed,
+    }
+
+
+def run_preprocess(narratives, corpus, processes=(1, None), chunksize=256):
+    """Time the cleaning of raw narratives and the compilation of a corpus.
+
+    Parameters
+    ----------
+    narratives : list
+        Raw narratives.
+    corpus : str
+        Name of the corpus in the results.
+    processes : tuple
+        Pool sizes to time, None for the number of CPUs.
+    chunksize : int
+        Narratives sent to a worker at a time.
+
+    Returns
+    -------
+    list
+        One dict per stage and pool size with the reports and MB of raw
+        text per second. The stages are the previous cleaning
+        ("legacy_clean"), the current cleaning ("clean") and the
+        compilation of a corpus from a JSON dump ("compile"), which adds
+        the parsing, hashing and writing, and the reading of every cleaned
+        narrative back from the compiled corpus ("read_corpus"), the cost
+        paid by each run instead of the cleaning.
+
+    """
+    results = [
+        _timed(
+            corpus,
+            "legacy_clean",
+            1,
+            narratives,
+            lambda: _consume(map(legacy_clean_context, narratives)),
+        )
+    ]
+    with tempfile.TemporaryDirectory() as workdir:
+        data_path = os.path.join(workdir, "data.json")
+        with open(data_path, "w", encoding="utf-8") as f:
+            json.dump(
+                [
+                    {
+                        "NtsbNumber": f"SYN{i}",
+                        "Oid": str(i),
+                        "FactualNarrative": text,
+                    }
+                    for i, text in enumerate(narratives)
+                ],
+                f,
+            )
+        for size in processes:
+            results.append(
+                _timed(
+                    corpus,
+                    "clean",
+                    size,
+                    narratives,
+                    lambda: _consume(
+                        clean_contexts(narratives, size, chunksize)
+                    ),
+                )
+            )
+            results.append(
+                _timed(
+                    corpus,
+                    "compile",
+                    size,
+                    narratives,
+                    lambda: compile_corpus(
+                        data_path,
+                        os.path.join(workdir, "corpus"),
+                        max_length=None,
+                        processes=size,
+                    ).close(),
+                )
+            )
+
+        def read_corpus():
+            with Corpus(os.path.join(workdir, "corpus")) as compiled:
+                _consume(compiled)
+
+        results.append(
+            _timed(corpus, "read_corpus", 1, narratives, read_corpus)
+        )
+    return results
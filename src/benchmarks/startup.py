@@ -0,0 +1,113 @@
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from benchmarks.throughput import _version
+
+RESULTS_PATH = "data/benchmarks/startup.jsonl"
+
+CLI = os.path.join(os.path.dirname(os.path.dirname(__file__)), "cli.py")
+
+# Module imported by main.py and by the query command, with llama_index
+QUERY_STACK = "models.executor"
+
+_IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def _example_files(workdir, n_reports=20):
+    """Results and manual labels of a few io reports, for the real commands."""
+    factors = ["decision_error", "skill_based_errors", "perceptual_error"]
+    answers = pd.DataFrame(
+        [
+            (document_id, factor, "YES" if (document_id + i) % 3 else "NO")
+            for document_id in range(n_reports)
+            for i, factor in enumerate(factors)
+        ],
+        columns=["document_id", "prompt", "result"],
+    )
+    answers.to_csv(os.path.join(workdir, "io_results.csv"))
+    manual = answers.assign(result=(answers.index % 2).astype(int))
+    manual.to_csv(os.path.join(workdir, "manual_labels.csv"), index=False)
+
+
+def _run(args, cwd, importtime=False):
+    command = [
+        sys.executable,
+        *(["-X", "importtime"] if importtime else []),
+        *args,
+    ]
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(CLI)}
+    start = time.perf_counter()
+    process = subprocess.run(
+        command, cwd=cwd, env=env, capture_output=True, text=True, check=True
+    )
+    return time.perf_counter() - start, process.stderr
+
+
+def slowest_imports(stderr, top=5):
+    """Top-level modules with the largest cumulative import time, in ms."""
+    imports = [
+        (match.group(4), int(match.group(2)) / 1000)
+        for match in map(_IMPORT_TIME.match, stderr.splitlines())
+        if match and len(match.group(3)) == 1
+    ]
+    return sorted(imports, key=lambda item: -item[1])[:top]
+
+
+def run_startup(repeats=5):
+    """Wall time of the CLI commands, each in a fresh interpreter.
+
+    consolidate and stats run for real on a few example reports, query is
+    only started (--help), as a run needs a model. The import of the
+    llama_index stack that main.py and query pay is timed as a reference.
+
+    Parameters
+    ----------
+    repeats : int
+        Runs of each command, the median is reported.
+
+    Returns
+    -------
+    list
+        One dict per command with the median and min wall time in seconds
+        and the five slowest top-level imports.
+
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        _example_files(workdir)
+        commands = {
+            "python": ["-c", "pass"],
+            "cli --help": [CLI, "--help"],
+            "query --help": [CLI, "query", "--help"],
+            "consolidate": [CLI, "consolidate", "io", "--output-dir", workdir],
+            "stats": [
+                CLI,
+                "stats",
+                "io",
+                "--manual",
+                os.path.join(workdir, "manual_labels.csv"),
+                "--labels-dir",
+                workdir,
+            ],
+            f"import {QUERY_STACK}": ["-c", f"import {QUERY_STACK}"],
+        }
+        for name, args in commands.items():
+            times = sorted(_run(args, workdir)[0] for _ in range(repeats))
+            _, stderr = _run(args, workdir, importtime=True)
+            results.append(
+                {
+                    "version": _version(),
+                    "time": time.time(),
+                    "command": name,
+                    "seconds": times[len(times) // 2],
+                    "min_seconds": times[0],
+                    "slowest_imports": slowest_imports(stderr),
+                }
+            )
+    return results
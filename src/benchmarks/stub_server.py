@@ -0,0 +1,535 @@
+import json
+import math
+import random
+import re
+import socket
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import zip_longest
+
+# Models of the real runs, the OpenAI client only accepts known model names
+MODELS = {"ollama": "qwen2.5:32b-instruct", "gpt": "gpt-4o-mini"}
+
+# Endpoints generating text, slowed down and failed as configured
+_COMPLETION_PATHS = (
+    "/api/chat",
+    "/api/generate",
+    "/v1/chat/completions",
+    "/v1/completions",
+)
+
+
+def _answer(request, answer):
+    """The answer, as a JSON object of booleans if the request has a schema."""
+    schema = request.get("format")
+    if isinstance(request.get("response_format"), dict):
+        schema = (
+            request["response_format"].get("json_schema", {}).get("schema")
+        )
+    if not isinstance(schema, dict):
+        return answer
+    return json.dumps(
+        {key: answer == "YES" for key in schema.get("properties", {})}
+    )
+
+
+def _prompt_text(request):
+    """Text of the prompt of an Ollama or OpenAI request."""
+    if "messages" in request:
+        return "".join(
+            str(message.get("content") or "")
+            for message in request["messages"]
+        )
+    return str(request.get("prompt") or "")
+
+
+def _token_count(text):
+    """Rough token count, about 4 characters per token."""
+    return max(1, len(text) // 4)
+
+
+def _logprob(token, logprob):
+    return {"token": token, "logprob": logprob, "bytes": None}
+
+
+def _logprobs(answer, confidence):
+    """Token logprobs of an answer, YES/NO with the given probability."""
+    content = []
+    for token in answer.split():
+        label = token.strip(".*").upper()
+        if label not in ("YES", "NO") or confidence >= 1:
+            content.append({**_logprob(token, 0.0), "top_logprobs": []})
+            continue
+        other = "NO" if label == "YES" else "YES"
+        top = [
+            _logprob(token, math.log(confidence)),
+            _logprob(other, math.log(1 - confidence)),
+        ]
+        content.append({**top[0], "top_logprobs": top})
+    return {"content": content}
+
+
+def _completion(request, answer, path="/v1/chat/completions", confidence=1.0):
+    """OpenAI completion payload answering a request."""
+    # One choice per requested sample
+    n = request.get("n") or 1
+    if path == "/v1/chat/completions":
+        choices = [
+            {
+                "index": i,
+                "message": {"role": "assistant", "content": answer},
+                "logprobs": (
+                    _logprobs(answer, confidence)
+                    if request.get("logprobs")
+                    else None
+                ),
+                "finish_reason": "stop",
+            }
+            for i in range(n)
+        ]
+    else:
+        choices = [
+            {"index": i, "text": answer, "finish_reason": "stop"}
+            for i in range(n)
+        ]
+    prompt_tokens = _token_count(_prompt_text(request))
+    completion_tokens = n * _token_count(answer)
+    return {
+        "id": "stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model"),
+        "choices": choices,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def _pieces(answer):
+    """The answer split in streamed pieces, a word and its leading space."""
+    return re.findall(r"\s*\S+", answer) or [answer]
+
+
+def _completion_chunks(request, answer, path="/v1/chat/completions"):
+    """OpenAI stream chunks answering a request.
+
+    Like the API, the usage comes in a last chunk without choices, and only
+    if the request asks for it with stream_options.
+    """
+    payload = _completion(request, answer, path)
+    chat = path == "/v1/chat/completions"
+    base = {
+        "id": "stub",
+        "object": "chat.completion.chunk" if chat else "text_completion",
+        "created": payload["created"],
+        "model": request.get("model"),
+    }
+
+    def choice(piece, finish_reason=None):
+        text = {"text": piece or ""}
+        if chat:
+            text = {"delta": {"role": "assistant", "content": piece}}
+            if piece is None:
+                text = {"delta": {}}
+        return {"index": 0, **text, "finish_reason": finish_reason}
+
+    chunks = [
+        {**base, "choices": [choice(piece)]} for piece in _pieces(answer)
+    ]
+    chunks.append({**base, "choices": [choice(None, "stop")]})
+    if (request.get("stream_options") or {}).get("include_usage"):
+        chunks.append({**base, "choices": [], "usage": payload["usage"]})
+    return chunks
+
+
+def _ollama_payload(request, answer, path="/api/chat", content=None):
+    """Ollama reply to a request.
+
+    content is a streamed piece of the answer, not done, or the empty last
+    message of a stream that carries the token counts.
+    """
+    payload = {
+        "model": request.get("model"),
+        "created_at": "1970-01-01T00:00:00Z",
+        "done": not content,
+    }
+    if content is None:
+        content = answer
+    if payload["done"]:
+        payload["done_reason"] = "stop"
+        payload["prompt_eval_count"] = _token_count(_prompt_text(request))
+        payload["eval_count"] = _token_count(answer)
+    if path == "/api/chat":
+        payload["message"] = {"role": "assistant", "content": content}
+    else:
+        payload["response"] = content
+    return payload
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes, Nagle would stall them
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, events, content_type):
+        """Send pre-encoded events in a chunked response, one at a time.
+
+        Events carrying text wait for its tokens at the token rate of the
+        server, so the first one arrives after the latency only.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for event, text in events:
+            if text and self.server.token_rate:
+                time.sleep(_token_count(text) / self.server.token_rate)
+            data = event.encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _reply_ollama(self, request, answer):
+        if request.get("stream") is not True:
+            self._send_json(_ollama_payload(request, answer, self.path))
+            return
+        # Newline delimited JSON, the counts come with the done message
+        events = [
+            (_ollama_payload(request, answer, self.path, piece), piece)
+            for piece in _pieces(answer) + [""]
+        ]
+        self._send_stream(
+            [(json.dumps(event) + "\n", text) for event, text in events],
+            "application/x-ndjson",
+        )
+
+    def _reply_openai(self, request, answer):
+        if not request.get("stream"):
+            self._send_json(
+                _completion(request, answer, self.path, self.server.confidence)
+            )
+            return
+        # Server-sent events, closed by [DONE]
+        chunks = _completion_chunks(request, answer, self.path)
+        events = [
+            (f"data: {json.dumps(chunk)}\n\n", piece)
+            for chunk, piece in zip_longest(chunks, _pieces(answer))
+        ]
+        events.append(("data: [DONE]\n\n", None))
+        self._send_stream(events, "text/event-stream")
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def _read_json(self):
+        return json.loads(self._body or b"{}")
+
+    def _upload(self):
+        """Store the file of a multipart upload (OpenAI files API)."""
+        message = BytesParser().parsebytes(
+            b"Content-Type: "
+            + self.headers["Content-Type"].encode("latin-1")
+            + b"\r\n\r\n"
+            + self._body
+        )
+        fields = {
+            part.get_param("name", header="content-disposition"): part
+            for part in message.get_payload()
+        }
+        upload = fields["file"]
+        return self.server.add_file(
+            upload.get_payload(decode=True),
+            upload.get_filename(),
+            fields["purpose"].get_payload(decode=True).decode(),
+        )
+
+    def _simulate(self, answer, stream=False):
+        """Wait like a model writing answer, True if the call should fail.
+
+        A streamed answer is written while it is sent, only the latency is
+        waited for here.
+        """
+        server = self.server
+        with server.lock:
+            delay = server.latency + server.random.uniform(0, server.jitter)
+            failed = server.random.random() < server.error_rate
+        if server.token_rate and not stream:
+            delay += _token_count(answer) / server.token_rate
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            with server.lock:
+                server.errors += 1
+            self._send_json({"error": "simulated server error"}, status=503)
+        return failed
+
+    def _jsonl_file(self, items, filename):
+        """Store batch output lines as a file, None if there are none."""
+        if not items:
+            return None
+        content = "".join(json.dumps(item) + "\n" for item in items)
+        return self.server.add_file(
+            content.encode("utf-8"), filename, "batch_output"
+        )
+
+    def _create_batch(self, request):
+        """Answer every line of the input file at once (OpenAI batch API).
+
+        Lines fail at the error rate of the server and go to the error file.
+        """
+        server = self.server
+        lines, errors = [], []
+        content = server.files[request["input_file_id"]]["content"]
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            with server.lock:
+                failed = server.random.random() < server.error_rate
+            if failed:
+                errors.append(
+                    {
+                        "id": f"stub-{item['custom_id']}",
+                        "custom_id": item["custom_id"],
+                        "response": {
+                            "status_code": 500,
+                            "request_id": "stub",
+                            "body": {
+                                "error": {"message": "simulated server error"}
+                            },
+                        },
+                        "error": None,
+                    }
+                )
+                continue
+            lines.append(
+                {
+                    "id": f"stub-{item['custom_id']}",
+                    "custom_id": item["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "request_id": "stub",
+                        "body": _completion(
+                            item["body"], self.server.answer, item["url"]
+                        ),
+                    },
+                    "error": None,
+                }
+            )
+        output = self._jsonl_file(lines, "output.jsonl")
+        error = self._jsonl_file(errors, "errors.jsonl")
+        with self.server.lock:
+            batch_id = f"batch-{len(self.server.batches)}"
+            batch = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": request["endpoint"],
+                "input_file_id": request["input_file_id"],
+                "completion_window": request["completion_window"],
+                "status": "in_progress",
+                "output_file_id": output and output["id"],
+                "error_file_id": error and error["id"],
+                "created_at": int(time.time()),
+                "request_counts": {
+                    "total": len(lines) + len(errors),
+                    "completed": len(lines),
+                    "failed": len(errors),
+                },
+            }
+            self.server.batches[batch_id] = batch
+        return batch
+
+    def do_GET(self):
+        self._body = b""
+        parts = self.path.strip("/").split("/")
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+            batch = self.server.batches[parts[2]]
+            # Report progress once before completing, like the real API
+            reply = dict(batch)
+            batch["status"] = "completed"
+            self._send_json(reply)
+        elif parts[:2] == ["v1", "files"] and parts[3:] == ["content"]:
+            body = self.server.files[parts[2]]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json({"error": f"unknown path {self.path}"}, status=404)
+
+    def do_POST(self):
+        self._body = self._read_body()
+        request = self._read_json() if self.path != "/v1/files" else {}
+        with self.server.lock:
+            self.server.requests += 1
+        answer = _answer(request, self.server.answer)
+        stream = bool(request.get("stream"))
+        if self.path in _COMPLETION_PATHS and self._simulate(answer, stream):
+            return
+
+        if self.path == "/api/show":
+            self._send_json(
+                {
+                    "modelfile": "",
+                    "parameters": "",
+                    "template": "",
+                    "details": {},
+                    "model_info": {"stub.context_length": 32768},
+                }
+            )
+        elif self.path in ("/api/chat", "/api/generate"):
+            self._reply_ollama(request, answer)
+        elif self.path in ("/v1/chat/completions", "/v1/completions"):
+            self._reply_openai(request, answer)
+        elif self.path == "/v1/files":
+            self._send_json(self._upload())
+        elif self.path == "/v1/batches":
+            self._send_json(self._create_batch(request))
+        else:
+            self._send_json({"error": f"unknown path {self.path}"}, status=404)
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under high concurrency
+    request_queue_size = 128
+
+
+class StubServer:
+    """Local server speaking enough of the Ollama and OpenAI APIs to answer
+    the queries of get_response, without touching the network.
+
+    The OpenAI files and batch endpoints are faked as well: a batch is
+    answered as soon as it is created and reported completed from its
+    second poll on.
+
+    Parameters
+    ----------
+    answer : str
+        The text returned for every completion. Requests with a JSON schema
+        get an object setting every property to answer == "YES".
+    host : str
+        Interface to bind.
+    port : int
+        Port to bind, 0 picks a free one.
+    latency : float
+        Seconds every completion takes before the first token.
+    jitter : float
+        Extra seconds drawn uniformly between 0 and jitter per completion.
+    error_rate : float
+        Fraction of the completions answered with HTTP 503.
+    token_rate : float, optional
+        Output tokens generated per second, None for instant generation.
+    seed : int, optional
+        Seed of the jitter and errors, for reproducible runs.
+    confidence : float
+        Probability given to the YES/NO tokens when logprobs are requested.
+
+    """
+
+    def __init__(
+        self,
+        answer="NO",
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        token_rate=None,
+        seed=None,
+        confidence=1.0,
+    ):
+        self.httpd = _StubHTTPServer((host, port), _StubHandler)
+        self.httpd.lock = threading.Lock()
+        self.httpd.answer = answer
+        self.httpd.latency = latency
+        self.httpd.jitter = jitter
+        self.httpd.error_rate = error_rate
+        self.httpd.token_rate = token_rate
+        self.httpd.random = random.Random(seed)
+        self.httpd.confidence = confidence
+        self.httpd.connections = 0
+        self.httpd.requests = 0
+        self.httpd.errors = 0
+        self.httpd.files = {}
+        self.httpd.batches = {}
+        self.httpd.add_file = self._add_file
+        self._thread = None
+
+    def _add_file(self, content, filename, purpose):
+        with self.httpd.lock:
+            file_id = f"file-{len(self.httpd.files)}"
+            self.httpd.files[file_id] = {"content": content}
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def connections(self):
+        return self.httpd.connections
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def errors(self):
+        return self.httpd.errors
+
+    def reset_counters(self):
+        with self.httpd.lock:
+            self.httpd.connections = 0
+            self.httpd.requests = 0
+            self.httpd.errors = 0
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
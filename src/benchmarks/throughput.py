@@ -0,0 +1,278 @@
+import json
+import os
+import random
+import re
+import subprocess
+import time
+import tracemalloc
+
+import pandas as pd
+
+from benchmarks.stub_server import MODELS, StubServer
+from models.engine import run_queries
+from models.executor import build_strategy_jobs
+from models.prompts import load_registry
+from models.telemetry import Telemetry
+
+RESULTS_PATH = "data/benchmarks/throughput.jsonl"
+
+_SENTENCE = re.compile(r"(?<=[.!?])\s+")
+
+
+def synthetic_corpus(n_reports, contexts, seed=0):
+    """Narratives assembled from the sentences of real reports.
+
+    The number of sentences of each synthetic report is drawn from the real
+    reports, so the prompt lengths follow the same distribution.
+
+    Parameters
+    ----------
+    n_reports : int
+        Number of narratives to generate.
+    contexts : list
+        Cleaned narratives, None for dropped reports.
+    seed : int
+        Seed of the generator.
+
+    Returns
+    -------
+    list
+        The synthetic narratives.
+
+    """
+    reports = [_SENTENCE.split(context) for context in contexts if context]
+    sentences = [sentence for report in reports for sentence in report]
+    lengths = [len(report) for report in reports]
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choices(sentences, k=rng.choice(lengths)))
+        for _ in range(n_reports)
+    ]
+
+
+def benchmark_corpora(contexts, n_reports=None, n_synthetic=10000, seed=0):
+    """Corpora of the throughput benchmark, by name.
+
+    Parameters
+    ----------
+    contexts : list
+        Cleaned narratives, None for dropped reports.
+    n_reports : int, optional
+        Number of real reports sampled, all of them (the 215 reports of
+        data.json) by default.
+    n_synthetic : int
+        Number of synthetic reports, see synthetic_corpus.
+    seed : int
+        Seed of the sample and of the synthetic reports.
+
+    Returns
+    -------
+    dict
+        The reports_<n> and synthetic_<n> lists of narratives.
+
+    """
+    reports = [context for context in contexts if context is not None]
+    if n_reports is not None and n_reports < len(reports):
+        reports = random.Random(seed).sample(reports, n_reports)
+    return {
+        f"reports_{len(reports)}": reports,
+        f"synthetic_{n_synthetic}": synthetic_corpus(
+            n_synthetic, contexts, seed
+        ),
+    }
+
+
+def _version():
+    """Commit of the working tree, to tell the benchmark runs apart."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _peak_memory(jobs, gpt_model, model_type, base_url, **options):
+    """Peak Python memory of running the jobs, in bytes."""
+    tracemalloc.start()
+    try:
+        run_queries(
+            jobs,
+            gpt_model,
+            model_type=model_type,
+            base_url=base_url,
+            **options,
+        )
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_throughput(
+    contexts,
+    corpus,
+    strategies=None,
+    model_type="ollama",
+    gpt_model=None,
+    stub_options=None,
+    memory=True,
+    **options,
+):
+    """Run strategies end to end against a local stub server.
+
+    Every job goes through the query engine, the client registry and the
+    HTTP stack exactly as in a real run, only the model is replaced by a
+    StubServer with the configured latency, jitter, error rate and token
+    rate.
+
+    Parameters
+    ----------
+    contexts : list
+        Cleaned narratives, None for dropped reports.
+    corpus : str
+        Name of the corpus in the results.
+    strategies : list, optional
+        Strategies of the PromptRegistry to run, all of them by default.
+    model_type : str
+        ollama or gpt, selects the API spoken to the stub.
+    gpt_model : str, optional
+        Model name sent to the stub server, MODELS[model_type] by default.
+    stub_options : dict, optional
+        Passed on to StubServer (latency, jitter, error_rate, token_rate,
+        seed).
+    memory : bool
+        Measure the peak memory. tracemalloc slows every allocation down,
+        so it runs in a second pass of the jobs, against a stub without
+        latency, and the first pass times the queries alone.
+    **options
+        Passed on to run_queries (concurrency, retry, ...).
+
+    Returns
+    -------
+    list
+        One dict per strategy with the queries per second, p50/p99 latency
+        in milliseconds, errors and peak Python memory in MB (None without
+        memory). The stub server runs in the same process and is included
+        in the memory.
+
+    """
+    strategies = strategies or load_registry().strategies
+    gpt_model = gpt_model or MODELS[model_type]
+    stub_options = stub_options or {}
+    if model_type != "ollama":
+        # The stub ignores the key, the OpenAI client needs one to start
+        options.setdefault("api_key", "stub")
+
+    instant = {
+        **stub_options,
+        "latency": 0.0,
+        "jitter": 0.0,
+        "token_rate": None,
+    }
+    path = "" if model_type == "ollama" else "/v1"
+
+    results = []
+    with StubServer(**stub_options) as server, StubServer(**instant) as fast:
+        for strategy in strategies:
+            prompts = load_registry().templates(strategy)
+            jobs, _ = build_strategy_jobs(
+                contexts, {strategy: prompts}, clean=False
+            )
+
+            telemetry = Telemetry()
+            start = time.perf_counter()
+            rows, failed = run_queries(
+                jobs,
+                gpt_model,
+                model_type=model_type,
+                base_url=server.url + path,
+                telemetry=telemetry,
+                **options,
+            )
+            elapsed = time.perf_counter() - start
+            peak = None
+            if memory:
+                peak = _peak_memory(
+                    jobs, gpt_model, model_type, fast.url + path, **options
+                )
+
+            summary = telemetry.summary(by=("strategy",))[0]
+            results.append(
+                {
+                    "version": _version(),
+                    "time": time.time(),
+                    "corpus": corpus,
+                    "reports": sum(
+                        context is not None for context in contexts
+                    ),
+                    "strategy": strategy,
+                    "model_type": model_type,
+                    "stub": stub_options,
+                    "jobs": len(jobs),
+                    "answered": len(rows),
+                    "failed_reports": len(failed),
+                    "call_errors": summary["errors"],
+                    "seconds": elapsed,
+                    "qps": len(rows) / elapsed,
+                    "p50_ms": summary["wall_ms_p50"],
+                    "p99_ms": summary["wall_ms_p99"],
+                    "peak_memory_mb": peak / 2**20 if memory else None,
+                }
+            )
+    return results
+
+
+def save_results(results, path=RESULTS_PATH):
+    """Append benchmark results to the JSONL history."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+
+def compare_results(path=RESULTS_PATH, tolerance=0.1):
+    """Compare the last benchmarked version against the one before it.
+
+    Parameters
+    ----------
+    path : str
+        Location of the JSONL history.
+    tolerance : float
+        Relative change counted as a regression.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per corpus, strategy and backend with the relative change of
+        qps, p99 latency and peak memory, and a regression flag.
+
+    """
+    history = pd.read_json(path, lines=True)
+    versions = history.drop_duplicates("version", keep="last").sort_values(
+        "time"
+    )
+    if len(versions) < 2:
+        return pd.DataFrame()
+    baseline, current = versions["version"].iloc[-2:]
+
+    keys = ["corpus", "strategy", "model_type"]
+    metrics = ["qps", "p99_ms", "peak_memory_mb"]
+    latest = history.drop_duplicates([*keys, "version"], keep="last")
+    merged = latest[latest["version"] == baseline][keys + metrics].merge(
+        latest[latest["version"] == current][keys + metrics],
+        on=keys,
+        suffixes=("_baseline", "_current"),
+    )
+    for metric in metrics:
+        merged[f"{metric}_change"] = (
+            merged[f"{metric}_current"] / merged[f"{metric}_baseline"] - 1
+        )
+    merged["regression"] = (
+        (merged["qps_change"] < -tolerance)
+        | (merged["p99_ms_change"] > tolerance)
+        | (merged["peak_memory_mb_change"] > tolerance)
+    )
+    return merged.assign(baseline=baseline, current=current)
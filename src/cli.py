@@ -0,0 +1,201 @@
+"""Command line interface of the HFACS labelling pipeline.
+
+Run from the root of the repository, like main.py:
+
+    python src/cli.py query io cot --model gpt-4o-mini --model-type gpt
+    python src/cli.py consolidate cot
+    python src/cli.py stats io cot
+
+Only click is imported here. Each command imports what it needs when it
+runs, so consolidate and stats never load the llama_index stack.
+"""
+
+import os
+
+import click
+
+MODEL_TYPES = ["ollama", "gpt"]
+
+
+@click.group()
+def cli():
+    """Label NTSB reports with HFACS factors using LLMs."""
+
+
+@cli.command()
+@click.argument("strategies", nargs=-1, required=True)
+@click.option("--model", default="gpt-4o-mini", show_default=True)
+@click.option(
+    "--model-type",
+    type=click.Choice(MODEL_TYPES),
+    default="gpt",
+    show_default=True,
+)
+@click.option(
+    "--data", "data_path", default="data/data.json", show_default=True
+)
+@click.option(
+    "--corpus", "corpus_path", default="data/cache/corpus", show_default=True
+)
+@click.option("--output-dir", default="data", show_default=True)
+@click.option("--base-url", help="Server of the model, e.g. a remote Ollama.")
+@click.option("--concurrency", type=int, help="Requests in flight.")
+@click.option(
+    "--config", "config_path", default="configs/config.yaml", show_default=True
+)
+def query(
+    strategies,
+    model,
+    model_type,
+    data_path,
+    corpus_path,
+    output_dir,
+    base_url,
+    concurrency,
+    config_path,
+):
+    """Query the reports with one or more STRATEGIES (io, cot, ...).
+
+    Completed (report, prompt) pairs of a previous run are not asked again.
+    """
+    import yaml
+
+    from data.corpus import load_corpus
+    from models.executor import run_strategies
+    from models.prompts import load_registry
+
+    known = load_registry().strategies
+    unknown = sorted(set(strategies) - set(known))
+    if unknown:
+        raise click.BadParameter(
+            f"{', '.join(unknown)} (choose from {', '.join(known)})",
+            param_hint="STRATEGIES",
+        )
+    if model_type == "gpt":
+        with open(config_path) as f:
+            config = yaml.load(f, Loader=yaml.SafeLoader)
+        os.environ["OPENAI_API_KEY"] = config["openai_api_key"]
+
+    options = {"base_url": base_url, "concurrency": concurrency}
+    options = {
+        name: value for name, value in options.items() if value is not None
+    }
+    with load_corpus(data_path, corpus_path) as corpus:
+        outputs = run_strategies(
+            corpus,
+            list(strategies),
+            model,
+            model_type=model_type,
+            output_dir=output_dir,
+            clean=False,
+            **options,
+        )
+    for strategy, output in outputs.items():
+        click.echo(f"{strategy}: {len(output)} answers")
+
+
+@cli.command()
+@click.argument("strategy")
+@click.option(
+    "--results",
+    "results_path",
+    help="Defaults to <output-dir>/<strategy>_results.csv.",
+)
+@click.option("--output-dir", default="data", show_default=True)
+def consolidate(strategy, results_path, output_dir):
+    """Parse the answers of STRATEGY into one label per report and factor.
+
+    Writes <strategy>_labels.csv and <strategy>_parse_errors.csv.
+    """
+    import pandas as pd
+
+    from features.parsing import parse_results
+
+    results_path = results_path or os.path.join(
+        output_dir, f"{strategy}_results.csv"
+    )
+    labels, errors = parse_results(pd.read_csv(results_path), strategy)
+    labels.to_csv(
+        os.path.join(output_dir, f"{strategy}_labels.csv"), index=False
+    )
+    errors.to_csv(
+        os.path.join(output_dir, f"{strategy}_parse_errors.csv"), index=False
+    )
+    click.echo(
+        f"{strategy}: {labels['document_id'].nunique()} reports, "
+        f"{len(labels)} labels, {len(errors)} parse errors"
+    )
+
+
+@cli.command()
+@click.argument("strategies", nargs=-1, required=True)
+@click.option(
+    "--manual",
+    "manual_path",
+    default="data/raw/manual.csv",
+    show_default=True,
+    help="Positive reports per factor (prompt, result), or the labels of "
+    "every report when the file has a document_id column.",
+)
+@click.option(
+    "--labels-dir",
+    default="data",
+    show_default=True,
+    help="Folder of the <strategy>_labels.csv files.",
+)
+def stats(strategies, manual_path, labels_dir):
+    """Precision, recall and F1 of STRATEGIES against the manual labels.
+
+    Writes <strategy>_metrics.csv next to the labels. With counts per
+    factor only the macro F1 is known, see compare_counts.
+    """
+    import numpy as np
+    import pandas as pd
+
+    from features.metrics import (
+        compare_counts,
+        label_matrix,
+        metrics_frame,
+        multilabel_metrics,
+    )
+
+    manual_df = pd.read_csv(manual_path)
+    labels = {
+        strategy: pd.read_csv(
+            os.path.join(labels_dir, f"{strategy}_labels.csv")
+        )
+        for strategy in strategies
+    }
+    if "document_id" not in manual_df:
+        for strategy, df in labels.items():
+            df = compare_counts(df, manual_df)
+            df.to_csv(os.path.join(labels_dir, f"{strategy}_metrics.csv"))
+            click.echo(f"{strategy}: macro F1 {df['f1_score'].mean():.3f}")
+        return
+
+    factors = list(dict.fromkeys(manual_df["prompt"]))
+    documents = sorted(manual_df["document_id"].unique())
+    actual = label_matrix(manual_df, factors, documents)
+
+    # strategies x reports x factors, compared in a single pass
+    predicted = np.stack(
+        [
+            label_matrix(labels[strategy], factors, documents)
+            for strategy in strategies
+        ]
+    )
+    metrics = multilabel_metrics(predicted, actual)
+    for i, strategy in enumerate(strategies):
+        strategy_metrics = {
+            name: values[i] for name, values in metrics.items()
+        }
+        df = metrics_frame(strategy_metrics, factors)
+        df.to_csv(os.path.join(labels_dir, f"{strategy}_metrics.csv"))
+        click.echo(
+            f"{strategy}: micro F1 {metrics['micro_f1'][i]:.3f}, "
+            f"macro F1 {metrics['macro_f1'][i]:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    cli()
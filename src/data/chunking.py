@@ -0,0 +1,100 @@
+import re
+from functools import lru_cache
+
+# Encoding used for models unknown to tiktoken (e.g. qwen on Ollama), close
+# enough to size the chunks
+DEFAULT_ENCODING = "o200k_base"
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(gpt_model=None):
+    """Return the tiktoken encoding of a model."""
+    import tiktoken
+
+    if gpt_model is not None:
+        try:
+            return tiktoken.encoding_for_model(gpt_model)
+        except KeyError:
+            pass
+    return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text, gpt_model=None):
+    """Number of tokens of a text for the given model."""
+    return len(get_encoding(gpt_model).encode(text, disallowed_special=()))
+
+
+def _split_tokens(text, max_tokens, gpt_model):
+    """Cut a text every max_tokens tokens, the last resort for huge blocks."""
+    encoding = get_encoding(gpt_model)
+    tokens = encoding.encode(text, disallowed_special=())
+    return [
+        encoding.decode(tokens[i:i + max_tokens])
+        for i in range(0, len(tokens), max_tokens)
+    ]
+
+
+def _pack(pieces, max_tokens, gpt_model, separator):
+    """Greedily group consecutive pieces into blocks of at most max_tokens."""
+    blocks, current, size = [], [], 0
+    separator_tokens = count_tokens(separator, gpt_model)
+    for piece, tokens in pieces:
+        extra = tokens + (separator_tokens if current else 0)
+        if current and size + extra > max_tokens:
+            blocks.append(separator.join(current))
+            current, size, extra = [], 0, tokens
+        current.append(piece)
+        size += extra
+    if current:
+        blocks.append(separator.join(current))
+    return blocks
+
+
+def chunk_text(text, max_tokens, gpt_model=None):
+    """Split a narrative into chunks of at most max_tokens tokens.
+
+    Chunks are cut at paragraph (line) boundaries. A paragraph that is too
+    long on its own is cut at sentence boundaries, and a sentence that is
+    still too long is cut every max_tokens tokens.
+
+    Parameters
+    ----------
+    text : str
+        Cleaned narrative, one paragraph per line.
+    max_tokens : int
+        Token budget of a chunk.
+    gpt_model : str, optional
+        Model whose tokenizer is used to count tokens.
+
+    Returns
+    -------
+    list
+        The chunks, in order.
+
+    """
+    if count_tokens(text, gpt_model) <= max_tokens:
+        return [text]
+
+    pieces = []
+    for paragraph in text.splitlines():
+        tokens = count_tokens(paragraph, gpt_model)
+        if tokens <= max_tokens:
+            pieces.append((paragraph, tokens))
+            continue
+        sentences = []
+        for sentence in _SENTENCE_END.split(paragraph):
+            tokens = count_tokens(sentence, gpt_model)
+            if tokens <= max_tokens:
+                sentences.append((sentence, tokens))
+            else:
+                sentences.extend(
+                    (part, count_tokens(part, gpt_model))
+                    for part in _split_tokens(sentence, max_tokens, gpt_model)
+                )
+        pieces.extend(
+            (block, count_tokens(block, gpt_model))
+            for block in _pack(sentences, max_tokens, gpt_model, " ")
+        )
+    return _pack(pieces, max_tokens, gpt_model, "\n")
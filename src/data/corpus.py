@@ -0,0 +1,279 @@
+import hashlib
+import json
+import mmap
+import os
+from array import array
+from functools import partial
+
+from data.preprocess import clean_context, parallel_map
+from data.readers import MAX_NARRATIVE_LENGTH, iter_json
+
+# Bump when the layout of the compiled files or the cleaning changes
+CORPUS_VERSION = 1
+
+DEFAULT_FIELDS = ["NtsbNumber", "Oid", "EventDate"]
+
+
+def _fingerprint(data_path):
+    """Size, modification time and SHA-256 of the source file."""
+    sha = hashlib.sha256()
+    with open(data_path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            sha.update(block)
+    stat = os.stat(data_path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": sha.hexdigest(),
+    }
+
+
+def _paths(corpus_path):
+    return {
+        "text": corpus_path + ".txt",
+        "index": corpus_path + ".idx",
+        "manifest": corpus_path + ".json",
+    }
+
+
+def _compile_record(record, key, fields, max_length):
+    """Metadata, cleaned UTF-8 narrative and SHA-256, run in the workers."""
+    values = [record[field] for field in fields]
+    raw = record[key]
+    if raw is None or (max_length is not None and len(raw) > max_length):
+        return values, None, None
+    encoded = clean_context(raw).encode("utf-8")
+    return values, encoded, hashlib.sha256(encoded).hexdigest()
+
+
+def compile_corpus(
+    data_path,
+    corpus_path="data/cache/corpus",
+    key="FactualNarrative",
+    fields=DEFAULT_FIELDS,
+    max_length=MAX_NARRATIVE_LENGTH,
+    processes=None,
+):
+    """Parse, filter and clean the reports once and store them on disk.
+
+    The cleaned narratives are concatenated in `<corpus_path>.txt`, their
+    byte offsets are stored as int64 in `<corpus_path>.idx` and the source
+    fingerprint, metadata columns and SHA-256 of every cleaned narrative in
+    `<corpus_path>.json`, which is written last so an interrupted
+    compilation is never picked up.
+
+    The reports are parsed in this process and cleaned and hashed across a
+    process pool, in a single streaming pass over the file.
+
+    Parameters
+    ----------
+    data_path : str
+        Location of the JSON dump.
+    corpus_path : str
+        Prefix of the compiled files.
+    key : str
+        Narrative field.
+    fields : list
+        Metadata fields to keep, one column each.
+    max_length : int, optional
+        Longer raw narratives are dropped, as in read_json.
+    processes : int, optional
+        Number of worker processes, the number of CPUs by default.
+
+    Returns
+    -------
+    Corpus
+        The compiled corpus.
+
+    """
+    paths = _paths(corpus_path)
+    os.makedirs(os.path.dirname(corpus_path) or ".", exist_ok=True)
+    fingerprint = _fingerprint(data_path)
+
+    starts, ends = array("q"), array("q")
+    columns = {field: [] for field in fields}
+    hashes = []
+    offset = 0
+    compile_record = partial(
+        _compile_record, key=key, fields=fields, max_length=max_length
+    )
+    records = iter_json(data_path, fields=[key, *fields])
+    with open(paths["text"] + ".tmp", "wb") as text:
+        for values, encoded, digest in parallel_map(
+            compile_record, records, processes
+        ):
+            for field, value in zip(fields, values):
+                columns[field].append(value)
+            hashes.append(digest)
+            if encoded is None:
+                starts.append(-1)
+                ends.append(-1)
+                continue
+            text.write(encoded)
+            starts.append(offset)
+            offset += len(encoded)
+            ends.append(offset)
+
+    with open(paths["index"] + ".tmp", "wb") as index:
+        starts.tofile(index)
+        ends.tofile(index)
+    os.replace(paths["text"] + ".tmp", paths["text"])
+    os.replace(paths["index"] + ".tmp", paths["index"])
+
+    manifest = {
+        "version": CORPUS_VERSION,
+        "source": os.path.abspath(data_path),
+        "fingerprint": fingerprint,
+        "key": key,
+        "max_length": max_length,
+        "size": len(starts),
+        "columns": columns,
+        "hashes": hashes,
+    }
+    with open(paths["manifest"] + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(paths["manifest"] + ".tmp", paths["manifest"])
+    return Corpus(corpus_path)
+
+
+def is_fresh(data_path, corpus_path="data/cache/corpus", **options):
+    """Whether the compiled corpus matches the source file and options.
+
+    The size and modification time are checked first, the content hash only
+    when the file was touched.
+    """
+    manifest_path = _paths(corpus_path)["manifest"]
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    expected = {
+        "key": options.get("key", "FactualNarrative"),
+        "max_length": options.get("max_length", MAX_NARRATIVE_LENGTH),
+    }
+    if manifest["version"] != CORPUS_VERSION or any(
+        manifest[name] != value for name, value in expected.items()
+    ):
+        return False
+    if set(options.get("fields", DEFAULT_FIELDS)) - set(manifest["columns"]):
+        return False
+
+    stat = os.stat(data_path)
+    stored = manifest["fingerprint"]
+    if stored["size"] != stat.st_size:
+        return False
+    if stored["mtime_ns"] == stat.st_mtime_ns:
+        return True
+    return _fingerprint(data_path)["sha256"] == stored["sha256"]
+
+
+def load_corpus(data_path, corpus_path="data/cache/corpus", **options):
+    """Open the compiled corpus, (re)compiling it if data_path changed.
+
+    Parameters
+    ----------
+    data_path : str
+        Location of the JSON dump.
+    corpus_path : str
+        Prefix of the compiled files.
+    **options
+        Passed on to compile_corpus (key, fields, max_length, processes).
+
+    Returns
+    -------
+    Corpus
+        The compiled corpus.
+
+    """
+    if is_fresh(data_path, corpus_path, **options):
+        return Corpus(corpus_path)
+    return compile_corpus(data_path, corpus_path, **options)
+
+
+class Corpus:
+    """Read-only, memory-mapped view of a compiled corpus.
+
+    Narratives are decoded on access from the mapped file, so opening a
+    corpus costs the same for 200 or 100k reports. Indexing by document id
+    returns the cleaned narrative, or None for a dropped report, and
+    iterating yields them in order, which makes a Corpus a drop-in
+    replacement for the output of read_json (use clean=False in the query
+    engine, the narratives are already cleaned).
+
+    Parameters
+    ----------
+    corpus_path : str
+        Prefix of the compiled files.
+
+    """
+
+    def __init__(self, corpus_path="data/cache/corpus"):
+        paths = _paths(corpus_path)
+        with open(paths["manifest"], encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.path = corpus_path
+        self.source = manifest["source"]
+        self.columns = manifest["columns"]
+        self.hashes = manifest["hashes"]
+        self._size = manifest["size"]
+
+        self._text_file = open(paths["text"], "rb")
+        # mmap refuses empty files
+        if os.fstat(self._text_file.fileno()).st_size:
+            self._text = mmap.mmap(
+                self._text_file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        else:
+            self._text = b""
+        offsets = array("q")
+        with open(paths["index"], "rb") as f:
+            offsets.frombytes(f.read())
+        self._starts = offsets[: self._size]
+        self._ends = offsets[self._size:]
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, document_id):
+        start = self._starts[document_id]
+        if start < 0:
+            return None
+        return str(
+            memoryview(self._text)[start:self._ends[document_id]], "utf-8"
+        )
+
+    def __iter__(self):
+        for document_id in range(self._size):
+            yield self[document_id]
+
+    def stable_ids(self):
+        """Document ids that do not move when reports are added or removed.
+
+        Positions shift whenever the export changes; "NtsbNumber:Oid" stays
+        with its report, so results can be carried over between exports.
+        """
+        return [
+            f"{ntsb_number}:{oid}"
+            for ntsb_number, oid in zip(
+                self.columns["NtsbNumber"], self.columns["Oid"]
+            )
+        ]
+
+    def metadata(self, document_id):
+        """Metadata fields of a report."""
+        return {
+            field: values[document_id]
+            for field, values in self.columns.items()
+        }
+
+    def close(self):
+        if isinstance(self._text, mmap.mmap):
+            self._text.close()
+        self._text_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
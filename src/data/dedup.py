@@ -0,0 +1,227 @@
+import zlib
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from data.retrieval import tokenize
+
+# Mersenne prime of the MinHash permutations, hashes are 32 bits
+_PRIME = np.uint64(2**31 - 1)
+
+
+def shingles(narrative, size=5):
+    """Hashes of the word size-grams of a narrative."""
+    words = tokenize(narrative)
+    grams = {
+        " ".join(words[i:i + size])
+        for i in range(max(1, len(words) - size + 1))
+    }
+    return np.array(
+        [zlib.crc32(gram.encode("utf-8")) for gram in grams], dtype=np.uint64
+    )
+
+
+def lsh_bands(threshold, num_perm):
+    """Bands and rows per band of the LSH buckets for a threshold.
+
+    Two narratives of Jaccard similarity s share a bucket with probability
+    1 - (1 - s**rows)**bands, which jumps from 0 to 1 around
+    (1 / bands) ** (1 / rows). The highest such point not above threshold
+    is picked, so pairs just above it are still candidates.
+    """
+    options = sorted(
+        ((1 / bands) ** (bands / num_perm), bands, num_perm // bands)
+        for bands in range(1, num_perm + 1)
+        if num_perm % bands == 0
+    )
+    below = [option for option in options if option[0] <= threshold]
+    _, bands, rows = below[-1] if below else options[0]
+    return bands, rows
+
+
+class DuplicateIndex:
+    """MinHash/LSH index of near-duplicate narratives.
+
+    NTSB exports hold the preliminary, factual and final versions of an
+    event and boilerplate narratives that barely differ. Each narrative is
+    reduced to a MinHash signature of its word shingles; LSH buckets find
+    the candidate pairs and pairs whose estimated Jaccard similarity
+    reaches the threshold are clustered.
+
+    Parameters
+    ----------
+    threshold : float
+        Jaccard similarity from which two narratives are duplicates.
+    num_perm : int
+        Number of MinHash permutations.
+    shingle_size : int
+        Words per shingle.
+    seed : int
+        Seed of the permutations.
+
+    """
+
+    def __init__(self, threshold=0.9, num_perm=128, shingle_size=5, seed=1):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, int(_PRIME), num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, int(_PRIME), num_perm, dtype=np.uint64)
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        self.keys, self.signatures = [], []
+        self._buckets = defaultdict(list)
+
+    def signature(self, narrative):
+        """MinHash signature of a narrative."""
+        hashes = shingles(narrative, self.shingle_size)
+        if not len(hashes):
+            return np.full(len(self._a), _PRIME, dtype=np.uint64)
+        permuted = (
+            self._a[:, None] * hashes[None, :] + self._b[:, None]
+        ) % _PRIME
+        return permuted.min(axis=1)
+
+    def add(self, key, narrative):
+        """Index a narrative under a key, e.g. (NtsbNumber, Oid)."""
+        signature = self.signature(narrative)
+        position = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        for band in range(self.bands):
+            rows = signature[band * self.rows:(band + 1) * self.rows]
+            self._buckets[(band, rows.tobytes())].append(position)
+
+    def similarity(self, first, second):
+        """Estimated Jaccard similarity of two indexed narratives."""
+        return float(
+            np.mean(self.signatures[first] == self.signatures[second])
+        )
+
+    def clusters(self):
+        """Groups of duplicate positions, singletons included.
+
+        Returns
+        -------
+        list
+            Sorted lists of positions, in the order of their first member.
+
+        """
+        parent = list(range(len(self.keys)))
+
+        def find(position):
+            while parent[position] != position:
+                parent[position] = parent[parent[position]]
+                position = parent[position]
+            return position
+
+        checked = set()
+        for members in self._buckets.values():
+            for i, first in enumerate(members):
+                for second in members[i + 1:]:
+                    if (first, second) in checked:
+                        continue
+                    checked.add((first, second))
+                    if self.similarity(first, second) >= self.threshold:
+                        parent[find(second)] = find(first)
+
+        groups = defaultdict(list)
+        for position in range(len(self.keys)):
+            groups[find(position)].append(position)
+        return sorted(groups.values())
+
+
+def find_duplicates(contexts, keys, threshold=0.9, **options):
+    """Representative report of every report of a corpus.
+
+    Parameters
+    ----------
+    contexts : iterable
+        Cleaned narratives, None for dropped reports.
+    keys : list
+        Key of each report, e.g. zip of the NtsbNumber and Oid columns.
+    threshold : float
+        Jaccard similarity from which two narratives are duplicates.
+    **options
+        Passed on to DuplicateIndex (num_perm, shingle_size, seed).
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per report with document_id, key, cluster, representative
+        (the document id of the longest narrative of its cluster, queried
+        for all of them) and similarity to the representative.
+
+    """
+    index = DuplicateIndex(threshold, **options)
+    document_ids, lengths = [], []
+    for document_id, (key, context) in enumerate(zip(keys, contexts)):
+        if context is None:
+            continue
+        index.add(key, context)
+        document_ids.append(document_id)
+        lengths.append(len(context))
+
+    rows = []
+    for cluster, members in enumerate(index.clusters()):
+        representative = max(members, key=lambda position: lengths[position])
+        for position in members:
+            rows.append(
+                (
+                    document_ids[position],
+                    index.keys[position],
+                    cluster,
+                    document_ids[representative],
+                    index.similarity(position, representative),
+                )
+            )
+    columns = ["document_id", "key", "cluster", "representative", "similarity"]
+    return pd.DataFrame(rows, columns=columns).sort_values("document_id")
+
+
+def representative_jobs(jobs, duplicates):
+    """The jobs of the representative reports only."""
+    representatives = set(duplicates["representative"])
+    return [job for job in jobs if job.document_id in representatives]
+
+
+def fan_out(rows, duplicates):
+    """Copy the answers of each representative to its duplicates.
+
+    Parameters
+    ----------
+    rows : list
+        [document_id, prompt, result] rows of the representatives.
+    duplicates : pandas.DataFrame
+        Output of find_duplicates.
+
+    Returns
+    -------
+    list
+        The rows of every report of the clusters.
+
+    """
+    members = defaultdict(list)
+    for document_id, representative in zip(
+        duplicates["document_id"], duplicates["representative"]
+    ):
+        members[representative].append(document_id)
+    return [
+        [document_id, prompt, result]
+        for representative, prompt, result in rows
+        for document_id in members.get(representative, [representative])
+    ]
+
+
+def calls_avoided(jobs, duplicates):
+    """Calls saved by querying the representatives only."""
+    kept = len(representative_jobs(jobs, duplicates))
+    return {
+        "jobs": len(jobs),
+        "queried": kept,
+        "avoided": len(jobs) - kept,
+        "clusters": duplicates["cluster"].nunique(),
+        "duplicates": int(
+            (duplicates["document_id"] != duplicates["representative"]).sum()
+        ),
+    }
@@ -1,14 +1,96 @@
+import html
+import multiprocessing
+import os
+import re
+from collections import deque
+from itertools import islice
+
+# Tags that end a line of the narrative, the other tags are dropped
+_BLOCK_TAGS = frozenset(
+    "br p div li ul ol tr table h1 h2 h3 h4 h5 h6 blockquote pre".split()
+)
+_TAG = re.compile(r"</?([A-Za-z][A-Za-z0-9]*)\b[^<>]*>")
+
+
+def _tag(match):
+    return "\n" if match.group(1).lower() in _BLOCK_TAGS else ""
+
+
 def clean_context(context: str) -> str:
     """
-    Clean the context by removing unnecessary characters and formatting.
-    """
-    # Remove leading and trailing whitespaces
-    context = context.strip()
+    Clean the context by removing markup, HTML entities and empty lines.
 
-    # Remove &#x0D;
+    Tags are dropped (<br>, <p>, ... end the line) before the entities are
+    decoded, so a decoded "&lt;500 ft" stays in the text. The exports'
+    non-breaking (&#x1E;) and optional (&#x1F;) hyphens become "-" and
+    nothing. Empty lines are removed, the other lines are kept as they are.
+    Markup and entities are only looked for when a "<" or "&" is left.
+    """
     context = context.replace("&#x0D;", "")
+    if "<" in context:
+        context = _TAG.sub(_tag, context)
+    if "&" in context:
+        # html.unescape would drop the control characters
+        context = context.replace("&#x1E;", "-").replace("&#x1F;", "")
+        context = html.unescape(context)
+    lines = context.strip().splitlines()
+    return "\n".join([line for line in lines if line.strip()])
+
+
+def _clean(context):
+    return None if context is None else clean_context(context)
+
+
+def _map_chunk(function, chunk):
+    return [function(item) for item in chunk]
+
+
+def parallel_map(function, items, processes=None, chunksize=256):
+    """Apply a function to a stream of items across a process pool.
+
+    The results are yielded in order. At most two chunks per worker are in
+    flight, so the items are read as they are processed and a large corpus
+    is never held in memory, unlike Pool.imap which consumes its input as
+    fast as it can. With a single process the items are mapped in this
+    process, without the cost of the pool.
+
+    Parameters
+    ----------
+    function : callable
+        Module-level function, it is pickled to the workers.
+    items : iterable
+        Arguments of the calls.
+    processes : int, optional
+        Number of worker processes, the number of CPUs by default.
+    chunksize : int
+        Items sent to a worker at a time.
+
+    Yields
+    ------
+    object
+        The results, in the order of the items.
+
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes == 1:
+        yield from map(function, items)
+        return
+    items = iter(items)
+    in_flight = deque()
+    with multiprocessing.Pool(processes) as pool:
+        while True:
+            while len(in_flight) < 2 * processes:
+                chunk = list(islice(items, chunksize))
+                if not chunk:
+                    break
+                in_flight.append(
+                    pool.apply_async(_map_chunk, (function, chunk))
+                )
+            if not in_flight:
+                return
+            yield from in_flight.popleft().get()
 
-    # Remove emty lines
-    context = "\n".join([line for line in context.splitlines() if line.strip()])
 
-    return context
+def clean_contexts(contexts, processes=None, chunksize=256):
+    """Clean a stream of narratives across a process pool, None stays None."""
+    return parallel_map(_clean, contexts, processes, chunksize)
@@ -1,22 +1,130 @@
-def read_json(data_path, key=None):
-    """Function to read json data"""
-    import json
+import json
+
+# Narratives longer than this are dropped, as they will cause errors in the
+# LLM query
+MAX_NARRATIVE_LENGTH = 25000
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def iter_json(data_path, fields=None, chunk_size=2**16):
+    """Parse a JSON array of records one record at a time.
+
+    Only the current record is held in memory, so memory use does not grow
+    with the size of the dump.
 
+    Parameters
+    ----------
+    data_path : str
+        Location of the JSON file, a top-level array of objects.
+    fields : list, optional
+        Keys to keep from each record, None keeps all of them. Missing keys
+        are set to None.
+    chunk_size : int
+        Number of characters read from the file at a time.
+
+    Yields
+    ------
+    dict
+        The (projected) records, in file order.
+
+    """
     with open(data_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    processed_data = []
-    if key is not None:
-        for i, entry in enumerate(data):
-            if "FactualNarrative" in entry:
-                raw = entry["FactualNarrative"]
-                # Need to drop long reports, as they will cause errors in the LLM query.
-                if raw is not None and len(raw) <= 25000:
-                    processed_data.append(raw)
-                else:
-                    processed_data.append(None)
-
-    else:
-        return processed_data
-
-    return processed_data
+        buffer = _read_start(f, chunk_size)
+        if not buffer.startswith("["):
+            raise ValueError(f"{data_path} does not contain a JSON array")
+        for record in _decode_records(f, buffer[1:], chunk_size, data_path):
+            if fields is not None:
+                record = {field: record.get(field) for field in fields}
+            yield record
+
+
+def _read_start(f, chunk_size):
+    """The first chunk of a file, without leading whitespace."""
+    buffer = ""
+    while not buffer:
+        chunk = f.read(chunk_size)
+        buffer = chunk.lstrip(_WHITESPACE)
+        if not chunk:
+            break
+    return buffer
+
+
+def _skip_separators(f, buffer, pos, eof, chunk_size):
+    """Move past the separators between two records, reading more if needed.
+
+    Returns the buffer, the position of the next record in it and whether
+    the end of the file was reached.
+    """
+    while True:
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE + ",":
+            pos += 1
+        if pos < len(buffer) or eof:
+            return buffer, pos, eof
+        buffer, pos = f.read(chunk_size), 0
+        eof = not buffer
+
+
+def _decode_records(f, buffer, chunk_size, data_path):
+    """Decode the records of a JSON array, buffer starts after the bracket."""
+    pos, eof = 0, False
+    while True:
+        buffer, pos, eof = _skip_separators(f, buffer, pos, eof, chunk_size)
+        if pos >= len(buffer):
+            raise ValueError(f"{data_path} ends before the closing bracket")
+        if buffer[pos] == "]":
+            return
+
+        try:
+            record, end = _decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The record continues in the next chunk, read a larger one
+            # so that a long record is not decoded over and over
+            more = f.read(max(chunk_size, len(buffer) - pos))
+            eof = not more
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+
+        buffer, pos = buffer[end:], 0
+        yield record
+
+
+def iter_narratives(
+    data_path, key="FactualNarrative", max_length=MAX_NARRATIVE_LENGTH
+):
+    """Stream one narrative per report, None for the reports to drop.
+
+    The output can be given directly to the query engine (build_jobs), the
+    position of a narrative being its document id.
+
+    Parameters
+    ----------
+    data_path : str
+        Location of the JSON file.
+    key : str
+        Narrative field to read.
+    max_length : int, optional
+        Narratives longer than this are replaced by None, None for no limit.
+
+    Yields
+    ------
+    str
+        The raw narrative, or None.
+
+    """
+    for record in iter_json(data_path, fields=[key]):
+        raw = record[key]
+        if raw is not None and (max_length is None or len(raw) <= max_length):
+            yield raw
+        else:
+            yield None
+
+
+def read_json(data_path, key=None):
+    """Function to read json data"""
+    if key is None:
+        return []
+    return list(iter_narratives(data_path, key=key))
@@ -0,0 +1,315 @@
+import os
+import re
+
+import numpy as np
+
+from data.chunking import count_tokens
+
+_WORD = re.compile(r"[a-z0-9]+")
+_LINE = re.compile(r"[^\n]+")
+_SENTENCE = re.compile(r"[^.!?]+(?:[.!?]+|$)")
+_CONTEXT_HEADER = re.compile(r"Context:\s*$")
+
+# Words too common in the reports and prompts to tell passages apart
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that "
+    "the this to was were which with".split()
+)
+
+
+def tokenize(text):
+    """Lowercase words of a text, without the stopwords."""
+    return [
+        word for word in _WORD.findall(text.lower()) if word not in STOPWORDS
+    ]
+
+
+def split_passages(narrative, max_words=120, min_words=8):
+    """Character spans of the passages of a cleaned narrative.
+
+    Every line (paragraph) is a passage. Short lines, such as the section
+    headings, are joined to the line that follows them, and lines longer
+    than max_words words are cut between sentences into passages of at
+    most max_words words.
+    """
+    blocks, start, end = [], None, None
+    for line in _LINE.finditer(narrative):
+        if start is None:
+            start = line.start()
+        end = line.end()
+        if len(line.group().split()) >= min_words:
+            blocks.append((start, end))
+            start = None
+    if start is not None:
+        blocks.append((start, end))
+
+    spans = []
+    for block_start, block_end in blocks:
+        block = narrative[block_start:block_end]
+        if len(block.split()) <= max_words:
+            spans.append((block_start, block_end))
+        else:
+            spans.extend(
+                (block_start + start, block_start + end)
+                for start, end in _pack_sentences(block, max_words)
+            )
+    return spans
+
+
+def _pack_sentences(text, max_words):
+    """Spans of consecutive sentences of text, max_words words at most.
+
+    A sentence longer than max_words is a span of its own.
+    """
+    spans, start, end, words = [], None, None, 0
+    for sentence in _SENTENCE.finditer(text):
+        size = len(sentence.group().split())
+        if start is not None and words + size > max_words:
+            spans.append((start, end))
+            start, words = None, 0
+        if start is None:
+            start = sentence.start()
+        end, words = sentence.end(), words + size
+    if start is not None:
+        spans.append((start, end))
+    return spans
+
+
+class PassageIndex:
+    """BM25 index over the passages of every narrative of a corpus.
+
+    Term statistics are computed over the whole corpus, the search ranks
+    the passages of one report. The index holds no text, only the spans of
+    the passages, so it is searched together with the narrative.
+
+    Parameters
+    ----------
+    contexts : iterable
+        Cleaned narratives, None for dropped reports.
+    max_words : int
+        Longest passage, in words.
+    k1 : float
+        BM25 term frequency saturation.
+    b : float
+        BM25 length normalisation.
+
+    """
+
+    def __init__(self, contexts=None, max_words=120, k1=1.5, b=0.75):
+        self.max_words, self.k1, self.b = max_words, k1, b
+        if contexts is not None:
+            self._build(contexts, max_words)
+
+    @property
+    def options(self):
+        """The options the index was built with."""
+        return {"max_words": self.max_words, "k1": self.k1, "b": self.b}
+
+    def _build(self, contexts, max_words):
+        vocabulary = {}
+        terms, counts, indptr, lengths = [], [], [0], []
+        spans, offsets = [], [0]
+        for context in contexts:
+            for start, end in split_passages(context or "", max_words):
+                words = tokenize(context[start:end])
+                frequencies = {}
+                for word in words:
+                    term = vocabulary.setdefault(word, len(vocabulary))
+                    frequencies[term] = frequencies.get(term, 0) + 1
+                terms.extend(frequencies)
+                counts.extend(frequencies.values())
+                indptr.append(len(terms))
+                lengths.append(len(words))
+                spans.append((start, end))
+            offsets.append(len(spans))
+
+        self.vocabulary = vocabulary
+        self.terms = np.array(terms, dtype=np.int32)
+        self.counts = np.array(counts, dtype=np.float32)
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.spans = np.array(spans, dtype=np.int64).reshape(-1, 2)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        lengths = np.array(lengths, dtype=np.float32)
+        self._weights(lengths)
+
+    def _weights(self, lengths):
+        self.lengths = lengths
+        n_passages = len(lengths)
+        frequency = np.bincount(self.terms, minlength=len(self.vocabulary))
+        self.idf = np.log1p((n_passages - frequency + 0.5) / (frequency + 0.5))
+        average = lengths.mean() if n_passages else 1.0
+        self.norms = self.k1 * (
+            1 - self.b + self.b * lengths / max(average, 1.0)
+        )
+
+    def save(self, path):
+        """Store the index in a .npz file."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        vocabulary = np.array(sorted(self.vocabulary, key=self.vocabulary.get))
+        with open(path + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                vocabulary=vocabulary,
+                terms=self.terms,
+                counts=self.counts,
+                indptr=self.indptr,
+                spans=self.spans,
+                offsets=self.offsets,
+                lengths=self.lengths,
+                parameters=np.array([self.k1, self.b, self.max_words]),
+            )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """Open an index stored with save."""
+        with np.load(path) as data:
+            k1, b, max_words = data["parameters"].tolist()
+            index = cls(max_words=int(max_words), k1=k1, b=b)
+            index.vocabulary = {
+                word: term
+                for term, word in enumerate(data["vocabulary"].tolist())
+            }
+            for name in ["terms", "counts", "indptr", "spans", "offsets"]:
+                setattr(index, name, data[name])
+            index._weights(data["lengths"])
+        return index
+
+    def search(self, document_id, query, k=3):
+        """Spans of the k passages of a report that best match the query.
+
+        Parameters
+        ----------
+        document_id : int
+            Report to search.
+        query : str
+            Question the passages should answer.
+        k : int
+            Number of passages.
+
+        Returns
+        -------
+        list
+            (start, end) character spans in the narrative, in narrative
+            order. All the passages if the report has k or fewer.
+
+        """
+        first, last = self.offsets[document_id], self.offsets[document_id + 1]
+        if last - first <= k:
+            return [tuple(span) for span in self.spans[first:last].tolist()]
+
+        query_terms = [
+            self.vocabulary[word]
+            for word in set(tokenize(query))
+            if word in self.vocabulary
+        ]
+        start, end = self.indptr[first], self.indptr[last]
+        terms = self.terms[start:end]
+        sizes = np.diff(self.indptr[first:last + 1])
+        rows = np.repeat(np.arange(last - first), sizes)
+        match = np.isin(terms, query_terms)
+        tf = self.counts[start:end][match]
+        norms = self.norms[first:last][rows[match]]
+        scores = np.bincount(
+            rows[match],
+            weights=self.idf[terms[match]] * tf * (self.k1 + 1) / (tf + norms),
+            minlength=last - first,
+        )
+        best = np.sort(np.argsort(-scores, kind="stable")[:k])
+        return [tuple(span) for span in self.spans[first + best].tolist()]
+
+
+def load_index(corpus, index_path=None, **options):
+    """Open the passage index of a compiled Corpus, building it if needed.
+
+    The index is stored next to the corpus files and rebuilt when the
+    corpus was compiled again or the options differ from the stored ones.
+
+    Parameters
+    ----------
+    corpus : Corpus
+        The compiled corpus.
+    index_path : str, optional
+        Location of the index, `<corpus path>.bm25.npz` by default.
+    **options
+        Passed on to PassageIndex (max_words, k1, b).
+
+    Returns
+    -------
+    PassageIndex
+        The index.
+
+    """
+    index_path = index_path or corpus.path + ".bm25.npz"
+    manifest = corpus.path + ".json"
+    if os.path.exists(index_path) and os.path.getmtime(
+        index_path
+    ) >= os.path.getmtime(manifest):
+        index = PassageIndex.load(index_path)
+        if index.options == PassageIndex(**options).options:
+            return index
+    index = PassageIndex(corpus, **options)
+    index.save(index_path)
+    return index
+
+
+def question(prompt_template):
+    """The question of a prompt template, used as the query.
+
+    The text from "Question:" to the narrative, with its definitions. The
+    instructions before it are the same in every prompt and would only
+    match their own words in the passages.
+    """
+    before = prompt_template.split("{context}")[0]
+    _, found, text = before.partition("Question:")
+    return _CONTEXT_HEADER.sub("", text if found else before).strip()
+
+
+def retrieve_context(index, document_id, context, query, k=3):
+    """The k passages of a narrative most relevant to a query, in order."""
+    return "\n".join(
+        context[start:end]
+        for start, end in index.search(document_id, query, k)
+    )
+
+
+def retrieval_jobs(jobs, index, k=3):
+    """Jobs whose narrative is replaced by the passages relevant to the prompt.
+
+    Parameters
+    ----------
+    jobs : list
+        Jobs of cleaned narratives, as built from a Corpus.
+    index : PassageIndex
+        Index of the same corpus.
+    k : int
+        Number of passages per job.
+
+    Returns
+    -------
+    list
+        The jobs with their retrieved context.
+
+    """
+    return [
+        job._replace(
+            context=retrieve_context(
+                index, job.document_id, job.context, question(job.template), k
+            )
+        )
+        for job in jobs
+    ]
+
+
+def context_reduction(jobs, retrieved, gpt_model=None):
+    """Narrative tokens of full and retrieved jobs, and the reduction.
+
+    The tokens are counted with the tokenizer of gpt_model.
+    """
+    full = sum(count_tokens(job.context, gpt_model) for job in jobs)
+    kept = sum(count_tokens(job.context, gpt_model) for job in retrieved)
+    return {
+        "context_tokens_full": full,
+        "context_tokens_retrieved": kept,
+        "reduction": 1 - kept / full if full else 0.0,
+    }
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+
+
+def narrative_hash(context):
+    """SHA-256 of a narrative, as stored in the corpus manifest."""
+    return hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+
+def job_hash(job, digest=None):
+    """SHA-256 of the prompt template and narrative hash of a job.
+
+    Parameters
+    ----------
+    job : Job
+        The job.
+    digest : str, optional
+        narrative_hash of the job's narrative, e.g. from Corpus.hashes,
+        computed from the context if not given.
+
+    """
+    sha = hashlib.sha256(job.template.encode("utf-8"))
+    sha.update(b"\0")
+    sha.update((digest or narrative_hash(job.context)).encode("ascii"))
+    return sha.hexdigest()
+
+
+class ResultWriter:
+    """Append-only JSONL store of (document_id, prompt, result) rows.
+
+    Each result is appended as soon as it is available and the file is
+    fsynced every `sync_every` rows, so a crashed run loses at most one
+    batch. Reopening an existing file picks up the completed pairs, which
+    lets the query blocks resume where they stopped. Every row also stores
+    the job_hash of its job, so the pairs whose narrative or prompt changed
+    since they were answered can be found (see changes).
+
+    Parameters
+    ----------
+    path : str
+        Location of the JSONL file.
+    sync_every : int
+        Number of rows between two fsyncs.
+
+    """
+
+    def __init__(self, path, sync_every=50):
+        self.path = path
+        self.sync_every = sync_every
+        self.completed = set()
+        self.hashes = {}
+        self._pending = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        valid_bytes = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        # A crash can leave a partially written last line
+                        break
+                    key = (row["document_id"], row["prompt"])
+                    self.completed.add(key)
+                    self.hashes[key] = row.get("hash")
+                    valid_bytes += len(line)
+
+        self._file = open(path, "ab")
+        self._file.truncate(valid_bytes)
+
+    def pending(self, jobs):
+        """Return the jobs whose result is not stored yet."""
+        return [
+            job
+            for job in jobs
+            if (job.document_id, job.prompt) not in self.completed
+        ]
+
+    def changes(self, jobs, digests=None):
+        """Sort the jobs by what happened since the last run.
+
+        Parameters
+        ----------
+        jobs : list
+            Jobs of the current run, with stable document ids.
+        digests : dict, optional
+            Mapping of document id to narrative_hash, e.g. built from
+            Corpus.hashes, so the narratives are not hashed again.
+
+        Returns
+        -------
+        dict
+            The jobs never answered ("new"), the ones answered for another
+            narrative or prompt, or before hashes were stored ("changed"),
+            the ones whose answer is carried forward ("unchanged"), and the
+            stored (document_id, prompt) pairs that are no longer asked
+            ("removed").
+
+        """
+        digests = digests or {}
+        changes = {"new": [], "changed": [], "unchanged": []}
+        for job in jobs:
+            key = (job.document_id, job.prompt)
+            if key not in self.completed:
+                changes["new"].append(job)
+            elif self.hashes.get(key) != job_hash(
+                job, digests.get(job.document_id)
+            ):
+                changes["changed"].append(job)
+            else:
+                changes["unchanged"].append(job)
+        asked = {(job.document_id, job.prompt) for job in jobs}
+        changes["removed"] = sorted(self.completed - asked, key=str)
+        return changes
+
+    def outdated(self, jobs, digests=None):
+        """Return the new jobs and those whose narrative or prompt changed."""
+        changes = self.changes(jobs, digests)
+        return changes["new"] + changes["changed"]
+
+    def write(self, job, result):
+        """Append the result of a job."""
+        row = {
+            "document_id": job.document_id,
+            "prompt": job.prompt,
+            "result": result,
+            "hash": job_hash(job),
+        }
+        self._file.write(json.dumps(row).encode("utf-8") + b"\n")
+        self.completed.add((job.document_id, job.prompt))
+        self.hashes[(job.document_id, job.prompt)] = row["hash"]
+        self._pending += 1
+        if self._pending >= self.sync_every:
+            self.flush()
+
+    def flush(self):
+        """Flush and fsync the rows written so far."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_results(path, jobs=None):
+    """Read the rows stored by a ResultWriter.
+
+    Parameters
+    ----------
+    path : str
+        Location of the JSONL file.
+    jobs : list, optional
+        If given, the rows are returned in the order of the jobs, which keeps
+        the output independent of the order in which queries completed.
+
+    Returns
+    -------
+    list
+        The [document_id, prompt, result] rows.
+
+    """
+    results = {}
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                break
+            results[(row["document_id"], row["prompt"])] = row["result"]
+
+    if jobs is None:
+        return [[key[0], key[1], result] for key, result in results.items()]
+    return [
+        [job.document_id, job.prompt, results[(job.document_id, job.prompt)]]
+        for job in jobs
+        if (job.document_id, job.prompt) in results
+    ]
@@ -1,3 +1,26 @@
+import numpy as np
+import pandas as pd
+
+# Factors compared with the manual labels, in the order of the result tables
+EVALUATED_FACTORS = [
+    "physical_environment_factors",
+    "tools_and_technology_issues",
+    "communication_coordination_planning_failures",
+    "fit_for_duty",
+    "mental_problems",
+    "physiological_state",
+    "physical_mental_limitations",
+    "decision_error",
+    "skill_based_errors",
+    "perceptual_error",
+    "routine_violation",
+    "exceptional_violation",
+]
+
+# Characters around an answer that do not change it, as in "Yes."
+_ANSWER_STRIP = " \t\r\n.,;:!?\"'"
+
+
 def calculate_confusion_matrix(predicted_positive, actual_positive, total_samples):
     """
     Calculate the confusion matrix components (TP, FN, FP, TN) and compute
@@ -66,3 +89,203 @@ def calculate_confusion_matrix(predicted_positive, actual_positive, total_sample
     )
 
     return precision, recall, f1_score, TP, FN, FP, TN
+
+
+def _safe_divide(numerator, denominator):
+    """Elementwise division, 0 where the denominator is 0."""
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    out = np.zeros(np.broadcast(numerator, denominator).shape)
+    np.divide(numerator, denominator, out=out, where=denominator != 0)
+    return out
+
+
+def multilabel_metrics(predicted, actual):
+    """Exact per-report agreement metrics of multi-label classifications.
+
+    Unlike calculate_confusion_matrix, which only sees the totals and
+    assumes TP = min(PP, AP), every report is compared with its manual
+    labels. Any leading axes (e.g. strategies x models) are computed in the
+    same vectorized pass.
+
+    Parameters
+    ----------
+    predicted : array_like
+        LLM labels, shape (..., reports, factors), 1/0 or True/False. NaN
+        marks a missing answer, which is left out of the counts.
+    actual : array_like
+        Manual labels, broadcastable to predicted.
+
+    Returns
+    -------
+    dict
+        Arrays of shape (..., factors) for TP, FP, FN, TN, precision,
+        recall and f1_score, and arrays of shape (...) for the micro and
+        macro averages (micro_precision, micro_recall, micro_f1,
+        macro_precision, macro_recall, macro_f1).
+
+    Notes
+    -----
+    Precision, recall and F1 are 0 when their denominator is 0, as in
+    calculate_confusion_matrix.
+    """
+    predicted = np.asarray(predicted, dtype=float)
+    actual = np.asarray(actual, dtype=float)
+    predicted, actual = np.broadcast_arrays(predicted, actual)
+    valid = ~(np.isnan(predicted) | np.isnan(actual))
+    predicted = (predicted > 0) & valid
+    actual = (actual > 0) & valid
+
+    # Sum over the reports axis
+    TP = np.sum(predicted & actual, axis=-2)
+    FP = np.sum(predicted & ~actual, axis=-2)
+    FN = np.sum(~predicted & actual, axis=-2)
+    TN = np.sum(valid, axis=-2) - TP - FP - FN
+
+    precision = _safe_divide(TP, TP + FP)
+    recall = _safe_divide(TP, TP + FN)
+    f1_score = _safe_divide(2 * precision * recall, precision + recall)
+
+    micro_tp, micro_fp, micro_fn = (np.sum(x, axis=-1) for x in (TP, FP, FN))
+    micro_precision = _safe_divide(micro_tp, micro_tp + micro_fp)
+    micro_recall = _safe_divide(micro_tp, micro_tp + micro_fn)
+
+    return {
+        "TP": TP,
+        "FP": FP,
+        "FN": FN,
+        "TN": TN,
+        "precision": precision,
+        "recall": recall,
+        "f1_score": f1_score,
+        "micro_precision": micro_precision,
+        "micro_recall": micro_recall,
+        "micro_f1": _safe_divide(
+            2 * micro_precision * micro_recall, micro_precision + micro_recall
+        ),
+        "macro_precision": precision.mean(axis=-1),
+        "macro_recall": recall.mean(axis=-1),
+        "macro_f1": f1_score.mean(axis=-1),
+    }
+
+
+def label_matrix(df, factors, documents=None):
+    """Pivot long-format labels into a reports x factors matrix.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        One row per (document_id, prompt) with a 1/0 `result`, YES/NO
+        answers are converted whatever their case and surrounding
+        punctuation ("Yes." is 1).
+    factors : list
+        Factor names, the columns of the matrix in this order.
+    documents : list, optional
+        Document ids, the rows of the matrix in this order. Defaults to the
+        sorted ids present in df.
+
+    Returns
+    -------
+    numpy.ndarray
+        Float matrix of shape (reports, factors), NaN where no label exists.
+
+    """
+    answers = df["result"].astype(str).str.strip(_ANSWER_STRIP).str.upper()
+    result = answers.map({"YES": 1, "NO": 0}).fillna(
+        pd.to_numeric(answers, errors="coerce")
+    )
+    table = (
+        df.assign(result=result)
+        .pivot_table(
+            index="document_id",
+            columns="prompt",
+            values="result",
+            aggfunc="max",
+        )
+        .reindex(columns=factors)
+    )
+    if documents is not None:
+        table = table.reindex(index=documents)
+    return table.to_numpy(dtype=float)
+
+
+def metrics_frame(metrics, factors):
+    """Per-factor metrics of multilabel_metrics as a DataFrame."""
+    columns = ["TP", "FN", "FP", "TN", "precision", "recall", "f1_score"]
+    return pd.DataFrame(
+        {name: metrics[name] for name in columns}, index=factors
+    )
+
+
+def compare_labels(labels, manual, factors=EVALUATED_FACTORS, documents=None):
+    """Per-factor metrics of LLM labels against the manual labels.
+
+    Parameters
+    ----------
+    labels : pandas.DataFrame
+        LLM labels, one row per (document_id, prompt), see label_matrix.
+    manual : pandas.DataFrame
+        Manual labels in the same layout.
+    factors : list
+        Factors to compare, the rows of the result.
+    documents : list, optional
+        Reports to compare, defaults to the ones with manual labels.
+
+    Returns
+    -------
+    pandas.DataFrame
+        metrics_frame of multilabel_metrics, a report without an LLM label
+        is left out of the counts of that factor.
+
+    """
+    if documents is None:
+        documents = sorted(manual["document_id"].unique())
+    metrics = multilabel_metrics(
+        label_matrix(labels, factors, documents),
+        label_matrix(manual, factors, documents),
+    )
+    return metrics_frame(metrics, factors)
+
+
+def compare_counts(labels, manual, factors=EVALUATED_FACTORS):
+    """Per-factor metrics of LLM labels against positive counts per factor.
+
+    data/raw/manual.csv only gives the number of reports the annotators
+    labelled positive for each factor, so the metrics are those of
+    calculate_confusion_matrix, which assumes TP = min(PP, AP). Use
+    compare_labels when the manual labels of every report are known.
+
+    Parameters
+    ----------
+    labels : pandas.DataFrame
+        LLM labels, one row per (document_id, prompt), see label_matrix.
+    manual : pandas.DataFrame
+        Positive reports per factor, with prompt and result columns.
+    factors : list
+        Factors to compare.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per factor with the LLM (result_x) and manual (result_y)
+        positive counts, precision, recall and f1_score, the layout of the
+        data/results tables.
+
+    """
+    predicted = pd.DataFrame(
+        {
+            "prompt": factors,
+            "result": np.nansum(label_matrix(labels, factors), axis=0).astype(
+                int
+            ),
+        }
+    )
+    df = pd.merge(predicted, manual[["prompt", "result"]], on="prompt")
+    true_positive = np.minimum(df["result_x"], df["result_y"])
+    precision = _safe_divide(true_positive, df["result_x"])
+    recall = _safe_divide(true_positive, df["result_y"])
+    return df.assign(
+        precision=precision,
+        recall=recall,
+        f1_score=_safe_divide(2 * precision * recall, precision + recall),
+    )
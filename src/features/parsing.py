@@ -0,0 +1,262 @@
+import re
+from collections import namedtuple
+
+import pandas as pd
+
+SUPERVISORY_FACTORS = {
+    1: "inadequate_supervision",
+    2: "planned_inappropriate_operations",
+    3: "failure_to_correct_known_problems",
+    4: "supervisory_violation",
+}
+
+PRECONDITIONS_FOR_UNSAFE_ACTS = {
+    1: "physical_environment_factors",
+    2: "tools_and_technology_issues",
+    3: "operational_process_failures",
+    4: "communication_coordination_planning_failures",
+    5: "fit_for_duty",
+    6: "mental_problems",
+    7: "physiological_state",
+    8: "physical_mental_limitations",
+}
+
+UNSAFE_ACTS = {
+    1: "decision_error",
+    2: "skill_based_errors",
+    3: "perceptual_error",
+    4: "routine_violation",
+    5: "exceptional_violation",
+}
+
+# io_merged.yaml skips question 13
+MERGED_QUERIES = {
+    **SUPERVISORY_FACTORS,
+    5: "physical_environment_factors",
+    6: "tools_and_technology_issues",
+    7: "communication_coordination_planning_failures",
+    8: "mental_problems",
+    9: "physiological_state",
+    10: "physical_mental_limitations",
+    11: "decision_error",
+    12: "skill_based_errors",
+    14: "perceptual_error",
+    15: "routine_violation",
+    16: "exceptional_violation",
+}
+
+DETAILED = {
+    "supervisory_factors_detailed": SUPERVISORY_FACTORS,
+    "preconditions_for_unsafe_acts_detailed": PRECONDITIONS_FOR_UNSAFE_ACTS,
+    "unsafe_acts_detailed": UNSAFE_ACTS,
+}
+
+# Factor asked by each question number of the multi-question prompts, per
+# strategy. Any other prompt asks one question about the factor it is named
+# after.
+PROMPT_FACTORS = {
+    "io_merged": {"merged_queries": MERGED_QUERIES},
+    # Question 13 repeats question 11, the first answer is kept
+    "io_expanded_merged": {
+        "merged_queries": {**MERGED_QUERIES, 13: "decision_error"}
+    },
+    "cot": DETAILED,
+    "tot": DETAILED,
+}
+
+# Numbered questions of a prompt template ("3. Is ..." or "Question 3:")
+_QUESTION = re.compile(
+    r"(?:^|(?<=\s))(?:Question\s+)?(\d{1,2})[.:](?=\s)", re.M
+)
+
+# Numbered answers ("3. YES", "**Question 3:** NO") and bare answers ("YES")
+_NUMBERED = re.compile(
+    r"(?im)^[\s*#>-]*(?:Question\s*)?(?P<number>\d{1,2})\s*[.:)]\s*\**\s*"
+    r"(?P<label>YES|NO)\b"
+)
+_BARE = re.compile(r"(?im)^[\s*#>-]*(?P<label>YES|NO)[\s.*]*$")
+
+# Reasoning outputs (cot, tot) end with the answers that count
+_FINAL = re.compile(r"(?i)final answers?")
+
+ParseError = namedtuple(
+    "ParseError", ["document_id", "prompt", "kind", "detail"]
+)
+
+
+def prompt_factors(strategy, prompt):
+    """Mapping of question number to factor of a prompt."""
+    return PROMPT_FACTORS.get(strategy, {}).get(prompt, {1: prompt})
+
+
+def question_numbers(prompt_template):
+    """Sorted question numbers of a prompt template, empty for one question."""
+    question = prompt_template.split("{context}")[0]
+    return sorted({int(number) for number in _QUESTION.findall(question)})
+
+
+def validate_prompts(strategy, prompts):
+    """Check that the factor definitions match the questions of the prompts.
+
+    Parameters
+    ----------
+    strategy : str
+        Name of the strategy, a prompt file of the PromptRegistry.
+    prompts : dict
+        Mapping of prompt name to template, as loaded from the YAML file.
+
+    Raises
+    ------
+    ValueError
+        If a prompt asks other questions than the ones it is parsed with.
+
+    """
+    for prompt, template in prompts.items():
+        numbers = question_numbers(template) or [1]
+        expected = sorted(prompt_factors(strategy, prompt))
+        if numbers != expected:
+            raise ValueError(
+                f"{strategy}/{prompt} asks questions {numbers} "
+                f"but is parsed as {expected}"
+            )
+
+
+def parse_results(df, strategy):
+    """Turn the answers of a results file into one label per factor.
+
+    Answers are matched to factors by question number, never by position,
+    so a missing or extra line only affects its own question. Unnumbered
+    answers (one YES/NO per line) are accepted only when there are exactly
+    as many as questions. All the rows are parsed at once with pandas string
+    methods.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Results with document_id, prompt and result columns.
+    strategy : str
+        Name of the strategy, selects the factor definitions.
+
+    Returns
+    -------
+    tuple
+        The labels, a DataFrame with document_id, prompt (the factor) and
+        result (1 or 0) columns, and the errors, a DataFrame of ParseError
+        rows (kind is unparseable, count_mismatch, unexpected_question or
+        missing_answer).
+
+    """
+    df = df.reset_index(drop=True)
+    if df.empty:
+        return (
+            pd.DataFrame(columns=["document_id", "prompt", "result"]),
+            pd.DataFrame(columns=ParseError._fields),
+        )
+    definitions = pd.DataFrame(
+        [
+            (prompt, number, factor)
+            for prompt in df["prompt"].unique()
+            for number, factor in prompt_factors(strategy, prompt).items()
+        ],
+        columns=["prompt", "number", "factor"],
+    )
+    expected = definitions.groupby("prompt")["number"].count()
+
+    text = df["result"].fillna("").astype(str)
+    # Only keep what follows the last "Final answers" of reasoning outputs
+    text = text.str.split(_FINAL).str[-1]
+
+    numbered = text.str.extractall(_NUMBERED).reset_index()
+    numbered = numbered.rename(columns={"level_0": "row"})
+    numbered["number"] = numbered["number"].astype(int)
+    # A repeated answer to a question is a correction, the last one counts
+    numbered = numbered.drop_duplicates(["row", "number"], keep="last")
+
+    bare = text.str.extractall(_BARE).reset_index()
+    bare = bare.rename(columns={"level_0": "row"})
+    bare = bare[~bare["row"].isin(numbered["row"])]
+    bare["prompt"] = df["prompt"].to_numpy()[bare["row"]]
+    counts = bare.groupby("row")["label"].transform("count")
+    fits = counts.to_numpy() == expected.reindex(bare["prompt"]).to_numpy()
+    mismatched = bare.loc[~fits].groupby("row")["label"].count()
+    bare = bare[fits]
+    # Unnumbered answers follow the order of the questions
+    order = {
+        prompt: sorted(numbers)
+        for prompt, numbers in definitions.groupby("prompt")["number"]
+    }
+    bare["number"] = [
+        order[prompt][i] for prompt, i in zip(bare["prompt"], bare["match"])
+    ]
+
+    answers = pd.concat([numbered, bare], ignore_index=True)
+    # An empty part turns the row numbers into objects
+    answers["row"] = answers["row"].astype(int)
+    answers["document_id"] = df["document_id"].to_numpy()[answers["row"]]
+    answers["prompt"] = df["prompt"].to_numpy()[answers["row"]]
+    answers = answers.merge(
+        definitions, on=["prompt", "number"], how="left", indicator=True
+    )
+
+    errors = []
+    for row, count in mismatched.items():
+        errors.append(
+            ParseError(
+                df.at[row, "document_id"],
+                df.at[row, "prompt"],
+                "count_mismatch",
+                f"{count} answers for "
+                f"{expected[df.at[row, 'prompt']]} questions",
+            )
+        )
+    unexpected = answers[answers["_merge"] == "left_only"]
+    errors.extend(
+        ParseError(
+            item.document_id, item.prompt, "unexpected_question", item.number
+        )
+        for item in unexpected.itertuples()
+    )
+    answers = answers[answers["_merge"] == "both"]
+
+    parsed = set(answers["row"]) | set(mismatched.index)
+    for row in df.index.difference(list(parsed)):
+        errors.append(
+            ParseError(
+                df.at[row, "document_id"],
+                df.at[row, "prompt"],
+                "unparseable",
+                text[row][:80],
+            )
+        )
+
+    present = answers[["row", "number"]].assign(present=True)
+    missing = (
+        df[["document_id", "prompt"]]
+        .rename_axis("row")
+        .reset_index()
+        .loc[lambda rows: rows["row"].isin(answers["row"])]
+        .merge(definitions, on="prompt")
+        .merge(present, on=["row", "number"], how="left")
+    )
+    missing = missing[missing["present"].isna()]
+    errors.extend(
+        ParseError(
+            item.document_id, item.prompt, "missing_answer", item.factor
+        )
+        for item in missing.itertuples()
+    )
+
+    labels = (
+        answers.sort_values(["row", "number"])
+        .drop_duplicates(["row", "factor"])
+        .assign(result=lambda rows: rows["label"].str.upper().eq("YES"))
+        .astype({"result": int})
+    )[["document_id", "factor", "result"]].rename(columns={"factor": "prompt"})
+    errors = pd.DataFrame(errors, columns=ParseError._fields)
+    return labels.reset_index(drop=True), errors
+
+
+def requery_jobs(errors, jobs):
+    """Jobs whose answer could not be fully parsed, to be asked again."""
+    bad = set(zip(errors["document_id"], errors["prompt"]))
+    return [job for job in jobs if (job.document_id, job.prompt) in bad]
@@ -1,15 +1,40 @@
 import os
-import re
 
 import numpy as np
 import pandas as pd
 import yaml
-from tqdm import tqdm
 
-from data.preprocess import clean_context
-from data.readers import read_json
-from features.metrics import calculate_confusion_matrix
-from models.llm import get_response
+from data.corpus import compile_corpus, load_corpus
+from data.dedup import (
+    calls_avoided,
+    fan_out,
+    find_duplicates,
+    representative_jobs,
+)
+from data.readers import iter_json, iter_narratives, read_json
+from data.retrieval import context_reduction, load_index, retrieval_jobs
+from data.writers import ResultWriter, read_results
+from features.metrics import (
+    EVALUATED_FACTORS,
+    calculate_confusion_matrix,
+    compare_counts,
+    label_matrix,
+    metrics_frame,
+    multilabel_metrics,
+)
+from features.parsing import parse_results, requery_jobs
+from models.batch import run_batch
+from models.cache import ResponseCache
+from models.cascade import recall_loss, run_cascade, simulate_cascade
+from models.consistency import self_consistency_query
+from models.engine import build_jobs, run_queries
+from models.executor import run_strategies
+from models.prompts import load_registry
+from models.resilience import AdaptiveLimiter, DeadLetterQueue, RetryPolicy
+from models.routing import RoutingStats, routed_query
+from models.session import run_sessions, summarize_prompt_stats
+from models.structured import structured_labels, structured_query
+from models.telemetry import Telemetry, install_signal_toggle, slow_call_logger
 from utils import skip_run
 
 # The configuration file
@@ -23,48 +48,209 @@ with skip_run("skip", "read_json_data") as check, check():
     data_path = "data/data.json"
     data = read_json(data_path, key="FactualNarrative")
 
+    # Stream the reports, keeping only the fields needed downstream
+    fields = [
+        "NtsbNumber",
+        "EventDate",
+        "FactualNarrative",
+        "AnalysisNarrative",
+    ]
+    n_records = sum(1 for _ in iter_json(data_path, fields=fields))
+    print(f"{n_records} reports streamed")
+
+
+with skip_run("skip", "compile_corpus") as check, check():
+    # Parse, filter and clean the reports once, later runs map the result
+    corpus = compile_corpus("data/data.json", "data/cache/corpus")
+    print(f"{len(corpus)} reports compiled")
+    corpus.close()
+
 
 with skip_run("skip", "input_output_llm_query") as check, check():
     data_path = "data/data.json"
-    contexts = read_json(data_path, key="FactualNarrative")
+    contexts = iter_narratives(data_path, key="FactualNarrative")
 
     # Set the GPT model to use
     # gpt_model = "qwen2.5:32b-instruct"
     gpt_model = "gpt-4o-mini"
 
-    io_prompts = yaml.load(open(str("prompts/io.yaml")), Loader=yaml.SafeLoader)
-    output = pd.DataFrame(columns=["document_id", "prompt", "result"])
-
-    # Reports to drop:
-    reports_to_drop = []
-
-    for i, context in enumerate(tqdm(contexts)):
-        try:
-            context = clean_context(context)
-            for prompt in io_prompts:
-                result = get_response(
-                    gpt_model, context, io_prompts[prompt], model_type="gpt"
-                ).text
-                if np.isnan(output.index.max() + 1):
-                    output.loc[0] = [i, prompt, result]
-                else:
-                    output.loc[output.index.max() + 1] = [i, prompt, result]
-        except Exception:
-            if str(i) not in reports_to_drop:
-                reports_to_drop.append(str(i))
-
-            if i % 10 == 0:
-                # Save the reports to drop
-                with open("data/io_reports_to_drop.txt", "w") as outfile:
-                    outfile.write("\n".join(reports_to_drop))
-
-                # Save the dictionary
-                output.to_csv("data/io_results.csv")
+    io_prompts = load_registry().templates("io")
+
+    # Query the (report, prompt) pairs not completed by a previous run
+    jobs, reports_to_drop = build_jobs(contexts, io_prompts)
+    cache = ResponseCache()
+    with ResultWriter("data/io_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="gpt",
+            cache=cache,
+            on_result=writer.write,
+        )
+    print(cache.stats())
+    reports_to_drop = sorted(set(reports_to_drop) | set(failed))
+
+    # Save the reports to drop
+    with open("data/io_reports_to_drop.txt", "w") as outfile:
+        outfile.write("\n".join(map(str, reports_to_drop)))
 
     # Save the dictionary
+    results = read_results("data/io_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
     output.to_csv("data/io_results.csv")
 
 
+with skip_run("skip", "chunked_llm_query") as check, check():
+    data_path = "data/data.json"
+    # Keep the long reports, they are split into chunks of at most
+    # max_context_tokens tokens instead of being dropped
+    contexts = iter_narratives(
+        data_path, key="FactualNarrative", max_length=None
+    )
+
+    # Set the GPT model to use
+    # gpt_model = "qwen2.5:32b-instruct"
+    gpt_model = "gpt-4o-mini"
+
+    io_prompts = load_registry().templates("io")
+
+    jobs, reports_to_drop = build_jobs(contexts, io_prompts)
+    cache = ResponseCache()
+    with ResultWriter("data/io_chunked_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="gpt",
+            cache=cache,
+            on_result=writer.write,
+            max_context_tokens=6000,
+        )
+    print(cache.stats())
+    reports_to_drop = sorted(set(reports_to_drop) | set(failed))
+
+    with open("data/io_chunked_reports_to_drop.txt", "w") as outfile:
+        outfile.write("\n".join(map(str, reports_to_drop)))
+
+    results = read_results("data/io_chunked_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv("data/io_chunked_results.csv")
+
+
+with skip_run("skip", "retrieval_llm_query") as check, check():
+    data_path = "data/data.json"
+    corpus = load_corpus(data_path, "data/cache/corpus")
+    # Built once per compiled corpus, offline
+    index = load_index(corpus)
+    gpt_model = "gpt-4o-mini"
+
+    io_prompts = load_registry().templates("io")
+
+    # Each question only sees the 3 passages of the narrative closest to it
+    jobs, reports_to_drop = build_jobs(corpus, io_prompts, clean=False)
+    retrieved = retrieval_jobs(jobs, index, k=3)
+    print(context_reduction(jobs, retrieved, gpt_model))
+    with ResultWriter("data/io_retrieval_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(retrieved),
+            gpt_model,
+            model_type="gpt",
+            on_result=writer.write,
+        )
+    results = read_results("data/io_retrieval_results.jsonl", retrieved)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv("data/io_retrieval_results.csv")
+
+    # Accuracy against the full-context run, on the labelled reports
+    factors = list(io_prompts)
+    manual_df = pd.read_csv("data/raw/manual_labels.csv")
+    documents = sorted(manual_df["document_id"].unique())
+    actual = label_matrix(manual_df, factors, documents)
+    predicted = np.stack(
+        [
+            label_matrix(
+                parse_results(pd.read_csv(path), "io")[0], factors, documents
+            )
+            for path in [
+                "data/raw/io_results.csv",
+                "data/io_retrieval_results.csv",
+            ]
+        ]
+    )
+    metrics = multilabel_metrics(predicted, actual)
+    full, retrieval = (
+        metrics_frame(
+            {name: values[i] for name, values in metrics.items()}, factors
+        )
+        for i in range(2)
+    )
+    # Positive where the passages do better than the whole narrative
+    scores = ["precision", "recall", "f1_score"]
+    print(retrieval[scores] - full[scores])
+    print("micro F1", metrics["micro_f1"][0], "->", metrics["micro_f1"][1])
+
+
+with skip_run("skip", "deduplicated_llm_query") as check, check():
+    data_path = "data/data.json"
+    corpus = load_corpus(data_path, "data/cache/corpus")
+    gpt_model = "gpt-4o-mini"
+
+    io_prompts = load_registry().templates("io")
+
+    # Versions of the same event and boilerplate narratives are asked once,
+    # the representative's answers are copied to the rest of its cluster
+    keys = list(zip(corpus.columns["NtsbNumber"], corpus.columns["Oid"]))
+    duplicates = find_duplicates(corpus, keys, threshold=0.9)
+    duplicates.to_csv("data/io_duplicates.csv", index=False)
+    jobs, reports_to_drop = build_jobs(corpus, io_prompts, clean=False)
+    print(calls_avoided(jobs, duplicates))
+
+    with ResultWriter("data/io_dedup_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(representative_jobs(jobs, duplicates)),
+            gpt_model,
+            model_type="gpt",
+            on_result=writer.write,
+        )
+    results = fan_out(
+        read_results("data/io_dedup_results.jsonl", jobs), duplicates
+    )
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.sort_values("document_id", kind="stable").to_csv(
+        "data/io_dedup_results.csv"
+    )
+
+
+with skip_run("skip", "incremental_llm_query") as check, check():
+    data_path = "data/data.json"
+    # Recompiled when the export changes, the manifest hashes every report
+    corpus = load_corpus(data_path, "data/cache/corpus")
+    gpt_model = "gpt-4o-mini"
+
+    io_prompts = load_registry().templates("io")
+
+    # Reports are identified by NtsbNumber:Oid, so a new export only asks
+    # the new reports and the ones whose narrative or prompt changed
+    ids = corpus.stable_ids()
+    jobs, reports_to_drop = build_jobs(
+        corpus, io_prompts, clean=False, ids=ids
+    )
+    with ResultWriter("data/io_incremental_results.jsonl") as writer:
+        # The narratives were hashed when the corpus was compiled
+        changes = writer.changes(jobs, dict(zip(ids, corpus.hashes)))
+        print({change: len(items) for change, items in changes.items()})
+        _, failed = run_queries(
+            changes["new"] + changes["changed"],
+            gpt_model,
+            model_type="gpt",
+            on_result=writer.write,
+        )
+
+    # The unchanged answers are carried forward, removed reports left out
+    results = read_results("data/io_incremental_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv("data/io_incremental_results.csv")
+
+
 with skip_run("skip", "input_output_merged_llm_query") as check, check():
     data_path = "data/data.json"
     contexts = read_json(data_path, key="FactualNarrative")
@@ -73,34 +259,65 @@ with skip_run("skip", "input_output_merged_llm_query") as check, check():
     # gpt_model = "qwen2.5:32b-instruct"
     gpt_model = "gpt-4o-mini"
 
-    io_prompts = yaml.load(open(str("prompts/io_merged.yaml")), Loader=yaml.SafeLoader)
-    output = pd.DataFrame(columns=["document_id", "prompt", "result"])
+    io_prompts = load_registry().templates("io_merged")
 
-    # Reports to drop:
-    reports_to_drop = []
+    # Query the reports not completed by a previous run
     prompt = "merged_queries"
-
-    for i, context in enumerate(tqdm(contexts)):
-        try:
-            context = clean_context(context)
-            result = get_response(
-                gpt_model, context, io_prompts[prompt], model_type="gpt"
-            ).text
-            if np.isnan(output.index.max() + 1):
-                output.loc[0] = [i, prompt, result]
-            else:
-                output.loc[output.index.max() + 1] = [i, prompt, result]
-        except Exception:
-            if str(i) not in reports_to_drop:
-                reports_to_drop.append(str(i))
-
-            # Save the dictionary
-            output.to_csv("data/io_merged_results.csv")
+    jobs, reports_to_drop = build_jobs(contexts, {prompt: io_prompts[prompt]})
+    cache = ResponseCache()
+    with ResultWriter("data/io_merged_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="gpt",
+            cache=cache,
+            on_result=writer.write,
+        )
+    print(cache.stats())
 
     # Save the dictionary
+    results = read_results("data/io_merged_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
     output.to_csv("data/io_merged_results.csv")
 
 
+with skip_run("skip", "structured_merged_llm_query") as check, check():
+    data_path = "data/data.json"
+    contexts = load_corpus(data_path, "data/cache/corpus")
+    gpt_model = "gpt-4o-mini"
+    strategy = "io_merged"
+
+    # The registry checked the questions against the factor definitions
+    io_prompts = load_registry().templates(strategy)
+
+    # One JSON answer per report, only the missing factors are asked again
+    jobs, reports_to_drop = build_jobs(contexts, io_prompts, clean=False)
+    cache = ResponseCache()
+    with ResultWriter(f"data/{strategy}_structured_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="gpt",
+            cache=cache,
+            on_result=writer.write,
+            query=structured_query(strategy),
+        )
+    print(cache.stats())
+    reports_to_drop = sorted(set(reports_to_drop) | set(failed))
+
+    with open(
+        f"data/{strategy}_structured_reports_to_drop.txt", "w"
+    ) as outfile:
+        outfile.write("\n".join(map(str, reports_to_drop)))
+
+    results = read_results(f"data/{strategy}_structured_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv(f"data/{strategy}_structured_results.csv")
+    structured_labels(output).to_csv(
+        f"data/{strategy}_structured_labels.csv", index=False
+    )
+
+
 with skip_run("skip", "input_output_expanded_llm_query") as check, check():
     data_path = "data/data.json"
     contexts = read_json(data_path, key="FactualNarrative")
@@ -109,42 +326,35 @@ with skip_run("skip", "input_output_expanded_llm_query") as check, check():
     # gpt_model = "qwen2.5:32b-instruct"
     gpt_model = "gpt-4o-mini"
 
-    io_prompts = yaml.load(
-        open(str("prompts/io_expanded.yaml")), Loader=yaml.SafeLoader
-    )
-    output = pd.DataFrame(columns=["document_id", "prompt", "result"])
-
-    # Reports to drop:
-    reports_to_drop = []
-
-    for i, context in enumerate(tqdm(contexts)):
-        try:
-            context = clean_context(context)
-            for prompt in io_prompts:
-                result = get_response(
-                    gpt_model, context, io_prompts[prompt], model_type="gpt"
-                ).text
-                if np.isnan(output.index.max() + 1):
-                    output.loc[0] = [i, prompt, result]
-                else:
-                    output.loc[output.index.max() + 1] = [i, prompt, result]
-        except Exception:
-            if str(i) not in reports_to_drop:
-                reports_to_drop.append(str(i))
-
-            if i % 10 == 0:
-                # Save the reports to drop
-                with open("data/io_expanded_reports_to_drop.txt", "w") as outfile:
-                    outfile.write("\n".join(reports_to_drop))
-
-                # Save the dictionary
-                output.to_csv("data/io_expanded_results.csv")
+    io_prompts = load_registry().templates("io_expanded")
+
+    # Query the (report, prompt) pairs not completed by a previous run
+    jobs, reports_to_drop = build_jobs(contexts, io_prompts)
+    cache = ResponseCache()
+    with ResultWriter("data/io_expanded_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="gpt",
+            cache=cache,
+            on_result=writer.write,
+        )
+    print(cache.stats())
+    reports_to_drop = sorted(set(reports_to_drop) | set(failed))
+
+    # Save the reports to drop
+    with open("data/io_expanded_reports_to_drop.txt", "w") as outfile:
+        outfile.write("\n".join(map(str, reports_to_drop)))
 
     # Save the dictionary
+    results = read_results("data/io_expanded_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
     output.to_csv("data/io_expanded_results.csv")
 
 
-with skip_run("skip", "input_output_expanded_merged_llm_query") as check, check():
+with skip_run(
+    "skip", "input_output_expanded_merged_llm_query"
+) as check, check():
     data_path = "data/data.json"
     contexts = read_json(data_path, key="FactualNarrative")
 
@@ -152,33 +362,25 @@ with skip_run("skip", "input_output_expanded_merged_llm_query") as check, check(
     # gpt_model = "qwen2.5:32b-instruct"
     gpt_model = "gpt-4o-mini"
 
-    io_prompts = yaml.load(
-        open(str("prompts/io_expanded_merged.yaml")), Loader=yaml.SafeLoader
-    )
-    output = pd.DataFrame(columns=["document_id", "prompt", "result"])
+    io_prompts = load_registry().templates("io_expanded_merged")
 
-    # Reports to drop:
-    reports_to_drop = []
+    # Query the reports not completed by a previous run
     prompt = "merged_queries"
-
-    for i, context in enumerate(tqdm(contexts)):
-        try:
-            context = clean_context(context)
-            result = get_response(
-                gpt_model, context, io_prompts[prompt], model_type="gpt"
-            ).text
-            if np.isnan(output.index.max() + 1):
-                output.loc[0] = [i, prompt, result]
-            else:
-                output.loc[output.index.max() + 1] = [i, prompt, result]
-        except Exception:
-            if str(i) not in reports_to_drop:
-                reports_to_drop.append(str(i))
-
-            # Save the dictionary
-            output.to_csv("data/io_expanded_merged_results.csv")
+    jobs, reports_to_drop = build_jobs(contexts, {prompt: io_prompts[prompt]})
+    cache = ResponseCache()
+    with ResultWriter("data/io_expanded_merged_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="gpt",
+            cache=cache,
+            on_result=writer.write,
+        )
+    print(cache.stats())
 
     # Save the dictionary
+    results = read_results("data/io_expanded_merged_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
     output.to_csv("data/io_expanded_merged_results.csv")
 
 
@@ -190,38 +392,72 @@ with skip_run("skip", "cot_llm_query") as check, check():
     # gpt_model = "qwen2.5:32b-instruct"
     gpt_model = "gpt-4o-mini"
 
-    io_prompts = yaml.load(open(str("prompts/cot.yaml")), Loader=yaml.SafeLoader)
-    output = pd.DataFrame(columns=["document_id", "prompt", "result"])
-
-    # Reports to drop:
-    reports_to_drop = []
-
-    for i, context in enumerate(tqdm(contexts)):
-        try:
-            context = clean_context(context)
-            for prompt in io_prompts:
-                result = get_response(
-                    gpt_model, context, io_prompts[prompt], model_type="gpt"
-                ).text
-                if np.isnan(output.index.max() + 1):
-                    output.loc[0] = [i, prompt, result]
-                else:
-                    output.loc[output.index.max() + 1] = [i, prompt, result]
-        except Exception:
-            if str(i) not in reports_to_drop:
-                reports_to_drop.append(str(i))
-
-        # Save the reports to drop
-        with open("data/cot_reports_to_drop.txt", "w") as outfile:
-            outfile.write("\n".join(reports_to_drop))
-
-        # Save the dictionary
-        output.to_csv("data/cot_results.csv")
+    io_prompts = load_registry().templates("cot")
+
+    # Query the (report, prompt) pairs not completed by a previous run
+    jobs, reports_to_drop = build_jobs(contexts, io_prompts)
+    cache = ResponseCache()
+    with ResultWriter("data/cot_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="gpt",
+            cache=cache,
+            on_result=writer.write,
+        )
+    print(cache.stats())
+    reports_to_drop = sorted(set(reports_to_drop) | set(failed))
+
+    # Save the reports to drop
+    with open("data/cot_reports_to_drop.txt", "w") as outfile:
+        outfile.write("\n".join(map(str, reports_to_drop)))
 
     # Save the dictionary
+    results = read_results("data/cot_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
     output.to_csv("data/cot_results.csv")
 
 
+with skip_run("skip", "cot_cascade_llm_query") as check, check():
+    data_path = "data/data.json"
+    contexts = load_corpus(data_path, "data/cache/corpus")
+    gpt_model = "gpt-4o-mini"
+
+    cot_prompts = load_registry().templates("cot")
+
+    # The detailed prompts are only asked when their HFACS level is not NO.
+    # A crashed run resumes, gating on the level answers it stored
+    jobs, reports_to_drop = build_jobs(contexts, cot_prompts, clean=False)
+    with ResultWriter("data/cot_cascade_results.jsonl") as writer:
+        answered = pd.DataFrame(
+            read_results("data/cot_cascade_results.jsonl", jobs),
+            columns=["document_id", "prompt", "result"],
+        )
+        _, failed, stats = run_cascade(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="gpt",
+            on_result=writer.write,
+            answered=answered,
+        )
+    print(stats)
+
+    results = read_results("data/cot_cascade_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv("data/cot_cascade_results.csv")
+    # Recall lost against the full fan-out run
+    print(recall_loss(pd.read_csv("data/raw/cot_results.csv"), output))
+
+
+with skip_run("skip", "simulate_cot_cascade") as check, check():
+    # What the cascade would have saved and lost on a full fan-out run,
+    # without any call to the model
+    full = pd.read_csv("data/raw/cot_results.csv")
+    simulated, calls_saved = simulate_cascade(full)
+    print(f"calls saved {calls_saved} of {len(full)}")
+    print(recall_loss(full, simulated))
+
+
 with skip_run("skip", "tot_llm_query") as check, check():
     data_path = "data/data.json"
     contexts = read_json(data_path, key="FactualNarrative")
@@ -230,425 +466,376 @@ with skip_run("skip", "tot_llm_query") as check, check():
     # gpt_model = "qwen2.5:32b-instruct"
     gpt_model = "gpt-4o-mini"
 
-    io_prompts = yaml.load(open(str("prompts/tot.yaml")), Loader=yaml.SafeLoader)
-    output = pd.DataFrame(columns=["document_id", "prompt", "result"])
+    io_prompts = load_registry().templates("tot")
+
+    # Query the (report, prompt) pairs not completed by a previous run
+    jobs, reports_to_drop = build_jobs(contexts, io_prompts)
+    cache = ResponseCache()
+    with ResultWriter("data/tot_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="gpt",
+            cache=cache,
+            on_result=writer.write,
+        )
+    print(cache.stats())
+
+    # Save the dictionary
+    results = read_results("data/tot_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv("data/tot_results.csv")
 
-    # Reports to drop:
-    reports_to_drop = []
 
-    for i, context in enumerate(tqdm(contexts)):
-        try:
-            context = clean_context(context)
-            for prompt in io_prompts:
-                result = get_response(
-                    gpt_model, context, io_prompts[prompt], model_type="gpt"
-                ).text
-                if np.isnan(output.index.max() + 1):
-                    output.loc[0] = [i, prompt, result]
-                else:
-                    output.loc[output.index.max() + 1] = [i, prompt, result]
-        except Exception:
-            if str(i) not in reports_to_drop:
-                reports_to_drop.append(str(i))
+with skip_run("skip", "tot_self_consistency_llm_query") as check, check():
+    data_path = "data/data.json"
+    contexts = load_corpus(data_path, "data/cache/corpus")
+    gpt_model = "gpt-4o-mini"
 
-        # Save the dictionary
-        output.to_csv("data/tot_results.csv")
+    tot_prompts = load_registry().templates("tot")
+
+    # Five short answers per prompt, voted per factor, instead of one long
+    # answer written out by five imagined experts
+    jobs, reports_to_drop = build_jobs(contexts, tot_prompts, clean=False)
+    telemetry = Telemetry()
+    with ResultWriter("data/tot_sc_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="gpt",
+            query=self_consistency_query("tot", n=5),
+            on_result=writer.write,
+            telemetry=telemetry,
+        )
+    print(telemetry.summary(by=("model",)))
 
+    # Same layout as the tot results, consolidated with parse_results
+    results = read_results("data/tot_sc_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv("data/tot_sc_results.csv")
 
-with skip_run("skip", "consolidate_data_io") as check, check():
-    df = pd.read_csv("data/raw/io_results.csv")[["prompt", "result"]]
-    df["result"] = df["result"].replace({"YES": 1, "NO": 0})
-    df["result"] = pd.to_numeric(df["result"], errors="coerce")
-    df = df.groupby(["prompt"]).sum()
 
-    # Load manual data
-    manual_df = pd.read_csv("data/raw/manual.csv")
+with skip_run("skip", "session_llm_query") as check, check():
+    data_path = "data/data.json"
+    contexts = load_corpus(data_path, "data/cache/corpus")
 
-    final_df = pd.merge(df, manual_df, on="prompt")
-    final_df = final_df[
-        final_df["prompt"].isin(
-            [
-                "physical_environment_factors",
-                "tools_and_technology_issues",
-                "communication_coordination_planning_failures",
-                "fit_for_duty",
-                "mental_problems",
-                "physiological_state",
-                "physical_mental_limitations",
-                "decision_error",
-                "skill_based_errors",
-                "perceptual_error",
-                "routine_violation",
-                "exceptional_violation",
-            ]
+    # Context-first prompts sent report by report, so the narrative is
+    # evaluated once and reused from the KV cache by the other questions
+    gpt_model = "qwen2.5:32b-instruct"
+
+    io_prompts = load_registry().templates("io")
+
+    jobs, reports_to_drop = build_jobs(contexts, io_prompts, clean=False)
+    with ResultWriter("data/io_session_results.jsonl") as writer:
+        _, failed, stats = run_sessions(
+            writer.pending(jobs),
+            gpt_model,
+            model_type="ollama",
+            on_result=writer.write,
         )
-    ]
-    df = final_df
-    precision, recall, f1_score = [], [], []
-    for index, row in df.iterrows():
-        output = calculate_confusion_matrix(row["result_x"], row["result_y"], 215)
-        precision.append(output[0])
-        recall.append(output[1])
-        f1_score.append(output[2])
-
-    df["precision"] = precision
-    df["recall"] = recall
-    df["f1_score"] = f1_score
-    df.to_excel("data/results/io.xlsx")
+    print(summarize_prompt_stats(stats))
+    pd.DataFrame(stats).to_csv("data/io_session_prompt_stats.csv", index=False)
 
+    results = read_results("data/io_session_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv("data/io_session_results.csv")
 
-with skip_run("skip", "consolidate_data_io_expanded") as check, check():
-    df = pd.read_csv("data/raw/io_expanded_results.csv")[["prompt", "result"]]
-    df["result"] = df["result"].replace({"YES": 1, "NO": 0})
-    df["result"] = pd.to_numeric(df["result"], errors="coerce")
-    df = df.groupby(["prompt"]).sum()
 
-    # Load manual data
-    manual_df = pd.read_csv("data/raw/manual.csv")
+with skip_run("skip", "batch_llm_query") as check, check():
+    data_path = "data/data.json"
+    contexts = load_corpus(data_path, "data/cache/corpus")
+    gpt_model = "gpt-4o-mini"
 
-    final_df = pd.merge(df, manual_df, on="prompt")
-    final_df = final_df[
-        final_df["prompt"].isin(
-            [
-                "physical_environment_factors",
-                "tools_and_technology_issues",
-                "communication_coordination_planning_failures",
-                "fit_for_duty",
-                "mental_problems",
-                "physiological_state",
-                "physical_mental_limitations",
-                "decision_error",
-                "skill_based_errors",
-                "perceptual_error",
-                "routine_violation",
-                "exceptional_violation",
-            ]
+    io_prompts = load_registry().templates("io_expanded")
+
+    # Submitted to the OpenAI Batch API, rerun the block to resume waiting
+    jobs, reports_to_drop = build_jobs(contexts, io_prompts, clean=False)
+    # The requests the batches failed, with their error
+    dead_letters = DeadLetterQueue("data/io_expanded_batch_dead_letters.jsonl")
+    with ResultWriter("data/io_expanded_batch_results.jsonl") as writer:
+        _, failed = run_batch(
+            writer.pending(jobs),
+            gpt_model,
+            "io_expanded",
+            on_result=writer.write,
+            dead_letters=dead_letters,
         )
+    reports_to_drop = sorted(set(reports_to_drop) | set(failed))
+
+    with open("data/io_expanded_batch_reports_to_drop.txt", "w") as outfile:
+        outfile.write("\n".join(map(str, reports_to_drop)))
+
+    results = read_results("data/io_expanded_batch_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv("data/io_expanded_batch_results.csv")
+
+
+with skip_run("skip", "resilient_llm_query") as check, check():
+    data_path = "data/data.json"
+    contexts = load_corpus(data_path, "data/cache/corpus")
+    gpt_model = "gpt-4o-mini"
+
+    io_prompts = load_registry().templates("io")
+
+    # Transient errors are retried, the concurrency follows the rate limits
+    # and the (report, prompt) pairs that still fail wait in a dead-letter
+    # queue instead of dropping the whole report
+    jobs, reports_to_drop = build_jobs(contexts, io_prompts, clean=False)
+    dead_letters = DeadLetterQueue("data/io_dead_letters.jsonl")
+    limiter = AdaptiveLimiter(16, maximum=64, latency_target=30)
+    with ResultWriter("data/io_results.jsonl") as writer:
+        pending = writer.pending(jobs)
+        # Re-drive the failures of the previous run first
+        redriven = dead_letters.redrive(pending)
+        first = set(redriven)
+        pending = redriven + [job for job in pending if job not in first]
+        _, failed = run_queries(
+            pending,
+            gpt_model,
+            model_type="gpt",
+            concurrency=limiter,
+            on_result=writer.write,
+            retry=RetryPolicy(),
+            dead_letters=dead_letters,
+        )
+        # Failures leave the queue once their result is stored
+        dead_letters.discard(
+            job
+            for job in redriven
+            if (job.document_id, job.prompt) in writer.completed
+        )
+    print(f"final concurrency {limiter.limit:.1f}, dead letters {len(failed)}")
+
+
+with skip_run("skip", "multi_strategy_llm_query") as check, check():
+    data_path = "data/data.json"
+    # Recompiled only when data.json changed
+    contexts = load_corpus(data_path, "data/cache/corpus")
+
+    # Set the GPT model to use
+    # gpt_model = "qwen2.5:32b-instruct"
+    gpt_model = "gpt-4o-mini"
+
+    # Strategies to compare, the reports are read and cleaned only once
+    strategies = [
+        "io",
+        "io_merged",
+        "io_expanded",
+        "io_expanded_merged",
+        "cot",
+        "tot",
     ]
-    df = final_df
-    precision, recall, f1_score = [], [], []
-    for index, row in df.iterrows():
-        output = calculate_confusion_matrix(row["result_x"], row["result_y"], 215)
-        precision.append(output[0])
-        recall.append(output[1])
-        f1_score.append(output[2])
-
-    df["precision"] = precision
-    df["recall"] = recall
-    df["f1_score"] = f1_score
-    df.to_excel("data/results/pe.xlsx")
 
+    cache = ResponseCache()
+    run_strategies(
+        contexts,
+        strategies,
+        gpt_model,
+        model_type="gpt",
+        clean=False,
+        cache=cache,
+    )
+    print(cache.stats())
 
-with skip_run("skip", "consolidate_data_cot") as check, check():
-    df = pd.read_csv("data/raw/cot_results.csv")[["prompt", "result"]]
-    df = df[df["prompt"].str.contains("detailed")]
 
-    factors = {
-        "supervisory_factors_detailed": [
-            "inadequate_supervision",
-            "planned_inappropriate_operations",
-            "failure_to_correct_known_problems",
-            "supervisory_violation",
-        ],
-        "preconditions_for_unsafe_acts_detailed": [
-            "physical_environment_factors",
-            "tools_and_technology_issues",
-            "operational_process_failures",
-            "communication_coordination_planning_failures",
-            "fit_for_duty",
-            "mental_problems",
-            "physiological_state",
-            "physical_mental_limitations",
-        ],
-        "unsafe_acts_detailed": [
-            "decision_error",
-            "skill_based_errors",
-            "perceptual_error",
-            "routine_violation",
-            "exceptional_violation",
-        ],
-    }
+with skip_run("skip", "routed_llm_query") as check, check():
+    data_path = "data/data.json"
+    contexts = load_corpus(data_path, "data/cache/corpus")
+
+    io_prompts = load_registry().templates("io")
+
+    # Every query goes to the local model first, the ones it is unsure of
+    # (split votes over 5 samples) or that it answers badly go to gpt-4o-mini
+    jobs, reports_to_drop = build_jobs(contexts, io_prompts, clean=False)
+    jobs = [job._replace(strategy="io") for job in jobs]
+    routing = RoutingStats()
+    query = routed_query(
+        "io",
+        strong_model="gpt-4o-mini",
+        strong_type="gpt",
+        method="samples",
+        threshold=0.8,
+        # Escalated unless the 5 samples agree
+        thresholds={
+            "exceptional_violation": 1.0,
+            "supervisory_violation": 1.0,
+        },
+        stats=routing,
+    )
+    with ResultWriter("data/io_routed_results.jsonl") as writer:
+        _, failed = run_queries(
+            writer.pending(jobs),
+            "qwen2.5:32b-instruct",
+            model_type="ollama",
+            query=query,
+            on_result=writer.write,
+        )
+    print(routing.summary())
 
-    output_rows = []
+    results = read_results("data/io_routed_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv("data/io_routed_results.csv")
 
-    for index, row in df.iterrows():
-        detailed_values = [
-            re.sub(r"^\d+\. \s*", "", output).replace(" ", "")
-            for output in row["result"].split("\n")
-        ]
-        for factor, value in zip(factors[row["prompt"]], detailed_values):
-            output_rows.append({"prompt": factor, "result": value})
-    df = pd.DataFrame(output_rows)
 
-    df["result"] = df["result"].replace({"YES": 1, "NO": 0})
-    df["result"] = pd.to_numeric(df["result"], errors="coerce")
-    df = df.groupby(["prompt"]).sum()
+with skip_run("skip", "instrumented_llm_query") as check, check():
+    data_path = "data/data.json"
+    contexts = load_corpus(data_path, "data/cache/corpus")
+    gpt_model = "gpt-4o-mini"
+
+    # Latency, tokens and cost of every call, per strategy, model and prompt.
+    # The slow-call log can be switched on and off with kill -USR1 <pid>,
+    # except on Windows
+    telemetry = Telemetry(stream=True)
+    telemetry.add_hook(slow_call_logger(threshold_ms=20000))
+    install_signal_toggle(telemetry)
+    run_strategies(
+        contexts,
+        ["io", "io_merged"],
+        gpt_model,
+        model_type="gpt",
+        clean=False,
+        telemetry=telemetry,
+    )
+    telemetry.to_json("data/metrics/llm_calls.json")
+    # Picked up by the node exporter textfile collector
+    telemetry.to_prometheus("data/metrics/hfacs_llm.prom")
 
-    # Load manual data
-    manual_df = pd.read_csv("data/raw/manual.csv")
 
-    final_df = pd.merge(df, manual_df, on="prompt")
-    final_df = final_df[
-        final_df["prompt"].isin(
-            [
-                "physical_environment_factors",
-                "tools_and_technology_issues",
-                "communication_coordination_planning_failures",
-                "fit_for_duty",
-                "mental_problems",
-                "physiological_state",
-                "physical_mental_limitations",
-                "decision_error",
-                "skill_based_errors",
-                "perceptual_error",
-                "routine_violation",
-                "exceptional_violation",
-            ]
+with skip_run("skip", "requery_unparsed_answers") as check, check():
+    data_path = "data/data.json"
+    contexts = load_corpus(data_path, "data/cache/corpus")
+    gpt_model = "gpt-4o-mini"
+    strategy = "io_merged"
+
+    # The registry checked the questions against the factor definitions
+    io_prompts = load_registry().templates(strategy)
+
+    # Ask again only the (report, prompt) pairs whose answer did not parse,
+    # the new answers are appended to the store and replace the old ones
+    jobs, _ = build_jobs(contexts, io_prompts, clean=False)
+    results = read_results(f"data/{strategy}_results.jsonl", jobs)
+    df = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    _, errors = parse_results(df, strategy)
+    print(errors["kind"].value_counts())
+
+    bad_jobs = requery_jobs(errors, jobs)
+    with ResultWriter(f"data/{strategy}_results.jsonl") as writer:
+        run_queries(
+            bad_jobs, gpt_model, model_type="gpt", on_result=writer.write
         )
-    ]
-    df = final_df
-    precision, recall, f1_score = [], [], []
-    for index, row in df.iterrows():
-        output = calculate_confusion_matrix(row["result_x"], row["result_y"], 215)
-        precision.append(output[0])
-        recall.append(output[1])
-        f1_score.append(output[2])
-
-    df["precision"] = precision
-    df["recall"] = recall
-    df["f1_score"] = f1_score
-    df.to_excel("data/results/cot.xlsx")
 
+    results = read_results(f"data/{strategy}_results.jsonl", jobs)
+    output = pd.DataFrame(results, columns=["document_id", "prompt", "result"])
+    output.to_csv(f"data/{strategy}_results.csv")
 
-with skip_run("skip", "consolidate_data_tot") as check, check():
-    df = pd.read_csv("data/tot_results.csv")[["prompt", "result"]]
-    df = df[~df["result"].str.contains("Final answers", na=False)]
-
-    factors = {
-        "supervisory_factors_detailed": [
-            "inadequate_supervision",
-            "planned_inappropriate_operations",
-            "failure_to_correct_known_problems",
-            "supervisory_violation",
-        ],
-        "preconditions_for_unsafe_acts_detailed": [
-            "physical_environment_factors",
-            "tools_and_technology_issues",
-            "operational_process_failures",
-            "communication_coordination_planning_failures",
-            "fit_for_duty",
-            "mental_problems",
-            "physiological_state",
-            "physical_mental_limitations",
-        ],
-        "unsafe_acts_detailed": [
-            "decision_error",
-            "skill_based_errors",
-            "perceptual_error",
-            "routine_violation",
-            "exceptional_violation",
-        ],
-    }
 
-    output_rows = []
+with skip_run("skip", "consolidate_data_io") as check, check():
+    df = pd.read_csv("data/raw/io_results.csv")
+
+    # Compared with the positive counts per factor of the manual labelling
+    manual_df = pd.read_csv("data/raw/manual.csv")
+    df = compare_counts(df, manual_df)
+    df.to_excel("data/results/io.xlsx")
 
-    for index, row in df.iterrows():
-        detailed_values = [
-            re.sub(r"^\d+\. \s*", "", output).replace(" ", "")
-            for output in row["result"].split("\n")
-        ]
-        for factor, value in zip(factors[row["prompt"]], detailed_values):
-            output_rows.append({"prompt": factor, "result": value})
-    df = pd.DataFrame(output_rows)
 
-    df["result"] = df["result"].replace({"YES": 1, "NO": 0})
-    df["result"] = pd.to_numeric(df["result"], errors="coerce")
-    df = df.groupby(["prompt"]).sum()
+with skip_run("skip", "consolidate_data_io_expanded") as check, check():
+    df = pd.read_csv("data/raw/io_expanded_results.csv")
 
-    # Load manual data
+    # Compared with the positive counts per factor of the manual labelling
     manual_df = pd.read_csv("data/raw/manual.csv")
+    df = compare_counts(df, manual_df)
+    df.to_excel("data/results/pe.xlsx")
 
-    final_df = pd.merge(df, manual_df, on="prompt")
-    final_df = final_df[
-        final_df["prompt"].isin(
-            [
-                "physical_environment_factors",
-                "tools_and_technology_issues",
-                "communication_coordination_planning_failures",
-                "fit_for_duty",
-                "mental_problems",
-                "physiological_state",
-                "physical_mental_limitations",
-                "decision_error",
-                "skill_based_errors",
-                "perceptual_error",
-                "routine_violation",
-                "exceptional_violation",
-            ]
-        )
-    ]
-    df = final_df
-    precision, recall, f1_score = [], [], []
-    for index, row in df.iterrows():
-        output = calculate_confusion_matrix(row["result_x"], row["result_y"], 215)
-        precision.append(output[0])
-        recall.append(output[1])
-        f1_score.append(output[2])
-
-    df["precision"] = precision
-    df["recall"] = recall
-    df["f1_score"] = f1_score
-    df.to_excel("data/results/tot.xlsx")
 
+with skip_run("skip", "consolidate_data_cot") as check, check():
+    df = pd.read_csv("data/raw/cot_results.csv")
+    df = df[df["prompt"].str.contains("detailed")]
 
-with skip_run("skip", "consolidate_data_io_merged") as check, check():
-    df = pd.read_csv("data/raw/io_merged_results.csv")[["prompt", "result"]]
-
-    factors = [
-        "inadequate_supervision",
-        "planned_inappropriate_operations",
-        "failure_to_correct_known_problems",
-        "supervisory_violation",
-        "physical_environment_factors",
-        "tools_and_technology_issues",
-        # "operational_process_failures",
-        "communication_coordination_planning_failures",
-        "fit_for_duty",
-        "mental_problems",
-        "physiological_state",
-        "physical_mental_limitations",
-        "decision_error",
-        "skill_based_errors",
-        "perceptual_error",
-        "routine_violation",
-        "exceptional_violation",
-    ]
+    # Answers are matched to factors by question number
+    df, errors = parse_results(df, "cot")
+    errors.to_csv("data/cot_parse_errors.csv", index=False)
 
-    output_rows = []
+    # Compared with the positive counts per factor of the manual labelling
+    manual_df = pd.read_csv("data/raw/manual.csv")
+    df = compare_counts(df, manual_df)
+    df.to_excel("data/results/cot.xlsx")
 
-    for index, row in df.iterrows():
-        detailed_values = [
-            re.sub(r"^\d+\. \s*", "", output).replace(" ", "")
-            for output in row["result"].split("\n")
-        ]
-        for factor, value in zip(factors, detailed_values):
-            output_rows.append({"prompt": factor, "result": value})
 
-    df = pd.DataFrame(output_rows)
+with skip_run("skip", "consolidate_data_tot") as check, check():
+    df = pd.read_csv("data/tot_results.csv")
 
-    df["result"] = df["result"].replace({"YES": 1, "NO": 0})
-    df["result"] = pd.to_numeric(df["result"], errors="coerce")
-    df = df.groupby(["prompt"]).sum().astype(int)
+    # Answers are matched to factors by question number
+    df, errors = parse_results(df, "tot")
+    errors.to_csv("data/tot_parse_errors.csv", index=False)
 
-    # Load manual data
+    # Compared with the positive counts per factor of the manual labelling
     manual_df = pd.read_csv("data/raw/manual.csv")
+    df = compare_counts(df, manual_df)
+    df.to_excel("data/results/tot.xlsx")
 
-    final_df = pd.merge(df, manual_df, on="prompt")
-    final_df = final_df[
-        final_df["prompt"].isin(
-            [
-                "physical_environment_factors",
-                "tools_and_technology_issues",
-                "communication_coordination_planning_failures",
-                "fit_for_duty",
-                "mental_problems",
-                "physiological_state",
-                "physical_mental_limitations",
-                "decision_error",
-                "skill_based_errors",
-                "perceptual_error",
-                "routine_violation",
-                "exceptional_violation",
-            ]
-        )
-    ]
-    df = final_df
-    precision, recall, f1_score = [], [], []
-    for index, row in df.iterrows():
-        output = calculate_confusion_matrix(row["result_x"], row["result_y"], 215)
-        precision.append(output[0])
-        recall.append(output[1])
-        f1_score.append(output[2])
-
-    df["precision"] = precision
-    df["recall"] = recall
-    df["f1_score"] = f1_score
-    df.to_excel("data/results/io_merged.xlsx")
 
+with skip_run("skip", "consolidate_data_io_merged") as check, check():
+    df = pd.read_csv("data/raw/io_merged_results.csv")
 
-with skip_run("skip", "consolidate_data_io_expanded_merged") as check, check():
-    df = pd.read_csv("data/raw/io_expanded_merged_results.csv")[["prompt", "result"]]
-
-    factors = [
-        "inadequate_supervision",
-        "planned_inappropriate_operations",
-        "failure_to_correct_known_problems",
-        "supervisory_violation",
-        "physical_environment_factors",
-        "tools_and_technology_issues",
-        # "operational_process_failures",
-        "communication_coordination_planning_failures",
-        "fit_for_duty",
-        "mental_problems",
-        "physiological_state",
-        "physical_mental_limitations",
-        "decision_error",
-        "skill_based_errors",
-        "perceptual_error",
-        "routine_violation",
-        "exceptional_violation",
-    ]
+    # Answers are matched to factors by question number
+    df, errors = parse_results(df, "io_merged")
+    errors.to_csv("data/io_merged_parse_errors.csv", index=False)
 
-    output_rows = []
+    # Compared with the positive counts per factor of the manual labelling
+    manual_df = pd.read_csv("data/raw/manual.csv")
+    df = compare_counts(df, manual_df)
+    df.to_excel("data/results/io_merged.xlsx")
 
-    for index, row in df.iterrows():
-        detailed_values = [
-            re.sub(r"^\d+\. \s*", "", output).replace(" ", "")
-            for output in row["result"].split("\n")
-        ]
-        for factor, value in zip(factors, detailed_values):
-            output_rows.append({"prompt": factor, "result": value})
 
-    df = pd.DataFrame(output_rows)
+with skip_run("skip", "consolidate_data_io_expanded_merged") as check, check():
+    df = pd.read_csv("data/raw/io_expanded_merged_results.csv")
 
-    df["result"] = df["result"].replace({"YES": 1, "NO": 0})
-    df["result"] = pd.to_numeric(df["result"], errors="coerce")
-    df = df.groupby(["prompt"]).sum().astype(int)
+    # Answers are matched to factors by question number
+    df, errors = parse_results(df, "io_expanded_merged")
+    errors.to_csv("data/io_expanded_merged_parse_errors.csv", index=False)
 
-    # Load manual data
+    # Compared with the positive counts per factor of the manual labelling
     manual_df = pd.read_csv("data/raw/manual.csv")
+    df = compare_counts(df, manual_df)
+    df.to_excel("data/results/pe_merged.xlsx")
 
-    final_df = pd.merge(df, manual_df, on="prompt")
-    final_df = final_df[
-        final_df["prompt"].isin(
-            [
-                "physical_environment_factors",
-                "tools_and_technology_issues",
-                "communication_coordination_planning_failures",
-                "fit_for_duty",
-                "mental_problems",
-                "physiological_state",
-                "physical_mental_limitations",
-                "decision_error",
-                "skill_based_errors",
-                "perceptual_error",
-                "routine_violation",
-                "exceptional_violation",
-            ]
+
+with skip_run("skip", "per_report_metrics") as check, check():
+    factors = EVALUATED_FACTORS
+    strategies = ["io", "io_expanded"]
+
+    # Manual labels of every report, one row per (document_id, prompt),
+    # see "Manual labels" in the README
+    manual_df = pd.read_csv("data/raw/manual_labels.csv")
+    documents = sorted(manual_df["document_id"].unique())
+    actual = label_matrix(manual_df, factors, documents)
+
+    # strategies x reports x factors, compared in a single pass
+    predicted = np.stack(
+        [
+            label_matrix(
+                pd.read_csv(f"data/raw/{strategy}_results.csv"),
+                factors,
+                documents,
+            )
+            for strategy in strategies
+        ]
+    )
+    metrics = multilabel_metrics(predicted, actual)
+
+    for i, strategy in enumerate(strategies):
+        strategy_metrics = {
+            name: values[i] for name, values in metrics.items()
+        }
+        df = metrics_frame(strategy_metrics, factors)
+        print(
+            strategy,
+            "micro F1",
+            metrics["micro_f1"][i],
+            "macro F1",
+            metrics["macro_f1"][i],
         )
-    ]
-    df = final_df
-    precision, recall, f1_score = [], [], []
-    for index, row in df.iterrows():
-        output = calculate_confusion_matrix(row["result_x"], row["result_y"], 215)
-        precision.append(output[0])
-        recall.append(output[1])
-        f1_score.append(output[2])
-
-    df["precision"] = precision
-    df["recall"] = recall
-    df["f1_score"] = f1_score
-    df.to_excel("data/results/pe_merged.xlsx")
+        df.to_excel(f"data/results/{strategy}_per_report.xlsx")
 
 
 with skip_run("skip", "precision_recall_f1_score") as check, check():
@@ -690,17 +877,14 @@ with skip_run("skip", "precision_recall_f1_score") as check, check():
         df["Factors"] = pd.Categorical(df["Factors"], categories=sort_order)
         df = df.sort_values(by="Factors")
 
-        precision, recall, f1_score = [], [], []
-
-        for index, row in df.iterrows():
-            output = calculate_confusion_matrix(row["LLM"], row["Manual"], 215)
-            precision.append(output[0])
-            recall.append(output[1])
-            f1_score.append(output[2])
-
-        df["precision"] = precision
-        df["recall"] = recall
-        df["f1_score"] = f1_score
+        # Only the totals per factor are in these files
+        outputs = [
+            calculate_confusion_matrix(llm, manual, 215)
+            for llm, manual in zip(df["LLM"], df["Manual"])
+        ]
+        df["precision"] = [output[0] for output in outputs]
+        df["recall"] = [output[1] for output in outputs]
+        df["f1_score"] = [output[2] for output in outputs]
 
         print(save_path)
         df.to_excel(save_path, index=False)
@@ -714,7 +898,89 @@ with skip_run("skip", "chi_sqaure_test") as check, check():
     print(data["Manual"].sum())
     print(data["LLM"].sum())
 
-    chi2_statistic, p_value = chisquare(f_exp=data["Manual"], f_obs=data["LLM"])
+    chi2_statistic, p_value = chisquare(
+        f_exp=data["Manual"], f_obs=data["LLM"]
+    )
 
     print("Chi-squared statistic:", chi2_statistic)
     print("P-value:", p_value)
+
+
+with skip_run("skip", "benchmark_client_reuse") as check, check():
+    from benchmarks.clients import benchmark_client_reuse
+
+    for model_type in ["ollama", "gpt"]:
+        print(model_type, benchmark_client_reuse(model_type=model_type))
+
+
+with skip_run("skip", "check_batch_roundtrip") as check, check():
+    from benchmarks.batch import check_batch_roundtrip
+
+    print(check_batch_roundtrip())
+
+
+with skip_run("skip", "benchmark_throughput") as check, check():
+    from benchmarks.throughput import (
+        benchmark_corpora,
+        compare_results,
+        run_throughput,
+        save_results,
+    )
+
+    contexts = list(load_corpus("data/data.json", "data/cache/corpus"))
+    # A hosted model: about 0.5 s to the first token, 50 tokens per second
+    # and 1% of server errors
+    stub = {
+        "latency": 0.5,
+        "jitter": 0.2,
+        "error_rate": 0.01,
+        "token_rate": 50,
+    }
+    # The 45 prompts of a report take about 9 s over both backends at this
+    # latency: the 215 reports and 10k synthetic ones run for about a day,
+    # pass n_reports and n_synthetic for a quicker run
+    corpora = benchmark_corpora(contexts)
+    results = []
+    for model_type in ["ollama", "gpt"]:
+        for corpus, narratives in corpora.items():
+            results += run_throughput(
+                narratives, corpus, model_type=model_type, stub_options=stub
+            )
+    save_results(results)
+    columns = ["corpus", "model_type", "strategy", "qps", "p50_ms", "p99_ms"]
+    print(pd.DataFrame(results)[columns])
+    # Changes against the previous benchmarked commit
+    print(compare_results())
+
+
+with skip_run("skip", "benchmark_preprocessing") as check, check():
+    from benchmarks.preprocess import (
+        RESULTS_PATH,
+        run_preprocess,
+        synthetic_raw_corpus,
+    )
+    from benchmarks.throughput import save_results
+
+    raw = list(iter_narratives("data/data.json", max_length=None))
+    results = run_preprocess(
+        synthetic_raw_corpus(100000, raw), "synthetic_100k"
+    )
+    save_results(results, RESULTS_PATH)
+    columns = [
+        "stage",
+        "processes",
+        "seconds",
+        "reports_per_second",
+        "mb_per_second",
+    ]
+    print(pd.DataFrame(results)[columns])
+
+
+with skip_run("skip", "benchmark_startup") as check, check():
+    from benchmarks.startup import RESULTS_PATH, run_startup
+    from benchmarks.throughput import save_results
+
+    # Start-up of the CLI commands against the llama_index import of main.py
+    results = run_startup()
+    save_results(results, RESULTS_PATH)
+    print(pd.DataFrame(results)[["command", "seconds", "min_seconds"]])
@@ -0,0 +1,278 @@
+import io
+import json
+import os
+import time
+
+from models.llm import _render_prompt
+
+# Terminal states of an OpenAI batch
+BATCH_DONE = {"completed", "failed", "expired", "cancelled"}
+
+# Limits of one batch input file of the OpenAI Batch API
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 200 * 2**20
+
+
+class BatchError(RuntimeError):
+    """A request of a batch that got no answer."""
+
+
+def _custom_id(job):
+    return json.dumps([job.document_id, job.prompt, job.strategy])
+
+
+def _request_line(job, gpt_model, body):
+    request = {
+        "custom_id": _custom_id(job),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": gpt_model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": _render_prompt(job.context, job.template),
+                }
+            ],
+            **body,
+        },
+    }
+    return (json.dumps(request) + "\n").encode("utf-8")
+
+
+def build_batch_files(
+    jobs,
+    gpt_model,
+    path,
+    max_requests=MAX_BATCH_REQUESTS,
+    max_bytes=MAX_BATCH_BYTES,
+    **body,
+):
+    """Render the jobs into OpenAI batch input files.
+
+    Each line is the chat completion request of a job, its custom_id being
+    the JSON-encoded [document_id, prompt, strategy] of the job. A batch
+    takes at most 50,000 requests and 200 MB, the jobs are split into as
+    many files as needed, named <path stem>-<part><extension>.
+
+    Parameters
+    ----------
+    jobs : list
+        Jobs created by build_jobs or build_strategy_jobs.
+    gpt_model : str
+        The model to query.
+    path : str
+        Location of the JSONL files, before the part number.
+    max_requests : int
+        Requests per file.
+    max_bytes : int
+        Size of a file.
+    **body
+        Extra request parameters, e.g. temperature.
+
+    Returns
+    -------
+    list
+        The paths of the files.
+
+    """
+    body = {"temperature": 1.0, **body}
+    root, extension = os.path.splitext(path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    paths, f = [], None
+    requests = size = 0
+    try:
+        for job in jobs:
+            line = _request_line(job, gpt_model, body)
+            full = f is not None and (
+                requests == max_requests or size + len(line) > max_bytes
+            )
+            if f is None or full:
+                if f is not None:
+                    f.close()
+                paths.append(f"{root}-{len(paths)}{extension}")
+                f = open(paths[-1], "wb")
+                requests, size = 0, 0
+            f.write(line)
+            requests += 1
+            size += len(line)
+    finally:
+        if f is not None:
+            f.close()
+    return paths
+
+
+def submit_batch(client, path):
+    """Upload a batch input file and start the batch, returns the batch."""
+    with open(path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+
+
+def wait_batch(client, batch_id, poll_interval=30):
+    """Poll a batch until it reaches a terminal state, returns the batch."""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in BATCH_DONE:
+            return batch
+        time.sleep(poll_interval)
+
+
+def _file_lines(client, file_id):
+    """The JSON lines of a batch output or error file."""
+    if file_id is None:
+        return
+    content = client.files.content(file_id).text
+    for line in io.StringIO(content):
+        if line.strip():
+            yield json.loads(line)
+
+
+def _error_message(item):
+    """Why a line of a batch output or error file has no answer."""
+    response = item.get("response") or {}
+    error = item.get("error") or (response.get("body") or {}).get("error")
+    if isinstance(error, dict):
+        error = error.get("message") or error.get("code")
+    status = response.get("status_code")
+    return f"HTTP {status}: {error}" if status is not None else str(error)
+
+
+def ingest_batch(client, batches, jobs, on_result=None, dead_letters=None):
+    """Read the output and error files of finished batches.
+
+    Parameters
+    ----------
+    client : openai.OpenAI
+        The client the batches were submitted with.
+    batches : list
+        The finished batches (openai.types.Batch).
+    jobs : list
+        The jobs the batch input files were built from.
+    on_result : callable, optional
+        Called with (job, result) for every answered job.
+    dead_letters : DeadLetterQueue, optional
+        Stores the jobs without an answer with the error of their request,
+        or the status of their batch.
+
+    Returns
+    -------
+    tuple
+        The [document_id, prompt, result] rows in job order and the sorted
+        document ids of the jobs that failed.
+
+    """
+    by_id = {_custom_id(job): job for job in jobs}
+    results, errors = {}, {}
+    for batch in batches:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            for item in _file_lines(client, file_id):
+                job = by_id.get(item["custom_id"])
+                if job is None:
+                    continue
+                response = item.get("response") or {}
+                if item.get("error") or response.get("status_code") != 200:
+                    errors[job] = _error_message(item)
+                    continue
+                text = response["body"]["choices"][0]["message"]["content"]
+                results[job] = text
+                if on_result is not None:
+                    on_result(job, text)
+
+    rows = [
+        [job.document_id, job.prompt, results[job]]
+        for job in jobs
+        if job in results
+    ]
+    missing = [job for job in jobs if job not in results]
+    if dead_letters is not None:
+        statuses = ", ".join(f"{b.id} {b.status}" for b in batches)
+        for job in missing:
+            message = errors.get(job, f"no answer in the batches ({statuses})")
+            dead_letters.add(job, BatchError(message))
+    failed = {job.document_id for job in missing}
+    return rows, sorted(failed)
+
+
+def run_batch(
+    jobs,
+    gpt_model,
+    name,
+    work_dir="data/batches",
+    base_url=None,
+    poll_interval=30,
+    on_result=None,
+    dead_letters=None,
+    **options,
+):
+    """Run the jobs through the OpenAI Batch API instead of live requests.
+
+    The batch is cheaper and has its own rate limits, at the price of up to
+    24 hours of latency. Jobs over the limits of one batch are split into
+    several, see build_batch_files. The batch ids are saved next to the
+    input files as they are submitted, so calling run_batch again with the
+    same name after an interruption waits for the batches already
+    submitted instead of paying for new ones. The return value matches
+    run_queries.
+
+    Parameters
+    ----------
+    jobs : list
+        Jobs created by build_jobs or build_strategy_jobs.
+    gpt_model : str
+        The model to query.
+    name : str
+        Name of the batch, used for its files in work_dir.
+    work_dir : str
+        Folder of the batch input files and state.
+    base_url : str, optional
+        API address, e.g. the one of a StubServer.
+    poll_interval : float
+        Seconds between two status checks.
+    on_result : callable, optional
+        Called with (job, result) for every answered job, e.g.
+        ResultWriter.write.
+    dead_letters : DeadLetterQueue, optional
+        Stores the failed jobs with the error read from the batch.
+    **options
+        Passed on to openai.OpenAI (api_key, timeout, ...).
+
+    Returns
+    -------
+    tuple
+        The [document_id, prompt, result] rows in job order and the sorted
+        document ids of the jobs that failed.
+
+    """
+    from openai import OpenAI
+
+    if not jobs:
+        return [], []
+    client = OpenAI(base_url=base_url, **options)
+    input_path = os.path.join(work_dir, f"{name}.jsonl")
+    state_path = os.path.join(work_dir, f"{name}.batch.json")
+
+    state = {"parts": None, "batch_ids": []}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    if state["parts"] is None or len(state["batch_ids"]) < state["parts"]:
+        paths = build_batch_files(jobs, gpt_model, input_path)
+        state["parts"] = len(paths)
+        for path in paths[len(state["batch_ids"]):]:
+            state["batch_ids"].append(submit_batch(client, path).id)
+            with open(state_path, "w") as f:
+                json.dump(state, f)
+
+    batches = [
+        wait_batch(client, batch_id, poll_interval)
+        for batch_id in state["batch_ids"]
+    ]
+    rows, failed = ingest_batch(client, batches, jobs, on_result, dead_letters)
+    # The batches are spent, a new run submits fresh ones
+    os.remove(state_path)
+    return rows, failed
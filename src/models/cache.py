@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class CacheMiss(KeyError):
+    """Raised in replay mode when a prompt has no cached response."""
+
+
+class ResponseCache:
+    """Persistent, content-addressed cache of LLM responses.
+
+    Responses are stored in SQLite under the SHA-256 of (model, model type,
+    model options, rendered prompt), so a re-run only pays for the prompts
+    that actually changed. When the stored text exceeds `max_bytes` the
+    least recently used entries are evicted, down to `low_water` of the
+    budget so the next puts do not evict again.
+
+    Hits only record their access time in memory. The times are written
+    with the next put, every `touch_batch` hits and on close, so a cache
+    that is not closed only loses some recency, never a response.
+
+    Parameters
+    ----------
+    path : str
+        Location of the SQLite file.
+    max_bytes : int, optional
+        Size budget for the stored responses, None for no limit.
+    replay : bool
+        Read-only mode: nothing is written and misses raise CacheMiss.
+    low_water : float
+        Fraction of max_bytes left after an eviction.
+    touch_batch : int
+        Hits whose access times are written in one transaction.
+
+    """
+
+    def __init__(
+        self,
+        path="data/cache/responses.sqlite",
+        max_bytes=2**31,
+        replay=False,
+        low_water=0.9,
+        touch_batch=256,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.low_water = low_water
+        self.touch_batch = touch_batch
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched = {}
+
+        if replay:
+            self._db = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used "
+                "ON responses (last_used)"
+            )
+            self._db.commit()
+        self._bytes = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key(gpt_model, model_type, options, prompt):
+        """Content address of a query."""
+        payload = json.dumps(
+            [gpt_model, model_type, options, prompt],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for key, or None on a miss."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.replay:
+                    raise CacheMiss(key)
+                return None
+            self.hits += 1
+            if not self.replay:
+                self._touched[key] = time.time()
+                if len(self._touched) >= self.touch_batch:
+                    self._flush_touched()
+                    self._db.commit()
+            return row[0]
+
+    def put(self, key, response):
+        """Store a response, evicting old entries when over budget."""
+        if self.replay:
+            return
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            old = self._db.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self._bytes += size - (old[0] if old else 0)
+            self._touched.pop(key, None)
+            self._flush_touched()
+            if self.max_bytes is not None and self._bytes > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _flush_touched(self):
+        """Write the access times of the hits since the last flush."""
+        if self._touched:
+            self._db.executemany(
+                "UPDATE responses SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def _evict(self):
+        # Walks the last_used index only as far as needed
+        target = self.max_bytes * self.low_water
+        evicted = []
+        rows = self._db.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        )
+        for key, size in rows:
+            if self._bytes <= target:
+                break
+            evicted.append((key,))
+            self._bytes -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        """Hit/miss counters and current size of the cache."""
+        with self._lock:
+            entries = self._db.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "entries": entries,
+            "bytes": self._bytes,
+        }
+
+    def close(self):
+        if not self.replay:
+            with self._lock:
+                self._flush_touched()
+                self._db.commit()
+        self._db.close()
@@ -0,0 +1,213 @@
+import pandas as pd
+
+from data.chunking import count_tokens
+from features.parsing import parse_results, prompt_factors
+from models.engine import run_queries
+
+# Level question of cot.yaml gating each detailed prompt
+LEVELS = {
+    "supervisory_factors": "supervisory_factors_detailed",
+    "preconditions_for_unsafe_acts": "preconditions_for_unsafe_acts_detailed",
+    "unsafe_acts": "unsafe_acts_detailed",
+}
+DETAILED_LEVEL = {detailed: level for level, detailed in LEVELS.items()}
+
+SKIPPED = "Not asked, the level question was answered NO."
+
+
+def skipped_answer(strategy, prompt):
+    """Answer stored for a detailed prompt that was not asked: NO to all."""
+    numbers = sorted(prompt_factors(strategy, prompt))
+    return SKIPPED + "\n" + "\n".join(f"{number}. NO" for number in numbers)
+
+
+def closed_levels(results, strategy="cot"):
+    """(document_id, level prompt) pairs clearly answered NO.
+
+    Levels answered YES, unparseable or missing stay open, so an uncertain
+    answer never skips the detailed questions.
+    """
+    levels = results[results["prompt"].isin(LEVELS)]
+    labels, _ = parse_results(levels, strategy)
+    closed = labels[labels["result"] == 0]
+    return set(zip(closed["document_id"], closed["prompt"]))
+
+
+def gate_jobs(jobs, results, strategy="cot"):
+    """Split the detailed jobs into the ones to ask and the ones to skip.
+
+    Parameters
+    ----------
+    jobs : list
+        Detailed jobs.
+    results : pandas.DataFrame
+        Answers to the level prompts, with document_id, prompt and result
+        columns.
+    strategy : str
+        Name of the strategy, selects the factor definitions.
+
+    Returns
+    -------
+    tuple
+        The jobs to ask and the skipped jobs.
+
+    """
+    closed = closed_levels(results, strategy)
+    asked, skipped = [], []
+    for job in jobs:
+        if (job.document_id, DETAILED_LEVEL[job.prompt]) in closed:
+            skipped.append(job)
+        else:
+            asked.append(job)
+    return asked, skipped
+
+
+def cascade_stats(jobs, skipped, gpt_model=None):
+    """Calls and prompt tokens saved against asking every job."""
+    tokens = sum(
+        count_tokens(job.template, gpt_model)
+        + count_tokens(job.context, gpt_model)
+        for job in skipped
+    )
+    return {
+        "calls_full": len(jobs),
+        "calls": len(jobs) - len(skipped),
+        "calls_saved": len(skipped),
+        "calls_saved_share": len(skipped) / len(jobs) if jobs else 0.0,
+        "prompt_tokens_saved": tokens,
+    }
+
+
+def run_cascade(
+    jobs, gpt_model, strategy="cot", on_result=None, answered=None, **options
+):
+    """Ask the level questions first, the detailed ones only where needed.
+
+    The level prompts (and any prompt outside the cascade) are asked for
+    every report. A detailed prompt is then asked only when its level was
+    answered YES or could not be read; otherwise every sub-factor is
+    answered NO without calling the model, and that answer is stored like
+    the others so the consolidation is unchanged.
+
+    Parameters
+    ----------
+    jobs : list
+        Jobs of the cot prompts, as built by build_jobs.
+    gpt_model : str
+        The model to query.
+    strategy : str
+        Name of the strategy, selects the factor definitions.
+    on_result : callable, optional
+        Called with (job, result) for every answer, skipped ones included.
+    answered : pandas.DataFrame, optional
+        Answers stored by an interrupted run (document_id, prompt and
+        result columns). jobs are then the pending ones, and their detailed
+        prompts are gated on the level answers stored before as well.
+    **options
+        Passed on to run_queries (model_type, concurrency, cache, ...).
+
+    Returns
+    -------
+    tuple
+        The [document_id, prompt, result] rows, the sorted document ids of
+        the reports with a failed job, and the cascade_stats.
+
+    """
+    first = [job for job in jobs if job.prompt not in DETAILED_LEVEL]
+    detailed = [job for job in jobs if job.prompt in DETAILED_LEVEL]
+
+    rows, failed = run_queries(
+        first, gpt_model, on_result=on_result, **options
+    )
+    levels = pd.DataFrame(rows, columns=["document_id", "prompt", "result"])
+    if answered is not None:
+        levels = pd.concat([answered, levels], ignore_index=True)
+    asked, skipped = gate_jobs(detailed, levels, strategy)
+
+    detailed_rows, detailed_failed = run_queries(
+        asked, gpt_model, on_result=on_result, **options
+    )
+    for job in skipped:
+        answer = skipped_answer(strategy, job.prompt)
+        if on_result is not None:
+            on_result(job, answer)
+        detailed_rows.append([job.document_id, job.prompt, answer])
+
+    failed = sorted(set(failed) | set(detailed_failed))
+    return (
+        rows + detailed_rows,
+        failed,
+        cascade_stats(jobs, skipped, gpt_model),
+    )
+
+
+def simulate_cascade(results, strategy="cot"):
+    """Apply the cascade to the results of a full fan-out run.
+
+    Parameters
+    ----------
+    results : pandas.DataFrame
+        Answers to every cot prompt, with document_id, prompt and result
+        columns.
+    strategy : str
+        Name of the strategy, selects the factor definitions.
+
+    Returns
+    -------
+    tuple
+        The results the cascade would have stored, and the number of calls
+        it would have saved.
+
+    """
+    closed = closed_levels(results, strategy)
+    gated = [
+        (document_id, DETAILED_LEVEL.get(prompt)) in closed
+        for document_id, prompt in zip(
+            results["document_id"], results["prompt"]
+        )
+    ]
+    simulated = results.copy()
+    simulated.loc[gated, "result"] = [
+        skipped_answer(strategy, prompt)
+        for prompt in results.loc[gated, "prompt"]
+    ]
+    return simulated, sum(gated)
+
+
+def recall_loss(full, cascade, strategy="cot"):
+    """Positives of the full fan-out that the cascade missed, per factor.
+
+    Parameters
+    ----------
+    full : pandas.DataFrame
+        Results of the full fan-out run.
+    cascade : pandas.DataFrame
+        Results of the cascade on the same reports.
+    strategy : str
+        Name of the strategy, selects the factor definitions.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Per sub-factor, and for all of them ("all"), the positives of the
+        full run, the ones the cascade kept and the share of recall lost.
+
+    """
+    detailed = list(DETAILED_LEVEL)
+    full_labels, _ = parse_results(
+        full[full["prompt"].isin(detailed)], strategy
+    )
+    cascade_labels, _ = parse_results(
+        cascade[cascade["prompt"].isin(detailed)], strategy
+    )
+    merged = full_labels.merge(
+        cascade_labels,
+        on=["document_id", "prompt"],
+        suffixes=("_full", "_cascade"),
+    )
+    positives = merged[merged["result_full"] == 1]
+    table = positives.groupby("prompt")["result_cascade"].agg(["count", "sum"])
+    table.loc["all"] = table.sum()
+    table.columns = ["positives", "kept"]
+    table["recall_lost"] = 1 - table["kept"] / table["positives"]
+    return table
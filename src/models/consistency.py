@@ -0,0 +1,195 @@
+import asyncio
+import re
+
+import pandas as pd
+
+from features.parsing import parse_results, prompt_factors
+from models.llm import aget_response
+from models.telemetry import raw_field
+
+# Paragraph of tot.yaml asking for the reasoning of five experts
+_EXPERTS = re.compile(r"^Imagine .*$", re.M)
+
+SHORT_ANSWER = (
+    "Answer every question on its own line with the question number followed "
+    'by YES or NO, e.g. "1. YES".'
+)
+
+
+def short_answer_template(prompt_template):
+    """Ask for the answers only, without the written-out expert reasoning."""
+    if _EXPERTS.search(prompt_template) is None:
+        return prompt_template
+    return _EXPERTS.sub(SHORT_ANSWER, prompt_template, count=1)
+
+
+def _choice_text(choice):
+    return (
+        raw_field(choice, "message", "content")
+        or raw_field(choice, "text")
+        or ""
+    )
+
+
+async def asample_responses(
+    gpt_model,
+    context,
+    prompt_template,
+    n,
+    model_type="ollama",
+    native_n=None,
+    **options,
+):
+    """Draw n independent answers to a prompt.
+
+    OpenAI returns the n samples of one request (`n`), so the prompt is only
+    processed once. Backends without `n` (Ollama) get n parallel requests,
+    each with its own seed so the samples differ and stay reproducible.
+
+    Parameters
+    ----------
+    gpt_model : str
+        The model to query.
+    context : str
+        Cleaned narrative.
+    prompt_template : str
+        Prompt with a {context} placeholder.
+    n : int
+        Number of samples.
+    model_type : str
+        ollama or gpt.
+    native_n : bool, optional
+        Ask for the samples in one request, by default for gpt only.
+    **options
+        Passed on to aget_response (cache, base_url, telemetry, ...).
+
+    Returns
+    -------
+    list
+        The text of the samples.
+
+    """
+    if native_n is None:
+        native_n = model_type == "gpt"
+    if native_n:
+        # The cache keeps a single text per query, not the n choices
+        options = {**options, "cache": None}
+        response = await aget_response(
+            gpt_model,
+            context,
+            prompt_template,
+            model_type=model_type,
+            request_options={"n": n},
+            **options,
+        )
+        choices = raw_field(response.raw, "choices") or []
+        return [_choice_text(choice) for choice in choices] or [response.text]
+
+    # The seed is an option of each request, all of them share one client
+    responses = await asyncio.gather(
+        *(
+            aget_response(
+                gpt_model,
+                context,
+                prompt_template,
+                model_type=model_type,
+                request_options={"seed": seed},
+                **options,
+            )
+            for seed in range(n)
+        )
+    )
+    return [response.text for response in responses]
+
+
+def vote(samples, strategy, prompt):
+    """Majority vote of the samples, per factor.
+
+    Parameters
+    ----------
+    samples : list
+        Answers of the model to the same prompt.
+    strategy : str
+        Name of the strategy, selects the factors of the prompt.
+    prompt : str
+        Name of the prompt.
+
+    Returns
+    -------
+    dict
+        Mapping of factor to (label, share of YES votes, number of votes).
+        A factor is labelled 1 when more than half of the samples that
+        answered it said YES. Factors no sample answered are left out.
+
+    """
+    df = pd.DataFrame(
+        {
+            "document_id": range(len(samples)),
+            "prompt": prompt,
+            "result": samples,
+        }
+    )
+    labels, _ = parse_results(df, strategy)
+    votes = {}
+    for factor, results in labels.groupby("prompt")["result"]:
+        share = float(results.mean())
+        votes[factor] = (int(share > 0.5), share, len(results))
+    return votes
+
+
+def format_votes(votes, strategy, prompt, header="Final answers:"):
+    """Numbered answers of the votes, in the layout of the tot outputs.
+
+    Without header, the lines are the numbered answers alone.
+    """
+    lines = [
+        f"{number}. {'YES' if votes[factor][0] else 'NO'}"
+        for number, factor in sorted(prompt_factors(strategy, prompt).items())
+        if factor in votes
+    ]
+    return "\n".join([header, *lines] if header else lines)
+
+
+def self_consistency_query(strategy, n=5, native_n=None):
+    """Query for run_queries voting over n short answers per job.
+
+    Replaces the single long generation of tot.yaml, where the model writes
+    out the reasoning of five experts, with n samples of the answers only
+    that are majority-voted per factor. The result keeps the "Final
+    answers" layout, so the tot consolidation reads it unchanged.
+
+    With parallel requests (Ollama) a job holds one concurrency slot for
+    its n calls, size the concurrency accordingly.
+
+    Parameters
+    ----------
+    strategy : str
+        Name of the strategy, selects the factors of each prompt.
+    n : int
+        Number of samples per job, odd to avoid ties.
+    native_n : bool, optional
+        Ask for the samples in one request, by default for gpt only.
+
+    Returns
+    -------
+    callable
+        Coroutine function usable as the query of run_queries.
+
+    """
+
+    async def query(gpt_model, job, model_type="ollama", **options):
+        samples = await asample_responses(
+            gpt_model,
+            job.context,
+            short_answer_template(job.template),
+            n,
+            model_type=model_type,
+            native_n=native_n,
+            **options,
+        )
+        votes = vote(samples, strategy, job.prompt)
+        if not votes:
+            raise ValueError(f"No answer for report {job.document_id}")
+        return format_votes(votes, strategy, job.prompt)
+
+    return query
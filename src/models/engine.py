@@ -0,0 +1,231 @@
+import asyncio
+from collections import namedtuple
+
+from tqdm import tqdm
+
+from data.preprocess import clean_context
+from models.llm import aget_response
+from models.mapreduce import aquery_chunked
+from models.resilience import get_breaker
+from models.telemetry import call_labels
+
+# Maximum number of requests in flight per backend
+CONCURRENCY = {"ollama": 4, "gpt": 16}
+
+Job = namedtuple(
+    "Job",
+    ["document_id", "prompt", "context", "template", "strategy"],
+    defaults=[None],
+)
+
+
+def build_jobs(contexts, prompts, clean=True, ids=None):
+    """Expand the reports and prompts into one job per (report, prompt) pair.
+
+    Parameters
+    ----------
+    contexts : iterable
+        Raw narratives as returned by read_json or iter_narratives, None for
+        dropped reports.
+    prompts : dict
+        Mapping of prompt name to prompt template.
+    clean : bool
+        Clean the narratives, False when they come from a compiled Corpus.
+    ids : list, optional
+        Document id of each report, e.g. Corpus.stable_ids(). Defaults to
+        the position of the report.
+
+    Returns
+    -------
+    tuple
+        The list of jobs and the document ids that had no usable context.
+
+    """
+    jobs, skipped = [], []
+    for i, context in enumerate(contexts):
+        document_id = ids[i] if ids is not None else i
+        if context is None:
+            skipped.append(document_id)
+            continue
+        if clean:
+            context = clean_context(context)
+        for prompt in prompts:
+            jobs.append(Job(document_id, prompt, context, prompts[prompt]))
+    return jobs, skipped
+
+
+async def query_text(gpt_model, job, **options):
+    """Default query of the engine: the text answer to the job's prompt."""
+    response = await aget_response(
+        gpt_model, job.context, job.template, **options
+    )
+    return response.text
+
+
+def _slots(concurrency):
+    """The slot held by a request in flight and the number of workers."""
+    if isinstance(concurrency, int):
+        return asyncio.Semaphore(concurrency), concurrency
+    # The limiter never lets more than its maximum through
+    return concurrency, concurrency.maximum
+
+
+def _job_query(query, gpt_model, max_context_tokens=None, **options):
+    """Function returning the coroutine that answers a job.
+
+    Narratives longer than max_context_tokens are queried by chunks, see
+    aquery_chunked.
+    """
+
+    def call(job):
+        if max_context_tokens is None:
+            return query(gpt_model, job, **options)
+        return aquery_chunked(
+            query, gpt_model, job, max_context_tokens, **options
+        )
+
+    return call
+
+
+async def _attempt(func, slot, retry=None, breaker=None):
+    """Await func() inside slot, through the retry policy if there is one."""
+    if retry is None:
+        async with slot:
+            return await func()
+    return await retry.call(func, slot, breaker)
+
+
+async def arun_queries(
+    jobs,
+    gpt_model,
+    model_type="ollama",
+    concurrency=None,
+    on_result=None,
+    max_context_tokens=None,
+    query=None,
+    retry=None,
+    dead_letters=None,
+    **options,
+):
+    """Run the jobs concurrently with at most `concurrency` requests in flight.
+
+    Parameters
+    ----------
+    jobs : list
+        Jobs created by build_jobs.
+    gpt_model : str
+        The model to query.
+    model_type : str
+        ollama or gpt.
+    concurrency : int or AdaptiveLimiter, optional
+        Maximum number of requests in flight, defaults to CONCURRENCY. An
+        AdaptiveLimiter adjusts it from the latency and rate limiting seen
+        by the retry policy. A pool of that many workers (the maximum of
+        the limiter) pulls the jobs from a queue.
+    on_result : callable, optional
+        Called with (job, result) as soon as a job finishes, e.g.
+        ResultWriter.write.
+    max_context_tokens : int, optional
+        Token budget of a narrative. Longer narratives are split into chunks
+        that are queried concurrently and whose verdicts are merged, see
+        aquery_chunked. A job holds a single concurrency slot for all of
+        its chunks.
+    query : callable, optional
+        Coroutine function called as query(gpt_model, job, model_type=...,
+        **options) that returns the result of a job, defaults to query_text.
+    retry : RetryPolicy, optional
+        Retries the transient failures of a job (timeouts, 429, 5xx) with
+        backoff, behind the circuit breaker of the backend. Without it a
+        job fails on its first error.
+    dead_letters : DeadLetterQueue, optional
+        Stores the jobs that failed for good, to re-drive them later.
+    **options
+        Passed on to aget_response (base_url, cache, telemetry and client
+        options).
+
+    Returns
+    -------
+    tuple
+        The [document_id, prompt, result] rows in job order and the sorted
+        document ids of the jobs that failed.
+
+    """
+    if concurrency is None:
+        concurrency = CONCURRENCY.get(model_type, 1)
+    if query is None:
+        query = query_text
+    concurrency, n_workers = _slots(concurrency)
+    call = _job_query(
+        query, gpt_model, max_context_tokens, model_type=model_type, **options
+    )
+    breaker = get_breaker(model_type, options.get("base_url"))
+    results = [None] * len(jobs)
+    failed = set()
+
+    # A fixed pool of workers pulls the jobs, instead of one task per job
+    queue = asyncio.Queue()
+    for item in enumerate(jobs):
+        queue.put_nowait(item)
+
+    with tqdm(total=len(jobs)) as progress:
+
+        async def worker():
+            while not queue.empty():
+                index, job = queue.get_nowait()
+                # Label the calls of this job for the telemetry
+                call_labels.set(
+                    {"strategy": job.strategy, "prompt": job.prompt}
+                )
+                try:
+                    text = await _attempt(
+                        lambda: call(job), concurrency, retry, breaker
+                    )
+                    results[index] = text
+                    if on_result is not None:
+                        on_result(job, text)
+                except Exception as e:
+                    failed.add(job.document_id)
+                    if dead_letters is not None:
+                        dead_letters.add(job, e)
+                progress.update()
+
+        await asyncio.gather(
+            *(worker() for _ in range(min(n_workers, len(jobs))))
+        )
+
+    # Keep the rows in job order so the output layout is deterministic
+    rows = [
+        [job.document_id, job.prompt, result]
+        for job, result in zip(jobs, results)
+        if result is not None
+    ]
+    return rows, sorted(failed)
+
+
+def run_queries(
+    jobs,
+    gpt_model,
+    model_type="ollama",
+    concurrency=None,
+    on_result=None,
+    max_context_tokens=None,
+    query=None,
+    retry=None,
+    dead_letters=None,
+    **options,
+):
+    """Blocking wrapper around arun_queries."""
+    return asyncio.run(
+        arun_queries(
+            jobs,
+            gpt_model,
+            model_type,
+            concurrency,
+            on_result,
+            max_context_tokens,
+            query,
+            retry,
+            dead_letters,
+            **options,
+        )
+    )
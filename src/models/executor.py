@@ -0,0 +1,139 @@
+import os
+
+import pandas as pd
+
+from data.preprocess import clean_context
+from data.writers import ResultWriter, read_results
+from models.engine import Job, run_queries
+from models.prompts import load_registry
+
+
+def build_strategy_jobs(contexts, strategies, clean=True):
+    """Clean every report once and expand it into the jobs of all strategies.
+
+    Parameters
+    ----------
+    contexts : list
+        Raw narratives as returned by read_json, None for dropped reports.
+    strategies : dict
+        Mapping of strategy name to its prompts (prompt name to template).
+    clean : bool
+        Clean the narratives, False when they come from a compiled Corpus.
+
+    Returns
+    -------
+    tuple
+        The list of jobs, report-major, and the document ids that had no
+        usable context.
+
+    """
+    jobs, skipped = [], []
+    for i, context in enumerate(contexts):
+        if context is None:
+            skipped.append(i)
+            continue
+        if clean:
+            context = clean_context(context)
+        for strategy, prompts in strategies.items():
+            for prompt in prompts:
+                jobs.append(Job(i, prompt, context, prompts[prompt], strategy))
+    return jobs, skipped
+
+
+def run_strategies(
+    contexts,
+    strategies,
+    gpt_model,
+    model_type="ollama",
+    output_dir="data",
+    clean=True,
+    **options,
+):
+    """Run several prompting strategies in a single pass over the reports.
+
+    The jobs of all the strategies share one work queue, and each result is
+    streamed to the store of its strategy, so a run can be resumed. Once
+    done, the results are split back into the usual per-strategy files
+    (`<strategy>_results.csv` and `<strategy>_reports_to_drop.txt`).
+
+    Parameters
+    ----------
+    contexts : list
+        Raw narratives as returned by read_json.
+    strategies : list
+        Names of the strategies to run, prompt files of the PromptRegistry.
+    gpt_model : str
+        The model to query.
+    model_type : str
+        ollama or gpt.
+    output_dir : str
+        Folder of the result files.
+    clean : bool
+        Clean the narratives, False when they come from a compiled Corpus.
+    **options
+        Passed on to run_queries (concurrency, cache, base_url, ...).
+
+    Returns
+    -------
+    dict
+        The results DataFrame of every strategy.
+
+    """
+    registry = load_registry()
+    prompts = {
+        strategy: registry.templates(strategy) for strategy in strategies
+    }
+
+    jobs, skipped = build_strategy_jobs(contexts, prompts, clean)
+    writers = {
+        strategy: ResultWriter(
+            os.path.join(output_dir, f"{strategy}_results.jsonl")
+        )
+        for strategy in strategies
+    }
+    try:
+        pending = [
+            job
+            for job in jobs
+            if (job.document_id, job.prompt)
+            not in writers[job.strategy].completed
+        ]
+        run_queries(
+            pending,
+            gpt_model,
+            model_type=model_type,
+            on_result=lambda job, result: writers[job.strategy].write(
+                job, result
+            ),
+            **options,
+        )
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    outputs = {}
+    for strategy in strategies:
+        strategy_jobs = [job for job in jobs if job.strategy == strategy]
+        results = read_results(writers[strategy].path, strategy_jobs)
+        output = pd.DataFrame(
+            results, columns=["document_id", "prompt", "result"]
+        )
+        output.to_csv(os.path.join(output_dir, f"{strategy}_results.csv"))
+
+        # Reports with a missing answer
+        answered = {(row[0], row[1]) for row in results}
+        reports_to_drop = sorted(
+            set(skipped)
+            | {
+                job.document_id
+                for job in strategy_jobs
+                if (job.document_id, job.prompt) not in answered
+            }
+        )
+        with open(
+            os.path.join(output_dir, f"{strategy}_reports_to_drop.txt"), "w"
+        ) as outfile:
+            outfile.write("\n".join(map(str, reports_to_drop)))
+
+        outputs[strategy] = output
+    return outputs
@@ -1,32 +1,312 @@
-from llama_index.core import PromptTemplate
+import asyncio
+import json
+import threading
+import time
+from llama_index.core.base.llms.types import CompletionResponse
 from llama_index.llms.ollama import Ollama
 from llama_index.llms.openai import OpenAI
 
+from models.prompts import compile_template
+
+# Replace with the remote host's IP address
+OLLAMA_BASE_URL = "http://10.203.13.225:11434"
+
+# Shared clients, keyed by (model_type, model, base_url, options, event loop)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _build_llm(gpt_model: str, model_type: str, base_url=None, **options):
+    """Create the llama_index client for the requested backend."""
+    if model_type == "ollama":
+        return Ollama(
+            model=gpt_model,  # Or your desired model
+            base_url=base_url or OLLAMA_BASE_URL,
+            **{
+                "request_timeout": 500,
+                "num_thread": 20,
+                "num_gpu": 2,
+                **options,
+            },
+        )
+    return OpenAI(
+        model=gpt_model, api_base=base_url, **{"temperature": 1.0, **options}
+    )
+
+
+def get_client(gpt_model: str, model_type="ollama", base_url=None, **options):
+    """Return a shared client for the backend, creating it on first use.
+
+    llama_index clients keep their HTTP session (and its connection pool)
+    for their whole lifetime, so reusing them avoids a TCP/TLS handshake
+    per query. Async sessions are bound to the event loop they were first
+    used in, hence clients requested from a coroutine are also keyed by the
+    running loop.
+
+    Parameters
+    ----------
+    gpt_model : str
+        The model to query.
+    model_type : str
+        ollama or gpt.
+    base_url : str, optional
+        Server address, defaults to OLLAMA_BASE_URL or the OpenAI API.
+    **options
+        Extra keyword arguments for the llama_index client.
+
+    Returns
+    -------
+    llama_index.core.llms.LLM
+        The shared client.
+
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    key = (
+        model_type,
+        gpt_model,
+        base_url,
+        json.dumps(options, sort_keys=True, default=str),
+        loop,
+    )
+    with _clients_lock:
+        llm = _clients.get(key)
+        if llm is None:
+            # Forget the clients of event loops that are gone
+            for stale in [
+                k for k in _clients if k[-1] is not None and k[-1].is_closed()
+            ]:
+                del _clients[stale]
+            llm = _build_llm(gpt_model, model_type, base_url, **options)
+            _clients[key] = llm
+    return llm
+
+
+def clear_clients():
+    """Drop all the shared clients."""
+    with _clients_lock:
+        _clients.clear()
+
+
+def _render_prompt(context: str, prompt_template: str) -> str:
+    """Fill the {context} placeholder of a prompt template."""
+    return compile_template(prompt_template).render(context)
+
+
+def _request_kwargs(model_type, json_schema=None):
+    """Per-request arguments constraining the output to a JSON schema."""
+    if json_schema is None:
+        return {}
+    if model_type == "ollama":
+        return {"format": json_schema}
+    return {
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "answers",
+                "schema": json_schema,
+                "strict": True,
+            },
+        }
+    }
+
+
+def _with_model_options(llm, options):
+    """Shallow copy of a shared Ollama client sending extra model options.
+
+    The Ollama client of llama_index only sends its own options, so options
+    of one request (e.g. seed) need a copy. The copy shares the HTTP session
+    and the context window already looked up by the shared client.
+    """
+    # The async_client property creates the session on first access, and
+    # get_context_window caches the /api/show lookup: do both on the shared
+    # client so that the copies reuse them instead of making their own
+    llm.async_client
+    llm.get_context_window()
+    return llm.model_copy(
+        update={"additional_kwargs": {**llm.additional_kwargs, **options}}
+    )
+
+
+def _cache_options(options, json_schema=None, request_options=None):
+    """Options identifying a query in the cache."""
+    if json_schema is not None:
+        options = {**options, "json_schema": json_schema}
+    if request_options:
+        options = {**options, "request_options": request_options}
+    return options
+
+
+def _elapsed_ms(start):
+    return 1000 * (time.perf_counter() - start)
+
 
 def get_response(
-    gpt_model: str, context: str, prompt_template: str, model_type="ollama"
+    gpt_model: str,
+    context: str,
+    prompt_template: str,
+    model_type="ollama",
+    base_url=None,
+    cache=None,
+    json_schema=None,
+    telemetry=None,
+    **options,
 ):
     """
     Generate a response to a given question based on the provided document."
+
+    If a ResponseCache is given, byte-identical queries are answered from it.
+    If a JSON schema is given, the output is constrained to it (OpenAI
+    structured outputs, Ollama format). If a Telemetry is given, the
+    latency, tokens and cost of the call are recorded.
     """
+    start = time.perf_counter()
     try:
-        if model_type == "ollama":
-            llm = Ollama(
-                model=gpt_model,  # Or your desired model
-                base_url="http://10.203.13.225:11434",  # Replace with the remote host's IP address
-                request_timeout=500,
-                num_thread=20,
-                num_gpu=2,
-            )
-        else:
-            llm = OpenAI(model=gpt_model, temperature=1.0)
-
         # Create a prompt template for unstructured markdown output
-        prompt_template = PromptTemplate(f"{prompt_template}")
-        prompt = prompt_template.format(context=context)
+        prompt = _render_prompt(context, prompt_template)
+
+        if cache is not None:
+            key = cache.key(
+                gpt_model,
+                model_type,
+                _cache_options(options, json_schema),
+                prompt,
+            )
+            text = cache.get(key)
+            if text is not None:
+                if telemetry is not None:
+                    telemetry.record(
+                        gpt_model, model_type, _elapsed_ms(start), cached=True
+                    )
+                return CompletionResponse(text=text)
 
         # Get the response from the model
-        return llm.complete(prompt=prompt)
+        llm = get_client(gpt_model, model_type, base_url, **options)
+        response = llm.complete(
+            prompt=prompt, **_request_kwargs(model_type, json_schema)
+        )
+        if telemetry is not None:
+            telemetry.record(
+                gpt_model, model_type, _elapsed_ms(start), response
+            )
+
+        if cache is not None:
+            cache.put(key, response.text)
+        return response
     except Exception as e:
+        if telemetry is not None:
+            telemetry.record(
+                gpt_model, model_type, _elapsed_ms(start), ok=False
+            )
         # Handle any errors that may occur during context generation
-        raise RuntimeError(f"Error during context generation: {str(e)}")
+        raise RuntimeError(f"Error during context generation: {str(e)}") from e
+
+
+def _request_client(
+    gpt_model,
+    model_type,
+    base_url=None,
+    json_schema=None,
+    request_options=None,
+    **options,
+):
+    """Shared client of a request and the arguments of its call."""
+    llm = get_client(gpt_model, model_type, base_url, **options)
+    kwargs = _request_kwargs(model_type, json_schema)
+    if model_type == "ollama" and request_options:
+        llm = _with_model_options(llm, request_options)
+    else:
+        kwargs.update(request_options or {})
+    return llm, kwargs
+
+
+async def _acomplete(llm, prompt, start, stream=False, **kwargs):
+    """Completion of a prompt and its time to first token, in ms.
+
+    The time to first token is only measured when the completion is
+    streamed, it is None otherwise. OpenAI only reports the token usage of
+    a stream when asked to, in a last chunk without choices.
+    """
+    if not stream:
+        return await llm.acomplete(prompt=prompt, **kwargs), None
+    if isinstance(llm, OpenAI):
+        kwargs["stream_options"] = {"include_usage": True}
+    ttft_ms = None
+    # The chunks carry the text received so far and the last one the token
+    # usage (done chunk of Ollama, usage chunk of OpenAI), keep the last one
+    async for response in await llm.astream_complete(prompt=prompt, **kwargs):
+        if ttft_ms is None:
+            ttft_ms = _elapsed_ms(start)
+    return response, ttft_ms
+
+
+async def aget_response(
+    gpt_model: str,
+    context: str,
+    prompt_template: str,
+    model_type="ollama",
+    base_url=None,
+    cache=None,
+    json_schema=None,
+    telemetry=None,
+    request_options=None,
+    **options,
+):
+    """
+    Asynchronous counterpart of get_response, used by the query engine to
+    keep several requests in flight at once. With a streaming Telemetry the
+    completion is streamed to measure the time to first token.
+    request_options are extra arguments of this request only: arguments of
+    the call for OpenAI (e.g. n or logprobs), model options for Ollama
+    (e.g. seed). Both reuse the shared client.
+    """
+    start = time.perf_counter()
+    try:
+        prompt = _render_prompt(context, prompt_template)
+
+        if cache is not None:
+            key = cache.key(
+                gpt_model,
+                model_type,
+                _cache_options(options, json_schema, request_options),
+                prompt,
+            )
+            text = cache.get(key)
+            if text is not None:
+                if telemetry is not None:
+                    telemetry.record(
+                        gpt_model, model_type, _elapsed_ms(start), cached=True
+                    )
+                return CompletionResponse(text=text)
+
+        llm, kwargs = _request_client(
+            gpt_model,
+            model_type,
+            base_url,
+            json_schema,
+            request_options,
+            **options,
+        )
+        stream = (
+            telemetry is not None and telemetry.enabled and telemetry.stream
+        )
+        response, ttft_ms = await _acomplete(
+            llm, prompt, start, stream, **kwargs
+        )
+        if telemetry is not None:
+            telemetry.record(
+                gpt_model, model_type, _elapsed_ms(start), response, ttft_ms
+            )
+
+        if cache is not None:
+            cache.put(key, response.text)
+        return response
+    except Exception as e:
+        if telemetry is not None:
+            telemetry.record(
+                gpt_model, model_type, _elapsed_ms(start), ok=False
+            )
+        raise RuntimeError(f"Error during context generation: {str(e)}") from e
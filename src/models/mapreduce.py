@@ -0,0 +1,90 @@
+import asyncio
+import re
+
+from data.chunking import chunk_text
+
+# A line holding only a verdict, optionally numbered ("3. YES"), like the
+# bare answers of features.parsing. Prose starting with "No" is not one.
+_VERDICT = re.compile(r"^[\s*#>-]*(?:(\d+)\.\s*)?(YES|NO)[\s.*]*$")
+
+
+def merge_verdicts(answers):
+    """Combine the answers given on the chunks of one report.
+
+    A factor is a contributing factor of the accident if any chunk of the
+    report says so, hence the verdicts are OR-ed, per question number for
+    numbered answers and per verdict line otherwise (prose lines around
+    the verdicts are not counted). The merged answer keeps the
+    layout of the model output so the consolidation blocks read it as is.
+
+    Parameters
+    ----------
+    answers : list
+        The answers of the model, one per chunk.
+
+    Returns
+    -------
+    str
+        The merged answer.
+
+    """
+    merged, numbered = {}, False
+    for answer in answers:
+        verdicts = filter(None, map(_VERDICT.match, answer.splitlines()))
+        for i, match in enumerate(verdicts):
+            number, label = match.groups()
+            numbered = numbered or number is not None
+            key = int(number) if number is not None else i + 1
+            merged[key] = merged.get(key, False) or label == "YES"
+
+    if not merged:
+        raise ValueError("No YES/NO verdict in the answers of the chunks")
+
+    labels = {key: "YES" if value else "NO" for key, value in merged.items()}
+    if not numbered and len(labels) == 1:
+        return next(iter(labels.values()))
+    if numbered:
+        return "\n".join(f"{key}. {labels[key]}" for key in sorted(labels))
+    return "\n".join(labels[key] for key in sorted(labels))
+
+
+async def aquery_chunked(query, gpt_model, job, max_context_tokens, **options):
+    """Run a query on a report whose narrative may exceed the token budget.
+
+    Narratives that fit in max_context_tokens are queried as is. Longer
+    ones are split at paragraph boundaries (map), the query runs
+    concurrently on a copy of the job per chunk, and the verdicts are
+    merged per factor (reduce) by the `merge` attribute of the query,
+    merge_verdicts for queries answering with YES/NO lines.
+
+    Parameters
+    ----------
+    query : callable
+        Coroutine function called as query(gpt_model, job, **options),
+        e.g. the default query of the engine. Its optional `merge`
+        attribute combines the results of the chunks.
+    gpt_model : str
+        The model to query, also selects the tokenizer.
+    job : Job
+        The job, with its cleaned narrative and prompt template.
+    max_context_tokens : int
+        Token budget of the narrative part of the prompt.
+    **options
+        Passed on to the query (model_type, cache, base_url, ...).
+
+    Returns
+    -------
+    str
+        The answer of the query, merged over the chunks.
+
+    """
+    chunks = chunk_text(job.context, max_context_tokens, gpt_model)
+    if len(chunks) == 1:
+        return await query(gpt_model, job, **options)
+    answers = await asyncio.gather(
+        *(
+            query(gpt_model, job._replace(context=chunk), **options)
+            for chunk in chunks
+        )
+    )
+    return getattr(query, "merge", merge_verdicts)(answers)
@@ -0,0 +1,188 @@
+import glob
+import os
+import re
+from functools import lru_cache
+
+import yaml
+
+from data.chunking import count_tokens
+from features.parsing import prompt_factors, validate_prompts
+
+PROMPT_DIR = "prompts"
+
+# Placeholders the query engine fills, the only ones a template may have
+PLACEHOLDERS = frozenset({"context"})
+
+# What llama_index's formatter treats as a placeholder
+_PLACEHOLDER = re.compile(r"\{([^{}]+)\}")
+
+
+class CompiledTemplate:
+    """A prompt template split around its {context} placeholders.
+
+    Rendering joins the static parts with the narrative, the same text
+    llama_index's PromptTemplate produces without parsing the template on
+    every call.
+
+    Parameters
+    ----------
+    template : str
+        Prompt with a {context} placeholder.
+
+    Raises
+    ------
+    ValueError
+        If the template has no {context} placeholder or any other one.
+
+    """
+
+    __slots__ = ("template", "_parts")
+
+    def __init__(self, template):
+        placeholders = set(_PLACEHOLDER.findall(template))
+        if placeholders != PLACEHOLDERS:
+            raise ValueError(
+                f"Prompt template has placeholders {sorted(placeholders)}, "
+                f"expected {sorted(PLACEHOLDERS)}"
+            )
+        self.template = template
+        self._parts = template.split("{context}")
+
+    def render(self, context):
+        """Fill the {context} placeholders."""
+        return context.join(self._parts)
+
+    @property
+    def static_text(self):
+        """The template without its placeholders, sent with every narrative."""
+        return "".join(self._parts)
+
+
+@lru_cache(maxsize=None)
+def compile_template(template):
+    """Compile a prompt template once, see CompiledTemplate."""
+    return CompiledTemplate(template)
+
+
+class Prompt:
+    """A prompt of a strategy file and what the pipeline needs to know of it.
+
+    Parameters
+    ----------
+    strategy : str
+        Name of the prompt file, without .yaml.
+    name : str
+        Key of the prompt in the file.
+    template : str
+        The prompt template.
+
+    Attributes
+    ----------
+    compiled : CompiledTemplate
+        The template, shared with the query engine.
+    factors : dict
+        Mapping of question number to the factor it asks about.
+
+    """
+
+    def __init__(self, strategy, name, template):
+        self.strategy = strategy
+        self.name = name
+        self.compiled = compile_template(template)
+        self.factors = prompt_factors(strategy, name)
+        self._static_tokens = {}
+
+    @property
+    def template(self):
+        return self.compiled.template
+
+    def render(self, context):
+        return self.compiled.render(context)
+
+    def static_tokens(self, gpt_model=None):
+        """Tokens of the template without the narrative, for a model."""
+        if gpt_model not in self._static_tokens:
+            self._static_tokens[gpt_model] = count_tokens(
+                self.compiled.static_text, gpt_model
+            )
+        return self._static_tokens[gpt_model]
+
+
+class PromptRegistry:
+    """Every prompt of the prompt files, loaded and compiled once.
+
+    Each `<strategy>.yaml` of the folder is read, its templates are checked
+    to have only the {context} placeholder and to ask the questions their
+    factor definitions expect (validate_prompts), and compiled, so the
+    query engine only fills them in.
+
+    Parameters
+    ----------
+    prompt_dir : str
+        Folder of the prompt files.
+
+    """
+
+    def __init__(self, prompt_dir=PROMPT_DIR):
+        self.prompt_dir = prompt_dir
+        self.prompts = {}
+        for path in sorted(glob.glob(os.path.join(prompt_dir, "*.yaml"))):
+            strategy = os.path.splitext(os.path.basename(path))[0]
+            with open(path) as f:
+                templates = yaml.load(f, Loader=yaml.SafeLoader)
+            validate_prompts(strategy, templates)
+            self.prompts[strategy] = {
+                name: Prompt(strategy, name, template)
+                for name, template in templates.items()
+            }
+
+    def __contains__(self, strategy):
+        return strategy in self.prompts
+
+    def __getitem__(self, strategy):
+        return self.prompts[strategy]
+
+    @property
+    def strategies(self):
+        return list(self.prompts)
+
+    def templates(self, strategy):
+        """Mapping of prompt name to template, as in the YAML file."""
+        prompts = self.prompts[strategy]
+        return {name: prompt.template for name, prompt in prompts.items()}
+
+    def metadata(self, gpt_model=None):
+        """One dict per prompt with its questions, factors and static size.
+
+        Parameters
+        ----------
+        gpt_model : str, optional
+            Tokenizer of the static token counts.
+
+        Returns
+        -------
+        list
+            Dicts with strategy, prompt, questions, factors (in question
+            order), static_chars and static_tokens.
+
+        """
+        return [
+            {
+                "strategy": strategy,
+                "prompt": name,
+                "questions": len(prompt.factors),
+                "factors": [
+                    factor for _, factor in sorted(prompt.factors.items())
+                ],
+                "static_chars": len(prompt.compiled.static_text),
+                "static_tokens": prompt.static_tokens(gpt_model),
+            }
+            for strategy, prompts in self.prompts.items()
+            for name, prompt in prompts.items()
+        ]
+
+
+@lru_cache(maxsize=None)
+def load_registry(prompt_dir=PROMPT_DIR):
+    """The PromptRegistry of a folder, loaded on first use."""
+    return PromptRegistry(prompt_dir)
@@ -0,0 +1,402 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+import httpx
+
+# HTTP statuses worth retrying: timeout, conflict, rate limit, server errors
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+class CircuitOpen(RuntimeError):
+    """Raised instead of calling a backend whose circuit is open."""
+
+
+def _chain(exc):
+    """The exception and the ones it was raised from."""
+    seen = []
+    while exc is not None and exc not in seen:
+        seen.append(exc)
+        exc = exc.__cause__ or exc.__context__
+    return seen
+
+
+def _status(exc):
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_rate_limited(exc):
+    """Whether a failed call was rejected with HTTP 429."""
+    return any(_status(e) == 429 for e in _chain(exc))
+
+
+def is_retryable(exc):
+    """Whether a failed call may succeed if tried again.
+
+    Timeouts, connection errors, 408/409/429 and 5xx responses are
+    transient, anything else (bad request, authentication, parsing of the
+    answer) fails the same way every time.
+    """
+    for e in _chain(exc):
+        if isinstance(e, CircuitOpen):
+            return False
+        if isinstance(
+            e, (TimeoutError, ConnectionError, httpx.TransportError)
+        ):
+            return True
+        status = _status(e)
+        if status is not None:
+            return status in RETRYABLE_STATUS or status >= 500
+    return False
+
+
+def _retry_after(exc):
+    """Delay asked by the server in a Retry-After header, in seconds."""
+    for e in _chain(exc):
+        headers = getattr(getattr(e, "response", None), "headers", None)
+        if headers is None:
+            continue
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+class CircuitBreaker:
+    """Stop calling a backend after repeated transient failures.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls fail at once with CircuitOpen. Once `reset_timeout` seconds have
+    passed a single trial call is let through (half-open): its success
+    closes the circuit, its failure opens it again. RetryPolicy waits for
+    the circuit instead of failing its jobs.
+
+    Parameters
+    ----------
+    failure_threshold : int
+        Consecutive failures opening the circuit.
+    reset_timeout : float
+        Seconds before a trial call is allowed.
+
+    """
+
+    def __init__(self, failure_threshold=10, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def check(self):
+        """Raise CircuitOpen unless a call is allowed now."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return
+        raise CircuitOpen("The circuit of the backend is open")
+
+    def retry_in(self):
+        """Seconds before check may let a call through again."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                return remaining
+            # Half-open: poll until the trial call closes or reopens it
+            return min(1.0, self.reset_timeout) if self._trial else 0.0
+
+    async def wait(self):
+        """Wait until a call is allowed, see check."""
+        while True:
+            try:
+                return self.check()
+            except CircuitOpen:
+                await asyncio.sleep(self.retry_in())
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+# One circuit breaker per backend, keyed by (model_type, base_url)
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(model_type, base_url=None):
+    """Return the shared circuit breaker of a backend."""
+    with _breakers_lock:
+        return _breakers.setdefault((model_type, base_url), CircuitBreaker())
+
+
+class AdaptiveLimiter:
+    """Concurrency limit adjusted with AIMD, usable in place of a semaphore.
+
+    Every successful call raises the limit by 1 / limit (about one more
+    slot per round of calls), a rate-limited call or one slower than
+    `latency_target` halves it, at most once per `cooldown` seconds so a
+    burst of 429 counts as one signal.
+
+    Parameters
+    ----------
+    initial : int
+        Starting limit.
+    minimum : int
+        Lowest limit.
+    maximum : int
+        Highest limit.
+    latency_target : float, optional
+        Seconds above which a call counts as congestion.
+    decrease : float
+        Factor applied to the limit on congestion.
+    cooldown : float
+        Minimum seconds between two decreases.
+
+    """
+
+    def __init__(
+        self,
+        initial,
+        minimum=1,
+        maximum=64,
+        latency_target=None,
+        decrease=0.5,
+        cooldown=1.0,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.history = [(time.monotonic(), self.limit)]
+        self._last_decrease = float("-inf")
+        self._condition = None
+
+    async def __aenter__(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.in_flight < int(self.limit)
+            )
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def record(self, latency, throttled=False):
+        """Adjust the limit from the outcome of a call."""
+        now = time.monotonic()
+        congested = throttled or (
+            self.latency_target is not None and latency > self.latency_target
+        )
+        if congested:
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.decrease)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self.history.append((now, self.limit))
+
+
+class RetryPolicy:
+    """Retry transient failures with jittered exponential backoff.
+
+    The n-th retry waits a random time between 0 and
+    min(max_delay, base_delay * 2**n) ("full jitter"), or longer if the
+    server sent a Retry-After header. The concurrency slot is released
+    while waiting. While the circuit of the backend is open the jobs wait
+    for it to let calls through again, which does not use their attempts.
+
+    Parameters
+    ----------
+    max_attempts : int
+        Calls made before giving up.
+    base_delay : float
+        Seconds of the first backoff window.
+    max_delay : float
+        Largest backoff window.
+
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2**attempt)
+        )
+
+    async def call(self, func, slot, breaker=None):
+        """Await func() inside slot, retrying the transient failures.
+
+        Parameters
+        ----------
+        func : callable
+            Returns the coroutine to await, called once per attempt.
+        slot : asyncio.Semaphore or AdaptiveLimiter
+            Held during each attempt; an AdaptiveLimiter is told the latency
+            and whether the call was rate limited.
+        breaker : CircuitBreaker, optional
+            Circuit of the backend.
+
+        """
+        for attempt in range(self.max_attempts):
+            if breaker is not None:
+                await breaker.wait()
+            async with slot:
+                start = time.monotonic()
+                try:
+                    result = await func()
+                except Exception as e:
+                    error = e
+                else:
+                    error = None
+                latency = time.monotonic() - start
+                if isinstance(slot, AdaptiveLimiter):
+                    throttled = error is not None and is_rate_limited(error)
+                    slot.record(latency, throttled)
+
+            if error is None:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+            await asyncio.sleep(self.retry_delay(error, attempt, breaker))
+
+    def retry_delay(self, error, attempt, breaker=None):
+        """Seconds to wait before retrying a failed attempt.
+
+        The error is raised instead when it is not transient or the attempt
+        was the last one. The outcome is recorded on the breaker.
+        """
+        if not is_retryable(error):
+            # The backend answered, the request itself is wrong
+            if breaker is not None:
+                breaker.record_success()
+            raise error
+        if breaker is not None:
+            breaker.record_failure()
+        if attempt == self.max_attempts - 1:
+            raise error
+        return max(self.backoff(attempt), _retry_after(error) or 0)
+
+
+class DeadLetterQueue:
+    """Append-only JSONL store of the jobs that failed for good.
+
+    Each line holds the document id, prompt, strategy and error of a job.
+    The failed jobs can be re-driven later, e.g. once the backend is back.
+
+    Parameters
+    ----------
+    path : str
+        Location of the JSONL file.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def add(self, job, error):
+        """Store a failed job."""
+        row = {
+            "document_id": job.document_id,
+            "prompt": job.prompt,
+            "strategy": job.strategy,
+            "error": f"{type(error).__name__}: {error}",
+            "time": time.time(),
+        }
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row) + "\n")
+
+    def entries(self):
+        """The stored failures."""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def redrive(self, jobs):
+        """The failed jobs, to run them again.
+
+        The entries stay in the queue until discard is called with the jobs
+        whose results were stored, so a crash during the re-run loses none.
+
+        Parameters
+        ----------
+        jobs : list
+            All the jobs of the run, the failed ones are picked from them.
+
+        Returns
+        -------
+        list
+            The failed jobs, in the order of jobs.
+
+        """
+        failed = {
+            (row["document_id"], row["prompt"], row["strategy"])
+            for row in self.entries()
+        }
+        return [
+            job
+            for job in jobs
+            if (job.document_id, job.prompt, job.strategy) in failed
+        ]
+
+    def discard(self, jobs):
+        """Drop every entry of the jobs, e.g. once their results are stored.
+
+        The file is rewritten next to its destination and renamed, so an
+        interrupted call leaves the queue as it was.
+        """
+        done = {(job.document_id, job.prompt, job.strategy) for job in jobs}
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            with open(self.path, encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                for row in rows:
+                    key = (row["document_id"], row["prompt"], row["strategy"])
+                    if key not in done:
+                        f.write(json.dumps(row) + "\n")
+            os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,260 @@
+import math
+from collections import defaultdict
+
+import pandas as pd
+
+from features.parsing import parse_results
+from models.consistency import asample_responses, format_votes, vote
+from models.llm import aget_response
+from models.telemetry import raw_field
+
+# Request asking OpenAI for the probabilities of the answer tokens
+LOGPROBS = {"logprobs": True, "top_logprobs": 5}
+
+# Backends whose client returns the logprobs, the others are sampled
+LOGPROBS_BACKENDS = {"gpt"}
+
+# Options of the first call that also apply to the escalated one
+_SHARED_OPTIONS = ("cache", "telemetry")
+
+
+def _token_label(token):
+    """Upper case text of a logprobs token, empty if it has none."""
+    text = raw_field(token, "token")
+    return text.strip(" .*\n").upper() if text is not None else ""
+
+
+def label_confidences(response):
+    """Probability of every YES/NO answer token of a response.
+
+    Each probability is normalised over YES and NO, using the alternatives
+    listed in top_logprobs, so it reads as the confidence of the verdict.
+
+    Parameters
+    ----------
+    response : llama_index.core.base.llms.types.CompletionResponse
+        Response of a request made with LOGPROBS.
+
+    Returns
+    -------
+    list
+        Confidences in the order of the answers, None if the response has
+        no logprobs.
+
+    """
+    choices = raw_field(response.raw, "choices") or []
+    tokens = raw_field(choices[0], "logprobs", "content") if choices else None
+    if tokens is None:
+        return None
+    confidences = []
+    for token in tokens:
+        label = _token_label(token)
+        if label not in ("YES", "NO"):
+            continue
+        probabilities = {"YES": 0.0, "NO": 0.0}
+        for alternative in raw_field(token, "top_logprobs") or []:
+            name = _token_label(alternative)
+            if name in probabilities:
+                probabilities[name] += math.exp(
+                    raw_field(alternative, "logprob")
+                )
+        if probabilities[label] == 0:
+            probabilities[label] = math.exp(raw_field(token, "logprob"))
+        confidences.append(probabilities[label] / sum(probabilities.values()))
+    return confidences
+
+
+class RoutingStats:
+    """Escalations of a routed run, per prompt."""
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.escalations = defaultdict(lambda: defaultdict(int))
+        self.confidences = defaultdict(list)
+
+    def record(self, prompt, confidence, reason=None):
+        self.calls[prompt] += 1
+        if confidence is not None:
+            self.confidences[prompt].append(confidence)
+        if reason is not None:
+            self.escalations[prompt][reason] += 1
+
+    def summary(self):
+        """Escalation rate and reasons per prompt, and overall ("all")."""
+        rows = []
+        for prompt, calls in self.calls.items():
+            reasons = self.escalations[prompt]
+            confidences = self.confidences[prompt]
+            rows.append(
+                {
+                    "prompt": prompt,
+                    "calls": calls,
+                    "escalated": sum(reasons.values()),
+                    "low_confidence": reasons["low_confidence"],
+                    "unparseable": reasons["unparseable"],
+                    "mean_confidence": (
+                        sum(confidences) / len(confidences)
+                        if confidences
+                        else None
+                    ),
+                }
+            )
+        df = pd.DataFrame(
+            rows,
+            columns=[
+                "prompt",
+                "calls",
+                "escalated",
+                "low_confidence",
+                "unparseable",
+                "mean_confidence",
+            ],
+        ).set_index("prompt")
+        counts = ["calls", "escalated", "low_confidence", "unparseable"]
+        df.loc["all", counts] = df[counts].sum()
+        df = df.astype({column: int for column in counts})
+        df["escalation_rate"] = df["escalated"] / df["calls"]
+        return df
+
+
+def majority_text(samples, votes, strategy, prompt):
+    """The answer of the majority vote in the layout of the model.
+
+    A sample agreeing with the majority on every factor is returned as is,
+    so it reads like the answer of the strong model to the same prompt.
+    Without one, the numbered answers of the votes are returned.
+    """
+    majority = {factor: label for factor, (label, _, _) in votes.items()}
+    df = pd.DataFrame(
+        {
+            "document_id": range(len(samples)),
+            "prompt": prompt,
+            "result": samples,
+        }
+    )
+    labels, _ = parse_results(df, strategy)
+    for i, answers in labels.groupby("document_id"):
+        if dict(zip(answers["prompt"], answers["result"])) == majority:
+            return samples[i]
+    return format_votes(votes, strategy, prompt, header=None)
+
+
+def _parsed(text, strategy, prompt):
+    """Whether every question of the prompt got a YES/NO answer."""
+    df = pd.DataFrame(
+        {"document_id": [0], "prompt": [prompt], "result": [text]}
+    )
+    _, errors = parse_results(df, strategy)
+    return errors.empty
+
+
+def routed_query(
+    strategy,
+    strong_model="gpt-4o-mini",
+    strong_type="gpt",
+    strong_options=None,
+    method="logprobs",
+    threshold=0.8,
+    thresholds=None,
+    n=5,
+    stats=None,
+):
+    """Query for run_queries answering with a cheap model first.
+
+    The model given to run_queries answers every job. Its answer is kept
+    when it can be parsed and its confidence reaches the threshold of the
+    prompt, otherwise the job is asked again to the strong model. The
+    confidence is either the lowest YES/NO token probability of the answer
+    (method "logprobs", OpenAI-compatible backends) or the lowest share of
+    the majority over n samples (method "samples", any backend). The
+    logprobs method falls back to samples on Ollama, whose client returns
+    no logprobs, and on any answer without them.
+
+    Parameters
+    ----------
+    strategy : str
+        Name of the strategy, selects the factors of each prompt.
+    strong_model : str
+        Model answering the escalated jobs.
+    strong_type : str
+        ollama or gpt, backend of the strong model.
+    strong_options : dict, optional
+        Options of the strong model (base_url, api_key, ...). The cache and
+        telemetry of the first model are shared.
+    method : str
+        logprobs or samples.
+    threshold : float
+        Confidence below which a job is escalated.
+    thresholds : dict, optional
+        Threshold per prompt, overriding threshold, to trade cost against
+        accuracy factor by factor.
+    n : int
+        Number of samples of the samples method.
+    stats : RoutingStats, optional
+        Collects the escalations.
+
+    Returns
+    -------
+    callable
+        Coroutine function usable as the query of run_queries.
+
+    """
+    strong_options = strong_options or {}
+    thresholds = thresholds or {}
+
+    async def query(gpt_model, job, model_type="ollama", **options):
+        confidences = None
+        if method == "logprobs" and model_type in LOGPROBS_BACKENDS:
+            # Cached answers have lost their logprobs
+            response = await aget_response(
+                gpt_model,
+                job.context,
+                job.template,
+                model_type=model_type,
+                request_options=LOGPROBS,
+                **{**options, "cache": None},
+            )
+            text = response.text
+            confidences = label_confidences(response)
+        if confidences is None:
+            samples = await asample_responses(
+                gpt_model,
+                job.context,
+                job.template,
+                n,
+                model_type=model_type,
+                **options,
+            )
+            votes = vote(samples, strategy, job.prompt)
+            text = majority_text(samples, votes, strategy, job.prompt)
+            confidences = [
+                max(share, 1 - share) for _, share, _ in votes.values()
+            ]
+
+        confidence = min(confidences) if confidences else None
+        if not _parsed(text, strategy, job.prompt):
+            reason = "unparseable"
+        elif confidence is None or confidence < thresholds.get(
+            job.prompt, threshold
+        ):
+            reason = "low_confidence"
+        else:
+            reason = None
+        if stats is not None:
+            stats.record(job.prompt, confidence, reason)
+        if reason is None:
+            return text
+
+        shared = {
+            key: options[key] for key in _SHARED_OPTIONS if key in options
+        }
+        response = await aget_response(
+            strong_model,
+            job.context,
+            job.template,
+            model_type=strong_type,
+            **{**shared, **strong_options},
+        )
+        return response.text
+
+    return query
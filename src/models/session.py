@@ -0,0 +1,242 @@
+import asyncio
+import os
+import re
+import time
+from functools import lru_cache
+from itertools import groupby
+
+from tqdm import tqdm
+
+from models.engine import CONCURRENCY
+from models.llm import aget_response
+from models.telemetry import call_labels, raw_field
+
+# Reports in flight per backend. An Ollama server keeps one KV cache per
+# parallel slot (OLLAMA_NUM_PARALLEL, 1 by default), so more sessions than
+# slots evict each other's narrative and nothing is reused.
+SESSION_CONCURRENCY = {"ollama": 1, "gpt": CONCURRENCY["gpt"]}
+
+# Label introducing the narrative in the prompt files
+_CONTEXT_HEADER = re.compile(r"Context:\s*$", re.IGNORECASE)
+_BELOW = re.compile(r"\bcontext below\b")
+
+
+@lru_cache(maxsize=None)
+def context_first(prompt_template):
+    """Move the narrative of a prompt template in front of the question.
+
+    The prompt files ask the question before `{context}`, so two prompts for
+    the same report share no prefix and nothing can be reused from the KV
+    cache of the model (Ollama) or the prompt cache of the provider
+    (OpenAI). With the narrative first, every prompt of a report starts
+    with the same tokens and only the question is processed again.
+
+    Parameters
+    ----------
+    prompt_template : str
+        Prompt with a {context} placeholder.
+
+    Returns
+    -------
+    str
+        The prompt starting with "Context:" and the narrative.
+
+    """
+    if "{context}" not in prompt_template:
+        raise ValueError("The prompt template has no {context} placeholder")
+    before, after = prompt_template.split("{context}", 1)
+    before = _CONTEXT_HEADER.sub("", before.rstrip()).strip()
+    before = _BELOW.sub("context above", before)
+    question = "\n\n".join(part for part in (before, after.strip()) if part)
+    return f"Context:\n{{context}}\n\n{question}\n"
+
+
+def prompt_eval_stats(response, wall_ms=None):
+    """Prompt processing statistics of a llama_index response.
+
+    Parameters
+    ----------
+    response : CompletionResponse
+        Response of get_response or aget_response.
+    wall_ms : float, optional
+        Measured duration of the call.
+
+    Returns
+    -------
+    dict
+        prompt_tokens, cached_tokens (OpenAI prefix cache) and
+        prompt_eval_ms (Ollama), None when the backend does not report it.
+
+    """
+    raw = response.raw
+    prompt_tokens = raw_field(raw, "prompt_eval_count")
+    if prompt_tokens is None:
+        prompt_tokens = raw_field(raw, "usage", "prompt_tokens")
+    duration = raw_field(raw, "prompt_eval_duration")
+    return {
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": raw_field(
+            raw, "usage", "prompt_tokens_details", "cached_tokens"
+        ),
+        "prompt_eval_ms": duration / 1e6 if duration is not None else None,
+        "wall_ms": wall_ms,
+    }
+
+
+async def arun_sessions(
+    jobs,
+    gpt_model,
+    model_type="ollama",
+    concurrency=None,
+    on_result=None,
+    **options,
+):
+    """Run the jobs one report at a time with context-first prompts.
+
+    The prompts of a report are sent back to back on the same worker, so
+    the narrative stays in the KV cache of the Ollama server (or the prompt
+    cache of the provider) and only the question suffix is evaluated for
+    every prompt but the first. Reports run concurrently on OpenAI, one at
+    a time on Ollama unless the server has more parallel slots.
+
+    Parameters
+    ----------
+    jobs : list
+        Jobs created by build_jobs, grouped by report.
+    gpt_model : str
+        The model to query.
+    model_type : str
+        ollama or gpt.
+    concurrency : int, optional
+        Number of reports processed at once, defaults to
+        SESSION_CONCURRENCY. On Ollama it may not exceed the
+        OLLAMA_NUM_PARALLEL of the server, read from the environment.
+    on_result : callable, optional
+        Called with (job, result) as soon as a job finishes.
+    **options
+        Passed on to aget_response (cache, base_url and client options).
+
+    Returns
+    -------
+    tuple
+        The [document_id, prompt, result] rows in job order, the sorted
+        document ids of the failed reports and one prompt_eval_stats dict
+        (with document_id and prompt) per call.
+
+    Raises
+    ------
+    ValueError
+        If more Ollama sessions than OLLAMA_NUM_PARALLEL are requested.
+
+    """
+    if concurrency is None:
+        concurrency = SESSION_CONCURRENCY.get(model_type, 1)
+    slots = int(os.environ.get("OLLAMA_NUM_PARALLEL", 1))
+    if model_type == "ollama" and concurrency > slots:
+        raise ValueError(
+            f"{concurrency} concurrent sessions evict each other's KV cache "
+            f"on an Ollama server with OLLAMA_NUM_PARALLEL={slots}, set it "
+            "on the server and in this environment to at least the "
+            "concurrency"
+        )
+    semaphore = asyncio.Semaphore(concurrency)
+    results = {}
+    failed = set()
+    stats = []
+
+    with tqdm(total=len(jobs)) as progress:
+
+        async def session(document_jobs):
+            async with semaphore:
+                for job in document_jobs:
+                    call_labels.set(
+                        {"strategy": job.strategy, "prompt": job.prompt}
+                    )
+                    try:
+                        start = time.perf_counter()
+                        response = await aget_response(
+                            gpt_model,
+                            job.context,
+                            context_first(job.template),
+                            model_type=model_type,
+                            **options,
+                        )
+                        wall_ms = 1000 * (time.perf_counter() - start)
+                        results[job] = response.text
+                        stats.append(
+                            {
+                                "document_id": job.document_id,
+                                "prompt": job.prompt,
+                                **prompt_eval_stats(response, wall_ms),
+                            }
+                        )
+                        if on_result is not None:
+                            on_result(job, response.text)
+                    except Exception:
+                        failed.add(job.document_id)
+                    progress.update()
+
+        await asyncio.gather(
+            *(
+                session(list(document_jobs))
+                for _, document_jobs in groupby(
+                    jobs, key=lambda job: job.document_id
+                )
+            )
+        )
+
+    rows = [
+        [job.document_id, job.prompt, results[job]]
+        for job in jobs
+        if job in results
+    ]
+    return rows, sorted(failed), stats
+
+
+def run_sessions(
+    jobs,
+    gpt_model,
+    model_type="ollama",
+    concurrency=None,
+    on_result=None,
+    **options,
+):
+    """Blocking wrapper around arun_sessions."""
+    return asyncio.run(
+        arun_sessions(
+            jobs, gpt_model, model_type, concurrency, on_result, **options
+        )
+    )
+
+
+def summarize_prompt_stats(stats):
+    """Mean prompt processing cost of the first and follow-up calls.
+
+    The first call of a report pays for the narrative, the follow-up calls
+    should only pay for their question; the gap is the saving of the
+    session mode.
+    """
+    first, follow_up, seen = [], [], set()
+    for row in stats:
+        (follow_up if row["document_id"] in seen else first).append(row)
+        seen.add(row["document_id"])
+
+    def mean(rows, name):
+        values = [row[name] for row in rows if row[name] is not None]
+        return sum(values) / len(values) if values else None
+
+    return {
+        group: {
+            "calls": len(rows),
+            **{
+                f"mean_{name}": mean(rows, name)
+                for name in (
+                    "prompt_tokens",
+                    "cached_tokens",
+                    "prompt_eval_ms",
+                    "wall_ms",
+                )
+            },
+        }
+        for group, rows in (("first", first), ("follow_up", follow_up))
+    }
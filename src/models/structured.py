@@ -0,0 +1,245 @@
+import json
+import re
+from functools import lru_cache
+
+import pandas as pd
+
+from features.parsing import prompt_factors
+from models.llm import aget_response
+
+
+def factor_schema(factors):
+    """JSON schema of an object with one boolean per factor."""
+    return {
+        "type": "object",
+        "properties": {factor: {"type": "boolean"} for factor in factors},
+        "required": list(factors),
+        "additionalProperties": False,
+    }
+
+
+def _questions(strategy, prompt):
+    """Factor of each question of a prompt, the first question wins."""
+    questions = {}
+    for number, factor in sorted(prompt_factors(strategy, prompt).items()):
+        questions.setdefault(factor, number)
+    return questions
+
+
+# Parts of the merged prompt files
+_QUESTION = re.compile(r"(?<![\w.])(\d+)\.\s+([^?]*\?)")
+_DEFINITION = re.compile(r"Definition for Question (\d+):\s*([^\n]*)")
+# Sentences asking for plain YES/NO lines, replaced by the JSON instruction
+_ANSWER_FORMAT = re.compile(
+    r"\s*(The output must be YES or NO\.|I want \d+ answers\.)"
+)
+
+
+def _json_instruction(questions):
+    """Instruction telling the model which key answers which question."""
+    keys = "\n".join(
+        f"- {factor}: answer to question {number}"
+        for factor, number in questions.items()
+    )
+    return (
+        "Give the answers as a JSON object with the keys below, true for "
+        f"YES and false for NO:\n{keys}"
+    )
+
+
+@lru_cache(maxsize=None)
+def _structured_template(prompt_template, questions):
+    intro, rest = prompt_template.split("Question:", 1)
+    body, _ = rest.rsplit("Context:", 1)
+    texts = dict(_QUESTION.findall(body))
+    definitions = dict(_DEFINITION.findall(body))
+    asked = []
+    for _, number in questions:
+        asked.append(f"{number}. {texts[str(number)]}")
+        if str(number) in definitions:
+            asked.append(
+                f"Definition for Question {number}: {definitions[str(number)]}"
+            )
+    return "\n\n".join(
+        [
+            _ANSWER_FORMAT.sub("", intro).strip(),
+            "Questions:\n" + "\n".join(asked),
+            _json_instruction(dict(questions)),
+            "Context:\n{context}\n",
+        ]
+    )
+
+
+def structured_template(prompt_template, questions):
+    """A multi-question prompt asking only some questions, in JSON.
+
+    The questions (and their definitions) are taken from the prompt, the
+    sentences asking for YES/NO lines are replaced by the keys of the JSON
+    object, so the follow-up of a few missing factors does not send the
+    whole prompt again.
+
+    Parameters
+    ----------
+    prompt_template : str
+        Multi-question prompt with "Question:" and "Context:" sections and
+        a {context} placeholder.
+    questions : dict
+        Mapping of factor to question number, the questions to ask.
+
+    Returns
+    -------
+    str
+        The prompt template.
+
+    """
+    return _structured_template(prompt_template, tuple(questions.items()))
+
+
+def parse_json_answer(text, factors):
+    """Read the {factor: bool} answers of a JSON output.
+
+    Parameters
+    ----------
+    text : str
+        Output of the model.
+    factors : list
+        Expected keys.
+
+    Returns
+    -------
+    dict
+        The factors answered with a boolean, invalid or missing keys are
+        left out.
+
+    """
+    try:
+        answers = json.loads(text)
+    except ValueError:
+        return {}
+    if not isinstance(answers, dict):
+        return {}
+    return {
+        factor: answers[factor]
+        for factor in factors
+        if isinstance(answers.get(factor), bool)
+    }
+
+
+async def aget_structured_response(
+    gpt_model, context, prompt_template, questions, max_followups=1, **options
+):
+    """Ask a multi-question prompt with a JSON output, one boolean per factor.
+
+    The output is constrained to a JSON schema. If some factors are still
+    missing or not booleans, a follow-up call asks only their questions,
+    with a schema restricted to those factors (see structured_template), so
+    a bad answer does not cost the whole call.
+
+    Parameters
+    ----------
+    gpt_model : str
+        The model to query.
+    context : str
+        Cleaned narrative.
+    prompt_template : str
+        Prompt with a {context} placeholder.
+    questions : dict
+        Mapping of factor to question number in the prompt.
+    max_followups : int
+        Number of follow-up calls for the missing factors.
+    **options
+        Passed on to aget_response (model_type, cache, base_url, ...).
+
+    Returns
+    -------
+    dict
+        The {factor: bool} answers, missing factors are left out.
+
+    """
+    answers = {}
+    missing = dict(questions)
+    for _ in range(max_followups + 1):
+        response = await aget_response(
+            gpt_model,
+            context,
+            structured_template(prompt_template, missing),
+            json_schema=factor_schema(missing),
+            **options,
+        )
+        answers.update(parse_json_answer(response.text, missing))
+        missing = {
+            factor: number
+            for factor, number in missing.items()
+            if factor not in answers
+        }
+        if not missing:
+            break
+    return answers
+
+
+def merge_json_answers(answers):
+    """OR the JSON answers given on the chunks of one report, per factor."""
+    merged = {}
+    for answer in answers:
+        for factor, value in json.loads(answer).items():
+            merged[factor] = merged.get(factor, False) or value
+    return json.dumps(merged)
+
+
+def structured_query(strategy, max_followups=1):
+    """Query for run_queries returning the JSON answers of a job.
+
+    Parameters
+    ----------
+    strategy : str
+        Name of the strategy, selects the factors of each prompt.
+    max_followups : int
+        Number of follow-up calls for the missing factors.
+
+    Returns
+    -------
+    callable
+        Coroutine function usable as the query of run_queries, the result
+        is the JSON-encoded {factor: bool} dict. Chunked reports are merged
+        with merge_json_answers.
+
+    """
+
+    async def query(gpt_model, job, **options):
+        answers = await aget_structured_response(
+            gpt_model,
+            job.context,
+            job.template,
+            _questions(strategy, job.prompt),
+            max_followups,
+            **options,
+        )
+        if not answers:
+            raise ValueError(f"No answer for report {job.document_id}")
+        return json.dumps(answers)
+
+    query.merge = merge_json_answers
+    return query
+
+
+def structured_labels(df):
+    """Long labels of results stored by a structured query.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Results with document_id and result (JSON) columns.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per answered factor with document_id, prompt (the factor)
+        and result (1 or 0) columns.
+
+    """
+    rows = [
+        (document_id, factor, int(value))
+        for document_id, result in zip(df["document_id"], df["result"])
+        for factor, value in json.loads(result).items()
+    ]
+    return pd.DataFrame(rows, columns=["document_id", "prompt", "result"])
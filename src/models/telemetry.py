@@ -0,0 +1,322 @@
+import contextvars
+import json
+import math
+import os
+import signal
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+# US dollars per million (prompt, completion) tokens, local models are free
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+# Labels of the job a call belongs to, set by the query engine
+call_labels = contextvars.ContextVar("call_labels", default={})
+
+CallRecord = namedtuple(
+    "CallRecord",
+    [
+        "strategy",
+        "model",
+        "prompt",
+        "backend",
+        "wall_ms",
+        "ttft_ms",
+        "prompt_tokens",
+        "completion_tokens",
+        "cost",
+        "cached",
+        "ok",
+    ],
+)
+
+
+def raw_field(raw, *names):
+    """Follow attribute or key names in a raw response, None if missing."""
+    for name in names:
+        if raw is None:
+            return None
+        raw = (
+            raw.get(name)
+            if isinstance(raw, dict)
+            else getattr(raw, name, None)
+        )
+    return raw
+
+
+def token_usage(response):
+    """Prompt and completion tokens reported by the backend, or None."""
+    raw = getattr(response, "raw", None)
+    prompt_tokens = raw_field(raw, "prompt_eval_count")
+    completion_tokens = raw_field(raw, "eval_count")
+    if prompt_tokens is None:
+        prompt_tokens = raw_field(raw, "usage", "prompt_tokens")
+        completion_tokens = raw_field(raw, "usage", "completion_tokens")
+    return prompt_tokens, completion_tokens
+
+
+def cost(gpt_model, prompt_tokens, completion_tokens):
+    """Price of a call in US dollars, 0 for models without a price."""
+    prompt_price, completion_price = PRICES.get(gpt_model, (0, 0))
+    return (
+        (prompt_tokens or 0) * prompt_price
+        + (completion_tokens or 0) * completion_price
+    ) / 1e6
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    index = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+class Telemetry:
+    """Collect latency, token and cost figures of every LLM call.
+
+    Pass it to run_queries (or get_response) as `telemetry`; the query
+    engine labels each call with the strategy and prompt of its job.
+    Recording and the hooks can be switched on and off while a run is
+    going, e.g. with install_signal_toggle.
+
+    Parameters
+    ----------
+    enabled : bool
+        Record the calls.
+    stream : bool
+        Stream the completions to measure the time to first token. Without
+        it the time to first token is only known for Ollama (model load and
+        prompt evaluation time).
+
+    """
+
+    def __init__(self, enabled=True, stream=False):
+        self.enabled = enabled
+        self.stream = stream
+        self.records = []
+        self.hooks = []
+        self.hooks_enabled = True
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Call hook(record) after every recorded call."""
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(
+        self,
+        gpt_model,
+        model_type,
+        wall_ms,
+        response=None,
+        ttft_ms=None,
+        cached=False,
+        ok=True,
+    ):
+        """Record a call, labelled with the current call_labels."""
+        if not self.enabled:
+            return None
+        prompt_tokens, completion_tokens = token_usage(response)
+        if ttft_ms is None:
+            raw = getattr(response, "raw", None)
+            durations = [
+                raw_field(raw, "load_duration"),
+                raw_field(raw, "prompt_eval_duration"),
+            ]
+            if all(duration is not None for duration in durations):
+                ttft_ms = sum(durations) / 1e6
+        labels = call_labels.get()
+        record = CallRecord(
+            strategy=labels.get("strategy"),
+            model=gpt_model,
+            prompt=labels.get("prompt"),
+            backend=model_type,
+            wall_ms=wall_ms,
+            ttft_ms=ttft_ms,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cost=(
+                0.0
+                if cached
+                else cost(gpt_model, prompt_tokens, completion_tokens)
+            ),
+            cached=cached,
+            ok=ok,
+        )
+        with self._lock:
+            self.records.append(record)
+        if self.hooks_enabled:
+            for hook in list(self.hooks):
+                hook(record)
+        return record
+
+    def summary(self, by=("strategy", "model", "prompt")):
+        """Aggregate the calls per group of labels.
+
+        Parameters
+        ----------
+        by : tuple
+            CallRecord fields to group by.
+
+        Returns
+        -------
+        list
+            One dict per group with the labels, call and error counts,
+            latency percentiles and histogram, token totals and cost.
+
+        """
+        with self._lock:
+            records = list(self.records)
+        groups = defaultdict(list)
+        for record in records:
+            groups[tuple(getattr(record, name) for name in by)].append(record)
+
+        rows = []
+        for key, group in groups.items():
+            wall = [record.wall_ms for record in group]
+            ttft = [
+                record.ttft_ms
+                for record in group
+                if record.ttft_ms is not None
+            ]
+            rows.append(
+                {
+                    **dict(zip(by, key)),
+                    "calls": len(group),
+                    "errors": sum(not record.ok for record in group),
+                    "cached": sum(record.cached for record in group),
+                    "wall_ms_sum": sum(wall),
+                    "wall_ms_p50": _percentile(wall, 50),
+                    "wall_ms_p99": _percentile(wall, 99),
+                    "ttft_ms_p50": _percentile(ttft, 50) if ttft else None,
+                    "wall_ms_buckets": [
+                        sum(value <= bound for value in wall)
+                        for bound in LATENCY_BUCKETS
+                    ],
+                    "prompt_tokens": sum(r.prompt_tokens or 0 for r in group),
+                    "completion_tokens": sum(
+                        r.completion_tokens or 0 for r in group
+                    ),
+                    "cost": sum(record.cost for record in group),
+                }
+            )
+        return rows
+
+    def to_json(self, path, by=("strategy", "model", "prompt")):
+        """Write the summary and the bucket bounds to a JSON report."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "generated_at": time.time(),
+                    "latency_buckets_ms": LATENCY_BUCKETS,
+                    "groups": self.summary(by),
+                },
+                f,
+                indent=2,
+            )
+
+    def to_prometheus(self, path, prefix="hfacs_llm"):
+        """Write the metrics in the Prometheus textfile collector format.
+
+        The file is written next to its destination and renamed, so the
+        node exporter never reads a partial file.
+        """
+        by = ("strategy", "model", "prompt", "backend")
+        metric = f"{prefix}_call_latency_seconds"
+        lines = [
+            f"# HELP {metric} Wall latency of the LLM calls.",
+            f"# TYPE {metric} histogram",
+        ]
+        counters = {
+            "prompt_tokens": "Prompt tokens sent.",
+            "completion_tokens": "Completion tokens received.",
+            "cost": "Cost of the calls in US dollars.",
+            "errors": "Failed calls.",
+        }
+        groups = self.summary(by)
+        # Prometheus expects base units, the buckets are given in seconds
+        for row in groups:
+            labels = _prometheus_labels(row, by)
+            for bound, count in zip(LATENCY_BUCKETS, row["wall_ms_buckets"]):
+                le = f"{bound / 1000:g}"
+                lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {count}')
+            lines.append(
+                f'{metric}_bucket{{{labels},le="+Inf"}} {row["calls"]}'
+            )
+            lines.append(
+                f"{metric}_sum{{{labels}}} {row['wall_ms_sum'] / 1000}"
+            )
+            lines.append(f"{metric}_count{{{labels}}} {row['calls']}")
+        for name, help_text in counters.items():
+            lines.append(f"# HELP {prefix}_{name}_total {help_text}")
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for row in groups:
+                labels = _prometheus_labels(row, by)
+                lines.append(f"{prefix}_{name}_total{{{labels}}} {row[name]}")
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+def _label_value(value):
+    """A label value escaped for the Prometheus text format."""
+    if value is None:
+        return ""
+    value = str(value).replace("\\", "\\\\")
+    return value.replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prometheus_labels(row, names):
+    return ",".join(f'{name}="{_label_value(row[name])}"' for name in names)
+
+
+def slow_call_logger(threshold_ms, log=print):
+    """Hook logging the calls slower than threshold_ms."""
+
+    def hook(record):
+        if record.wall_ms > threshold_ms:
+            log(
+                f"slow call {record.wall_ms:.0f} ms: "
+                f"{record.backend}/{record.model} "
+                f"{record.strategy}/{record.prompt}"
+            )
+
+    return hook
+
+
+def install_signal_toggle(telemetry, signum=None):
+    """Switch the hooks of a Telemetry on and off when signum is received.
+
+    Lets a long production run be profiled on demand with
+    `kill -USR1 <pid>`, without restarting it. signum defaults to SIGUSR1,
+    which Windows does not have: nothing is installed there.
+
+    Returns
+    -------
+    bool
+        Whether the handler was installed.
+
+    """
+    if signum is None:
+        signum = getattr(signal, "SIGUSR1", None)
+        if signum is None:
+            return False
+
+    def toggle(*_):
+        telemetry.hooks_enabled = not telemetry.hooks_enabled
+
+    signal.signal(signum, toggle)
+    return True
@@ -0,0 +1,250 @@
+import json
+import os
+
+import pytest
+
+from data.corpus import compile_corpus, is_fresh, load_corpus
+from data.dedup import calls_avoided, fan_out, find_duplicates
+from data.preprocess import clean_context, clean_contexts, parallel_map
+from data.readers import iter_json, iter_narratives
+from data.retrieval import (
+    PassageIndex,
+    load_index,
+    question,
+    retrieval_jobs,
+    split_passages,
+)
+from data.writers import ResultWriter, narrative_hash, read_results
+from models.engine import Job
+
+
+def _jobs(contexts, prompts=("a", "b"), template="Q {context}"):
+    return [
+        Job(document_id, prompt, context, template)
+        for document_id, context in enumerate(contexts)
+        for prompt in prompts
+    ]
+
+
+def _write_export(path, narratives):
+    records = [
+        {
+            "NtsbNumber": f"ERA{i}",
+            "Oid": str(i),
+            "EventDate": "2020-01-01",
+            "FactualNarrative": narrative,
+        }
+        for i, narrative in enumerate(narratives)
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(records, f)
+
+
+NARRATIVE = (
+    "HISTORY OF FLIGHT&#x0D;\n"
+    "The pilot departed for a local flight in the helicopter.&#x0D;\n"
+    "&#x0D;\n"
+    "<p>During the landing the helicopter rolled over &lt;500 ft from the "
+    "pad.</p>&#x0D;\n"
+)
+
+
+class _Corpus(list):
+    def __init__(self, path, narratives):
+        super().__init__(narratives)
+        self.path = path
+        with open(path + ".json", "w") as f:
+            f.write("{}")
+
+
+def test_result_writer_resumes_after_a_crash(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    jobs = _jobs(["one", "two"])
+    with ResultWriter(path, sync_every=1) as writer:
+        writer.write(jobs[2], "YES")
+        writer.write(jobs[0], "NO")
+    with open(path, "ab") as f:
+        f.write(b'{"document_id": 1, "prom')
+
+    with ResultWriter(path) as writer:
+        assert writer.pending(jobs) == [jobs[1], jobs[3]]
+        writer.write(jobs[1], "YES")
+    assert read_results(path, jobs) == [
+        [0, "a", "NO"],
+        [0, "b", "YES"],
+        [1, "a", "YES"],
+    ]
+
+
+def test_iter_json_streams_the_records(tmp_path):
+    path = tmp_path / "data.json"
+    _write_export(path, ["a" * 100, None, "b"])
+    records = list(iter_json(path, fields=["Oid", "Missing"], chunk_size=16))
+    assert records == [
+        {"Oid": "0", "Missing": None},
+        {"Oid": "1", "Missing": None},
+        {"Oid": "2", "Missing": None},
+    ]
+    assert list(iter_narratives(path, max_length=10)) == [None, None, "b"]
+
+    path.write_text('{"not": "an array"}')
+    with pytest.raises(ValueError, match="JSON array"):
+        list(iter_json(path))
+    path.write_text('[{"Oid": "0"}, ')
+    with pytest.raises(ValueError, match="closing bracket"):
+        list(iter_json(path, chunk_size=4))
+
+
+def test_compiled_corpus(tmp_path):
+    data_path = str(tmp_path / "data.json")
+    corpus_path = str(tmp_path / "cache" / "corpus")
+    _write_export(data_path, [NARRATIVE, None, "x" * 30, "Second report."])
+
+    with compile_corpus(
+        data_path, corpus_path, max_length=20, processes=1
+    ) as corpus:
+        assert len(corpus) == 4
+        assert list(corpus) == [None, None, None, "Second report."]
+    with compile_corpus(data_path, corpus_path, processes=1) as corpus:
+        assert corpus[0] == clean_context(NARRATIVE)
+        assert corpus[1] is None
+
+    assert is_fresh(data_path, corpus_path)
+    assert not is_fresh(data_path, corpus_path, max_length=20)
+    _write_export(data_path, ["Only report."])
+    assert not is_fresh(data_path, corpus_path)
+    with load_corpus(data_path, corpus_path, processes=1) as corpus:
+        assert list(corpus) == ["Only report."]
+
+
+def test_question_leaves_out_the_instructions():
+    template = (
+        "Use the report below. The output must be YES or NO.\n"
+        "Question: Was fatigue a factor? Fatigue is tiredness.\n"
+        "Context: {context}\n"
+    )
+    assert question(template) == (
+        "Was fatigue a factor? Fatigue is tiredness."
+    )
+    assert question("Was fatigue a factor? {context}") == (
+        "Was fatigue a factor?"
+    )
+
+
+def test_split_passages_joins_headings_and_cuts_long_lines():
+    narrative = "HISTORY\n" + "The pilot flew. " * 10 + "\nWeather was fine."
+    spans = split_passages(narrative, max_words=10, min_words=3)
+    passages = [narrative[start:end] for start, end in spans]
+    assert passages[0].startswith("HISTORY\nThe pilot flew.")
+    assert all(len(passage.split()) <= 10 for passage in passages[1:])
+    assert passages[-1].endswith("Weather was fine.")
+
+
+def test_passage_index_and_retrieval(tmp_path):
+    narratives = [
+        "The engine lost power during cruise flight over the lake.\n"
+        "The pilot was tired after a long duty day without rest.\n"
+        "The weather was clear and the wind calm at the airport.\n"
+        "The helicopter was destroyed by the impact with the water.",
+        None,
+    ]
+    corpus = _Corpus(str(tmp_path / "corpus"), narratives)
+    index = load_index(corpus)
+    spans = index.search(0, "Was the pilot tired or fatigued?", k=1)
+    assert [narratives[0][start:end] for start, end in spans] == [
+        "The pilot was tired after a long duty day without rest."
+    ]
+    assert index.search(1, "tired") == []
+
+    template = "Question: Was the pilot tired?\nContext: {context}"
+    job = Job(0, "fatigue", narratives[0], template)
+    [retrieved] = retrieval_jobs([job], index, k=1)
+    assert retrieved.context == (
+        "The pilot was tired after a long duty day without rest."
+    )
+
+
+def test_load_index_rebuilds_when_the_options_change(tmp_path):
+    corpus = _Corpus(str(tmp_path / "corpus"), ["One passage here."] * 2)
+    index_path = corpus.path + ".bm25.npz"
+    load_index(corpus)
+    built = os.path.getmtime(index_path)
+    assert load_index(corpus).options == PassageIndex().options
+    assert os.path.getmtime(index_path) == built
+    assert load_index(corpus, max_words=50).options["max_words"] == 50
+    assert PassageIndex.load(index_path).options["max_words"] == 50
+
+
+def test_duplicates_are_queried_once():
+    base = " ".join(f"word{i}" for i in range(200))
+    contexts = [base, None, base + " extra", "something else entirely " * 5]
+    duplicates = find_duplicates(contexts, ["k0", "k1", "k2", "k3"])
+    representative = dict(
+        zip(duplicates["document_id"], duplicates["representative"])
+    )
+    assert representative == {0: 2, 2: 2, 3: 3}
+
+    jobs = _jobs(contexts, prompts=["a"])
+    assert calls_avoided(jobs, duplicates)["avoided"] == 2
+    rows = fan_out([[2, "a", "YES"], [3, "a", "NO"]], duplicates)
+    assert sorted(rows) == [[0, "a", "YES"], [2, "a", "YES"], [3, "a", "NO"]]
+
+
+def test_corpus_stable_ids_and_hashes(tmp_path):
+    data_path = str(tmp_path / "data.json")
+    _write_export(data_path, [NARRATIVE, None, "Second report."])
+    with compile_corpus(
+        data_path, str(tmp_path / "corpus"), processes=1
+    ) as corpus:
+        assert corpus.stable_ids() == ["ERA0:0", "ERA1:1", "ERA2:2"]
+        assert corpus.hashes[2] == narrative_hash("Second report.")
+        assert corpus.hashes[1] is None
+
+
+def test_result_writer_changes(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    jobs = _jobs(["one", "two", "three"], prompts=["a"])
+    with ResultWriter(path) as writer:
+        for job in jobs[:3]:
+            writer.write(job, "NO")
+
+    current = [
+        jobs[0],
+        jobs[1]._replace(context="two, revised"),
+        Job(3, "a", "four", "Q {context}"),
+    ]
+    digests = {job.document_id: narrative_hash(job.context) for job in current}
+    with ResultWriter(path) as writer:
+        changes = writer.changes(current, digests)
+        assert changes["new"] == [current[2]]
+        assert changes["changed"] == [current[1]]
+        assert changes["unchanged"] == [current[0]]
+        assert changes["removed"] == [(2, "a")]
+        assert writer.outdated(current) == [current[2], current[1]]
+        # Another template is another question
+        other = [jobs[0]._replace(template="R {context}")]
+        assert writer.outdated(other) == other
+
+
+def test_clean_context_decodes_markup_and_drops_empty_lines():
+    assert clean_context(NARRATIVE) == (
+        "HISTORY OF FLIGHT\n"
+        "The pilot departed for a local flight in the helicopter.\n"
+        "During the landing the helicopter rolled over <500 ft from the "
+        "pad."
+    )
+    assert clean_context("non&#x1E;stop opt&#x1F;ional") == (
+        "non-stop optional"
+    )
+    assert clean_context("  a table\n \n  | 1 | 2 |  \n") == (
+        "a table\n  | 1 | 2 |"
+    )
+
+
+def test_parallel_map_keeps_the_order():
+    items = [NARRATIVE * (i % 3) or None for i in range(50)]
+    expected = [
+        None if item is None else clean_context(item) for item in items
+    ]
+    assert list(clean_contexts(items, processes=2, chunksize=4)) == expected
+    assert list(parallel_map(abs, [-1, 2, -3], processes=1)) == [1, 2, 3]
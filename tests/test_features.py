@@ -0,0 +1,161 @@
+import pytest
+
+import numpy as np
+import pandas as pd
+from features.metrics import (
+    compare_counts,
+    compare_labels,
+    label_matrix,
+    multilabel_metrics,
+)
+from features.parsing import (
+    parse_results,
+    question_numbers,
+    requery_jobs,
+    validate_prompts,
+)
+from models.engine import Job
+
+
+def _results(rows):
+    return pd.DataFrame(rows, columns=["document_id", "prompt", "result"])
+
+
+def _labels(labels):
+    return {
+        (row.document_id, row.prompt): row.result
+        for row in labels.itertuples()
+    }
+
+
+def test_label_matrix_normalises_answers():
+    df = _results(
+        [
+            [0, "a", "Yes."],
+            [0, "b", " no"],
+            [1, "a", 1],
+            [1, "b", "maybe"],
+        ]
+    )
+    matrix = label_matrix(df, ["a", "b", "c"], documents=[0, 1, 2])
+    expected = np.array(
+        [[1, 0, np.nan], [1, np.nan, np.nan], [np.nan] * 3], dtype=float
+    )
+    np.testing.assert_array_equal(matrix, expected)
+
+
+def test_multilabel_metrics_counts_every_report():
+    predicted = np.array([[1, 0], [1, 1], [0, np.nan]])
+    actual = np.array([[1, 0], [0, 1], [1, 1]])
+    metrics = multilabel_metrics(predicted, actual)
+    np.testing.assert_array_equal(metrics["TP"], [1, 1])
+    np.testing.assert_array_equal(metrics["FP"], [1, 0])
+    np.testing.assert_array_equal(metrics["FN"], [1, 0])
+    np.testing.assert_array_equal(metrics["TN"], [0, 1])
+    np.testing.assert_allclose(metrics["f1_score"], [0.5, 1.0])
+    assert metrics["micro_f1"] == pytest.approx(2 / 3)
+
+    # Leading axes are computed in the same pass
+    stacked = multilabel_metrics(np.stack([predicted, actual]), actual)
+    np.testing.assert_allclose(stacked["macro_f1"], [0.75, 1.0])
+
+
+def test_compare_labels_uses_the_manual_reports():
+    manual = _results([[0, "a", 1], [1, "a", 0], [2, "a", 1]])
+    labels = _results([[0, "a", "YES"], [1, "a", "YES"], [5, "a", "YES"]])
+    frame = compare_labels(labels, manual, factors=["a"])
+    assert frame.loc["a", ["TP", "FP", "FN"]].tolist() == [1, 1, 0]
+
+
+def test_compare_counts_uses_the_totals_per_factor():
+    labels = _results([[0, "a", "YES"], [1, "a", "yes."], [0, "b", "NO"]])
+    manual = pd.DataFrame({"prompt": ["b", "a", "c"], "result": [3, 1, 2]})
+    frame = compare_counts(labels, manual, factors=["a", "b"])
+    assert frame["prompt"].tolist() == ["a", "b"]
+    assert frame[["result_x", "result_y"]].values.tolist() == [[2, 1], [0, 3]]
+    np.testing.assert_allclose(frame["precision"], [0.5, 0.0])
+    np.testing.assert_allclose(frame["f1_score"], [2 / 3, 0.0])
+
+
+def test_parse_single_question_answers():
+    df = _results(
+        [
+            [0, "decision_error", "YES"],
+            [1, "decision_error", "no."],
+            [2, "decision_error", "**NO**"],
+        ]
+    )
+    labels, errors = parse_results(df, "io")
+    assert _labels(labels) == {
+        (0, "decision_error"): 1,
+        (1, "decision_error"): 0,
+        (2, "decision_error"): 0,
+    }
+    assert errors.empty
+
+
+def test_parse_matches_numbered_answers_by_number():
+    # Question 13 of io_merged does not exist, 3 is missing
+    answers = "\n".join(
+        f"{number}. {'YES' if number % 2 else 'NO'}"
+        for number in [16, 1, 2, 13, 4, 5, 6, 7, 8, 9, 10, 11, 12, 14, 15]
+    )
+    labels, errors = parse_results(
+        _results([[0, "merged_queries", answers]]), "io_merged"
+    )
+    labels = _labels(labels)
+    assert labels[(0, "inadequate_supervision")] == 1
+    assert labels[(0, "planned_inappropriate_operations")] == 0
+    assert labels[(0, "exceptional_violation")] == 0
+    assert (0, "failure_to_correct_known_problems") not in labels
+    assert set(errors["kind"]) == {"unexpected_question", "missing_answer"}
+    missing = errors[errors["kind"] == "missing_answer"]
+    assert list(missing["detail"]) == ["failure_to_correct_known_problems"]
+
+
+def test_parse_reads_the_final_answers_of_reasoning():
+    answer = (
+        "1. The pilot decided to continue. YES, this is a decision.\n"
+        "Final answers:\n1. NO\n2. YES\n3. NO\n4. NO\n5. YES"
+    )
+    labels, errors = parse_results(
+        _results([[0, "unsafe_acts_detailed", answer]]), "cot"
+    )
+    labels = _labels(labels)
+    assert labels[(0, "decision_error")] == 0
+    assert labels[(0, "skill_based_errors")] == 1
+    assert labels[(0, "exceptional_violation")] == 1
+    assert errors.empty
+
+
+def test_parse_reports_bad_answers():
+    df = _results(
+        [
+            [0, "unsafe_acts_detailed", "YES\nNO"],
+            [1, "decision_error", "I cannot tell."],
+            [2, "decision_error", None],
+        ]
+    )
+    labels, errors = parse_results(df, "cot")
+    assert labels.empty
+    assert list(zip(errors["document_id"], errors["kind"])) == [
+        (0, "count_mismatch"),
+        (1, "unparseable"),
+        (2, "unparseable"),
+    ]
+    jobs = [Job(i, "decision_error", "", "{context}") for i in range(4)]
+    assert [job.document_id for job in requery_jobs(errors, jobs)] == [1, 2]
+
+
+def test_parse_empty_results():
+    labels, errors = parse_results(_results([]), "io")
+    assert labels.empty and errors.empty
+
+
+def test_question_numbers_and_validation():
+    template = "1. Is it? 2. Is it?\nQuestion 3: Is it?\nContext: {context}"
+    assert question_numbers(template) == [1, 2, 3]
+    assert question_numbers("Is it?\nContext: {context}") == []
+    validate_prompts("io", {"decision_error": "Is it? {context}"})
+    with pytest.raises(ValueError, match="asks questions"):
+        validate_prompts("cot", {"unsafe_acts_detailed": template})
@@ -0,0 +1,863 @@
+import asyncio
+import json
+import math
+import os
+import random
+import signal
+
+import httpx
+import pytest
+from click.testing import CliRunner
+
+import data.chunking
+import models.cascade
+import models.prompts
+import pandas as pd
+from benchmarks.batch import check_batch_roundtrip
+from benchmarks.stub_server import MODELS, StubServer
+from cli import cli
+from llama_index.core.base.llms.types import CompletionResponse
+from models.batch import build_batch_files
+from models.cache import CacheMiss, ResponseCache
+from models.cascade import (
+    gate_jobs,
+    recall_loss,
+    run_cascade,
+    simulate_cascade,
+    skipped_answer,
+)
+from models.consistency import asample_responses, format_votes, vote
+from models.engine import Job, build_jobs, run_queries
+from models.executor import build_strategy_jobs, run_strategies
+from models.llm import clear_clients, get_client
+from models.mapreduce import merge_verdicts
+from models.prompts import CompiledTemplate, PromptRegistry, compile_template
+from models.resilience import (
+    CircuitBreaker,
+    CircuitOpen,
+    DeadLetterQueue,
+    RetryPolicy,
+    is_retryable,
+)
+from models.routing import RoutingStats, label_confidences, routed_query
+from models.session import (
+    context_first,
+    prompt_eval_stats,
+    run_sessions,
+    summarize_prompt_stats,
+)
+from models.structured import (
+    merge_json_answers,
+    parse_json_answer,
+    structured_template,
+)
+from models.telemetry import (
+    Telemetry,
+    call_labels,
+    cost,
+    install_signal_toggle,
+    slow_call_logger,
+)
+
+TEMPLATE = "Answer YES or NO.\nQuestion: Is it?\nContext: {context}"
+
+
+def _jobs(n, prompts=("a",)):
+    return [
+        Job(i, prompt, f"Narrative {i}.", TEMPLATE, "io")
+        for i in range(n)
+        for prompt in prompts
+    ]
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def word_tokens(monkeypatch):
+    """Count words instead of tiktoken tokens, tiktoken needs a download."""
+    monkeypatch.setattr(
+        data.chunking,
+        "count_tokens",
+        lambda text, model=None: len(text.split()),
+    )
+
+
+def _status_error(status):
+    request = httpx.Request("POST", "http://backend")
+    response = httpx.Response(status, request=request)
+    return httpx.HTTPStatusError("failed", request=request, response=response)
+
+
+DETAILED = "supervisory_factors_detailed"
+
+
+def _results(rows):
+    return pd.DataFrame(rows, columns=["document_id", "prompt", "result"])
+
+
+def test_build_jobs_cleans_and_skips_reports():
+    jobs, skipped = build_jobs(
+        ["First&#x0D;\n\nreport", None], {"a": "{context}", "b": "{context}"}
+    )
+    assert skipped == [1]
+    assert [(job.document_id, job.prompt) for job in jobs] == [
+        (0, "a"),
+        (0, "b"),
+    ]
+    assert jobs[0].context == "First\nreport"
+
+
+def test_run_queries_keeps_the_job_order_and_limit():
+    in_flight, peak, seen = 0, 0, []
+
+    async def query(gpt_model, job, **options):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(random.Random(job.document_id).random() / 100)
+        in_flight -= 1
+        if job.document_id == 3:
+            raise RuntimeError("failed")
+        return f"answer {job.document_id}"
+
+    jobs = _jobs(10)
+    rows, failed = run_queries(
+        jobs,
+        "model",
+        concurrency=3,
+        query=query,
+        on_result=lambda job, result: seen.append(job.document_id),
+    )
+    assert peak == 3
+    assert failed == [3]
+    assert rows == [[i, "a", f"answer {i}"] for i in range(10) if i != 3]
+    assert sorted(seen) == [i for i in range(10) if i != 3]
+
+
+def test_run_queries_uses_a_pool_of_workers():
+    tasks = set()
+
+    async def query(gpt_model, job, **options):
+        tasks.add(asyncio.current_task())
+        await asyncio.sleep(0)
+        return "YES"
+
+    rows, _ = run_queries(_jobs(20), "model", concurrency=4, query=query)
+    assert len(rows) == 20 and len(tasks) == 4
+    assert run_queries([], "model", query=query) == ([], [])
+
+
+def test_clients_are_shared_per_options():
+    clear_clients()
+    client = get_client("model", base_url="http://backend")
+    assert get_client("model", base_url="http://backend") is client
+    assert get_client("model", base_url="http://other") is not client
+    assert get_client("model", base_url="http://backend", seed=1) is not client
+    clear_clients()
+    assert get_client("model", base_url="http://backend") is not client
+
+
+def test_cache_roundtrip_and_replay(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache(path)
+    key = cache.key("model", "gpt", {}, "prompt")
+    assert key != cache.key("model", "gpt", {"seed": 1}, "prompt")
+    assert cache.get(key) is None
+    cache.put(key, "YES")
+    assert cache.get(key) == "YES"
+    cache.close()
+
+    replay = ResponseCache(path, replay=True)
+    assert replay.get(key) == "YES"
+    with pytest.raises(CacheMiss):
+        replay.get("unknown")
+    assert replay.stats()["hits"] == 1 and replay.stats()["misses"] == 1
+    replay.close()
+
+
+def test_cache_evicts_the_least_recently_used(tmp_path):
+    cache = ResponseCache(
+        str(tmp_path / "responses.sqlite"), max_bytes=100, low_water=0.5
+    )
+    for i in range(9):
+        cache.put(str(i), "x" * 10)
+    # Recently read entries are kept
+    assert cache.get("0") is not None
+    cache.put("9", "x" * 10)
+    cache.put("10", "x" * 10)
+    assert cache.stats()["bytes"] <= 50
+    assert cache.get("0") is not None
+    assert cache.get("1") is None
+    assert cache.get("10") is not None
+    cache.close()
+
+
+def test_build_strategy_jobs_is_report_major():
+    strategies = {"s1": {"a": "{context}"}, "s2": {"b": "{context}"}}
+    jobs, skipped = build_strategy_jobs(["One&#x0D;", None, "Two"], strategies)
+    assert skipped == [1]
+    assert [(job.document_id, job.strategy, job.prompt) for job in jobs] == [
+        (0, "s1", "a"),
+        (0, "s2", "b"),
+        (2, "s1", "a"),
+        (2, "s2", "b"),
+    ]
+    assert jobs[0].context == "One"
+
+
+def test_run_strategies_writes_and_resumes(tmp_path, monkeypatch):
+    # The prompt files are read relative to the root of the repository
+    monkeypatch.chdir(ROOT)
+    contexts = ["First report.", None, "Second report."]
+    with StubServer(answer="NO") as server:
+        outputs = run_strategies(
+            contexts,
+            ["io", "io_merged"],
+            MODELS["ollama"],
+            output_dir=str(tmp_path),
+            base_url=server.url,
+        )
+        server.reset_counters()
+        again = run_strategies(
+            contexts,
+            ["io", "io_merged"],
+            MODELS["ollama"],
+            output_dir=str(tmp_path),
+            base_url=server.url,
+        )
+        assert server.requests == 0
+
+    assert len(outputs["io"]) == 2 * 17 and len(outputs["io_merged"]) == 2
+    pd.testing.assert_frame_equal(outputs["io"], again["io"])
+    saved = pd.read_csv(tmp_path / "io_merged_results.csv", index_col=0)
+    assert saved.values.tolist() == [
+        [0, "merged_queries", "NO"],
+        [2, "merged_queries", "NO"],
+    ]
+    assert (tmp_path / "io_reports_to_drop.txt").read_text() == "1"
+
+
+def test_run_queries_merges_the_chunks(word_tokens):
+    async def query(gpt_model, job, **options):
+        return "YES" if "fire" in job.context else "NO"
+
+    job = Job(0, "a", "The flight was normal.\nThe engine caught fire.", "")
+    rows, _ = run_queries([job], "model", query=query, max_context_tokens=5)
+    assert rows == [[0, "a", "YES"]]
+
+
+def test_merge_verdicts():
+    assert merge_verdicts(["NO", "Looking at it.\nYES"]) == "YES"
+    assert (
+        merge_verdicts(["1. NO\n2. YES", "1. YES\n2. NO"]) == "1. YES\n2. YES"
+    )
+    assert merge_verdicts(["NO\nNO", "NO\nYES"]) == "NO\nYES"
+    # Prose starting with yes or no is not a verdict
+    assert (
+        merge_verdicts(["No anomalies were found with the engine.\nYES"])
+        == "YES"
+    )
+    assert merge_verdicts(["Yes, there was weather.\nNO", "NO"]) == "NO"
+    assert merge_verdicts(["**3. YES**", "3. NO."]) == "3. YES"
+    with pytest.raises(ValueError):
+        merge_verdicts(["I cannot tell."])
+
+
+def test_context_first_moves_the_narrative_first():
+    template = (
+        "Use the context below to answer YES or NO.\n"
+        "Question: Was it?\nContext: {context}\n"
+    )
+    assert context_first(template) == (
+        "Context:\n{context}\n\n"
+        "Use the context above to answer YES or NO.\nQuestion: Was it?\n"
+    )
+    with pytest.raises(ValueError, match="placeholder"):
+        context_first("Was it?")
+
+
+def test_prompt_eval_stats_of_both_backends():
+    ollama = CompletionResponse(
+        text="NO", raw={"prompt_eval_count": 12, "prompt_eval_duration": 3e6}
+    )
+    assert prompt_eval_stats(ollama, 5.0) == {
+        "prompt_tokens": 12,
+        "cached_tokens": None,
+        "prompt_eval_ms": 3.0,
+        "wall_ms": 5.0,
+    }
+    usage = {
+        "prompt_tokens": 40,
+        "prompt_tokens_details": {"cached_tokens": 32},
+    }
+    gpt = CompletionResponse(text="NO", raw={"usage": usage})
+    stats = prompt_eval_stats(gpt)
+    assert stats["prompt_tokens"] == 40 and stats["cached_tokens"] == 32
+
+
+def test_sessions_need_ollama_parallel_slots(monkeypatch):
+    jobs = _jobs(3, prompts=("a", "b"))
+    monkeypatch.delenv("OLLAMA_NUM_PARALLEL", raising=False)
+    with pytest.raises(ValueError, match="OLLAMA_NUM_PARALLEL=1"):
+        run_sessions(jobs, MODELS["ollama"], concurrency=2)
+
+    monkeypatch.setenv("OLLAMA_NUM_PARALLEL", "2")
+    with StubServer(answer="YES") as server:
+        rows, failed, stats = run_sessions(
+            jobs, MODELS["ollama"], concurrency=2, base_url=server.url
+        )
+    assert rows == [[job.document_id, job.prompt, "YES"] for job in jobs]
+    assert not failed
+    summary = summarize_prompt_stats(stats)
+    assert summary["first"]["calls"] == 3
+    assert summary["follow_up"]["calls"] == 3
+    assert summary["first"]["mean_prompt_tokens"] > 0
+
+
+def test_batch_files_are_split(tmp_path):
+    paths = build_batch_files(
+        _jobs(7), "gpt-4o-mini", str(tmp_path / "batch.jsonl"), max_requests=3
+    )
+    assert [path.rsplit("-", 1)[1] for path in paths] == [
+        "0.jsonl",
+        "1.jsonl",
+        "2.jsonl",
+    ]
+    with open(paths[0]) as f:
+        line = json.loads(f.readline())
+    assert json.loads(line["custom_id"]) == [0, "a", "io"]
+
+
+def test_batch_roundtrip_reads_the_error_file():
+    assert check_batch_roundtrip(n_jobs=10) == {
+        "jobs": 10,
+        "rows": 10,
+        "failed": 0,
+        "dead_letters": 0,
+        "consistent": True,
+    }
+    result = check_batch_roundtrip(n_jobs=20, error_rate=0.3)
+    assert result["dead_letters"] > 0
+    assert result["rows"] + result["dead_letters"] == 20
+
+
+def test_structured_template_asks_the_missing_questions():
+    template = (
+        "Use the report below. I want 3 answers. The output must be YES or "
+        "NO.\nQuestion:\n1. Is it A?\n2. Is it B?\n3. Is it C?\n"
+        "Definition for Question 2: B is bad.\nContext: {context}"
+    )
+    followup = structured_template(template, {"b": 2, "c": 3})
+    assert "Is it A?" not in followup
+    assert "2. Is it B?\n" in followup
+    assert "Definition for Question 2: B is bad." in followup
+    assert "YES or NO" not in followup and "3 answers" not in followup
+    assert followup.endswith("Context:\n{context}\n")
+
+
+def test_parse_and_merge_json_answers():
+    assert parse_json_answer('{"a": true, "b": "yes"}', ["a", "b"]) == {
+        "a": True
+    }
+    assert parse_json_answer("not json", ["a"]) == {}
+    merged = merge_json_answers(['{"a": false, "b": true}', '{"a": true}'])
+    assert json.loads(merged) == {"a": True, "b": True}
+
+
+def test_is_retryable():
+    assert is_retryable(_status_error(429))
+    assert is_retryable(_status_error(503))
+    assert not is_retryable(_status_error(400))
+    assert not is_retryable(ValueError("bad answer"))
+    wrapped = RuntimeError("Error during context generation")
+    wrapped.__cause__ = httpx.ConnectError("refused")
+    assert is_retryable(wrapped)
+
+
+def test_circuit_breaker_opens_and_lets_a_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+    asyncio.run(breaker.wait())
+    # The trial call is let through, the others wait for its outcome
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_retry_policy_retries_transient_failures():
+    policy = RetryPolicy(max_attempts=3, base_delay=0.001)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _status_error(503)
+        return "YES"
+
+    async def bad_request():
+        calls.append(1)
+        raise _status_error(400)
+
+    async def run(func):
+        return await policy.call(func, asyncio.Semaphore(1), breaker)
+
+    assert asyncio.run(run(flaky)) == "YES"
+    assert len(calls) == 3
+    calls.clear()
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(run(bad_request))
+    assert len(calls) == 1
+
+
+def test_retry_delay_raises_the_final_errors():
+    policy = RetryPolicy(max_attempts=2, base_delay=0.5)
+    assert 0 <= policy.retry_delay(_status_error(503), 0) <= 0.5
+    with pytest.raises(httpx.HTTPStatusError):
+        policy.retry_delay(_status_error(503), 1)
+    with pytest.raises(httpx.HTTPStatusError):
+        policy.retry_delay(_status_error(400), 0)
+
+
+def test_dead_letters_are_redriven(tmp_path):
+    queue = DeadLetterQueue(str(tmp_path / "dead_letters.jsonl"))
+    jobs = _jobs(3)
+    queue.add(jobs[1], RuntimeError("timeout"))
+    assert queue.entries()[0]["error"] == "RuntimeError: timeout"
+    queue.add(jobs[2], RuntimeError("timeout"))
+    assert queue.redrive(jobs) == [jobs[1], jobs[2]]
+    # Kept until the re-run stored a result
+    assert len(queue.entries()) == 2
+    queue.discard([jobs[1]])
+    assert [row["document_id"] for row in queue.entries()] == [2]
+
+
+def test_cost_uses_the_price_table():
+    assert cost("gpt-4o-mini", 1_000_000, 1_000_000) == pytest.approx(0.75)
+    assert cost("gpt-4o", 1000, None) == pytest.approx(0.0025)
+    assert cost("qwen2.5:32b-instruct", 1000, 1000) == 0
+
+
+def test_telemetry_writes_prometheus_metrics(tmp_path):
+    telemetry = Telemetry()
+    token = call_labels.set({"strategy": "io", "prompt": 'say "hi"'})
+    try:
+        usage = {"prompt_tokens": 1000, "completion_tokens": 10}
+        response = CompletionResponse(text="NO", raw={"usage": usage})
+        telemetry.record("gpt-4o-mini", "gpt", 120.0, response)
+        telemetry.record("gpt-4o-mini", "gpt", 80.0, cached=True)
+        ollama = CompletionResponse(
+            text="NO",
+            raw={"load_duration": 1e6, "prompt_eval_duration": 2e6},
+        )
+        record = telemetry.record("qwen", "ollama", 50.0, ollama)
+    finally:
+        call_labels.reset(token)
+    assert record.ttft_ms == 3.0
+
+    path = str(tmp_path / "metrics" / "llm.prom")
+    telemetry.to_prometheus(path)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    labels = (
+        'strategy="io",model="gpt-4o-mini",prompt="say \\"hi\\"",backend="gpt"'
+    )
+    metric = "hfacs_llm_call_latency_seconds"
+    assert f'{metric}_bucket{{{labels},le="0.1"}} 1' in lines
+    assert f'{metric}_bucket{{{labels},le="0.25"}} 2' in lines
+    assert f'{metric}_bucket{{{labels},le="+Inf"}} 2' in lines
+    assert f"{metric}_sum{{{labels}}} 0.2" in lines
+    assert f"hfacs_llm_prompt_tokens_total{{{labels}}} 1000" in lines
+    [cost_line] = [
+        line
+        for line in lines
+        if line.startswith(f"hfacs_llm_cost_total{{{labels}}}")
+    ]
+    assert float(cost_line.split()[-1]) == pytest.approx(0.000156)
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_slow_calls_are_logged_until_toggled():
+    telemetry = Telemetry()
+    logged = []
+    telemetry.add_hook(slow_call_logger(100, log=logged.append))
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        assert install_signal_toggle(telemetry)
+        telemetry.record("qwen", "ollama", 50.0)
+        telemetry.record("qwen", "ollama", 150.0)
+        assert len(logged) == 1 and "150 ms" in logged[0]
+        os.kill(os.getpid(), signal.SIGUSR1)
+        telemetry.record("qwen", "ollama", 150.0)
+        assert len(logged) == 1 and not telemetry.hooks_enabled
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+
+def test_run_queries_against_both_backends():
+    with StubServer(answer="YES") as server:
+        rows, failed = run_queries(
+            _jobs(4), MODELS["ollama"], base_url=server.url
+        )
+        assert rows == [[i, "a", "YES"] for i in range(4)] and not failed
+        rows, failed = run_queries(
+            _jobs(4),
+            MODELS["gpt"],
+            model_type="gpt",
+            base_url=server.url + "/v1",
+            api_key="stub",
+        )
+        assert rows == [[i, "a", "YES"] for i in range(4)] and not failed
+
+
+def test_streamed_calls_record_ttft_tokens_and_cost():
+    telemetry = Telemetry(stream=True)
+    with StubServer(answer="YES, it is", latency=0.05) as server:
+        rows, failed = run_queries(
+            _jobs(2),
+            MODELS["gpt"],
+            model_type="gpt",
+            base_url=server.url + "/v1",
+            api_key="stub",
+            telemetry=telemetry,
+        )
+        assert rows == [[i, "a", "YES, it is"] for i in range(2)]
+        rows, failed = run_queries(
+            _jobs(2),
+            MODELS["ollama"],
+            base_url=server.url,
+            telemetry=telemetry,
+        )
+        assert rows == [[i, "a", "YES, it is"] for i in range(2)]
+    assert len(telemetry.records) == 4
+    for record in telemetry.records:
+        assert record.ok and 50 <= record.ttft_ms <= record.wall_ms
+        assert record.prompt_tokens > 0 and record.completion_tokens == 2
+    gpt = [record for record in telemetry.records if record.backend == "gpt"]
+    assert all(record.cost > 0 for record in gpt)
+
+
+def test_vote_takes_the_majority_per_factor():
+    samples = ["YES", "no", "YES", "I cannot tell."]
+    assert vote(samples, "io", "decision_error") == {
+        "decision_error": (1, 2 / 3, 3)
+    }
+    samples = [
+        "1. YES\n2. NO\n3. NO\n4. NO",
+        "1. YES\n2. YES\n3. NO\n4. NO",
+        "1. NO\n2. NO\n3. NO\n4. YES",
+    ]
+    votes = vote(samples, "tot", "supervisory_factors_detailed")
+    assert votes["inadequate_supervision"] == (1, 2 / 3, 3)
+    assert votes["planned_inappropriate_operations"] == (0, 1 / 3, 3)
+    assert format_votes(votes, "tot", "supervisory_factors_detailed") == (
+        "Final answers:\n1. YES\n2. NO\n3. NO\n4. NO"
+    )
+
+
+def test_samples_use_native_n_or_one_request_per_seed():
+    def sample(server, model_type, native_n=None):
+        base_url = server.url + ("/v1" if model_type == "gpt" else "")
+        options = {"api_key": "stub"} if model_type == "gpt" else {}
+        server.reset_counters()
+        samples = asyncio.run(
+            asample_responses(
+                MODELS[model_type],
+                "Narrative.",
+                TEMPLATE,
+                3,
+                model_type=model_type,
+                native_n=native_n,
+                base_url=base_url,
+                **options,
+            )
+        )
+        assert samples == ["YES"] * 3
+        return server.requests
+
+    with StubServer(answer="YES") as server:
+        assert sample(server, "gpt") == 1
+        assert sample(server, "gpt", native_n=False) == 3
+        # One request per seed, and one lookup of the context window
+        assert sample(server, "ollama") == 3 + 1
+
+
+def test_gate_jobs_skips_the_levels_answered_no():
+    levels = _results(
+        [
+            [0, "supervisory_factors", "NO"],
+            [1, "supervisory_factors", "YES"],
+            [2, "supervisory_factors", "I cannot tell."],
+        ]
+    )
+    jobs = [Job(i, DETAILED, "", "{context}", "cot") for i in range(4)]
+    asked, skipped = gate_jobs(jobs, levels)
+    assert [job.document_id for job in asked] == [1, 2, 3]
+    assert skipped == [jobs[0]]
+    assert skipped_answer("cot", DETAILED).endswith("\n3. NO\n4. NO")
+
+
+def test_simulated_cascade_and_its_recall_loss():
+    full = _results(
+        [
+            [0, "supervisory_factors", "NO"],
+            [0, DETAILED, "1. YES\n2. NO\n3. NO\n4. NO"],
+            [1, "supervisory_factors", "YES"],
+            [1, DETAILED, "1. YES\n2. YES\n3. NO\n4. NO"],
+        ]
+    )
+    cascade, gated = simulate_cascade(full)
+    assert gated == 1
+    assert cascade["result"][1] == skipped_answer("cot", DETAILED)
+    assert cascade["result"][3] == full["result"][3]
+
+    table = recall_loss(full, cascade)
+    assert table.loc["inadequate_supervision"].tolist() == [2, 1, 0.5]
+    assert table.loc["planned_inappropriate_operations", "recall_lost"] == 0
+    assert table.loc["all"].tolist() == pytest.approx([3, 2, 1 / 3])
+
+
+def test_run_cascade_asks_the_open_levels(monkeypatch):
+    monkeypatch.setattr(
+        models.cascade, "count_tokens", lambda text, model=None: 1
+    )
+    asked = []
+
+    async def query(gpt_model, job, **options):
+        asked.append((job.document_id, job.prompt))
+        if job.prompt == DETAILED:
+            return "1. YES\n2. NO\n3. NO\n4. NO"
+        return "NO" if job.document_id == 0 else "YES"
+
+    prompts = ["supervisory_factors", DETAILED]
+    jobs = [
+        Job(i, p, "", "{context}", "cot") for i in range(2) for p in prompts
+    ]
+    rows, failed, stats = run_cascade(jobs, "model", query=query)
+    assert (0, DETAILED) not in asked and (1, DETAILED) in asked
+    assert [0, DETAILED, skipped_answer("cot", DETAILED)] in rows
+    assert not failed
+    assert stats["calls"] == 3 and stats["calls_saved"] == 1
+
+    # Resumed with the level answers stored by the first run
+    asked.clear()
+    answered = _results(rows[:2])
+    rows, _, _ = run_cascade(
+        [job for job in jobs if job.prompt == DETAILED],
+        "model",
+        answered=answered,
+        query=query,
+    )
+    assert asked == [(1, DETAILED)]
+    assert len(rows) == 2
+
+
+def test_label_confidences_normalise_over_yes_and_no():
+    def token(text, probability):
+        return {"token": text, "logprob": math.log(probability)}
+
+    raw = {
+        "choices": [
+            {
+                "logprobs": {
+                    "content": [
+                        {"token": None, "logprob": 0.0},
+                        {
+                            **token("YES", 0.6),
+                            "top_logprobs": [
+                                token("YES", 0.6),
+                                {"token": None, "logprob": 0.0},
+                                token("NO", 0.2),
+                            ],
+                        },
+                    ]
+                }
+            }
+        ]
+    }
+
+    class Response:
+        pass
+
+    response = Response()
+    response.raw = raw
+    assert label_confidences(response) == pytest.approx([0.75])
+    response.raw = {"message": {"content": "YES"}}
+    assert label_confidences(response) is None
+
+
+@pytest.mark.parametrize(
+    "model_type, confidence, escalated",
+    [("gpt", 0.6, 1), ("gpt", 0.99, 0), ("ollama", 0.6, 0)],
+)
+def test_routed_query_escalates_uncertain_answers(
+    model_type, confidence, escalated
+):
+    stats = RoutingStats()
+    with StubServer(answer="YES", confidence=confidence) as server:
+        query = routed_query(
+            "io",
+            strong_options={"base_url": server.url + "/v1", "api_key": "stub"},
+            threshold=0.8,
+            n=3,
+            stats=stats,
+        )
+        base_url = server.url + ("/v1" if model_type == "gpt" else "")
+        options = {"api_key": "stub"} if model_type == "gpt" else {}
+        rows, failed = run_queries(
+            _jobs(1),
+            MODELS[model_type],
+            model_type=model_type,
+            query=query,
+            base_url=base_url,
+            **options,
+        )
+    assert rows == [[0, "a", "YES"]] and not failed
+    assert stats.summary().loc["all", "escalated"] == escalated
+
+
+def test_cli_query_runs_the_strategies(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    data_path = tmp_path / "data.json"
+    records = [
+        {"NtsbNumber": f"ERA{i}", "Oid": str(i), "FactualNarrative": text}
+        for i, text in enumerate(["First report.", "Second report."])
+    ]
+    data_path.write_text(json.dumps(records))
+    runner = CliRunner()
+    options = [
+        "--data",
+        str(data_path),
+        "--corpus",
+        str(tmp_path / "corpus"),
+        "--output-dir",
+        str(tmp_path),
+    ]
+
+    result = runner.invoke(cli, ["query", "io", "nope", *options])
+    assert result.exit_code == 2 and "nope" in result.output
+
+    with StubServer(answer="NO") as server:
+        result = runner.invoke(
+            cli,
+            [
+                "query",
+                "io_merged",
+                *options,
+                "--model",
+                MODELS["ollama"],
+                "--model-type",
+                "ollama",
+                "--base-url",
+                server.url,
+            ],
+        )
+    assert result.exit_code == 0, result.output
+    assert "io_merged: 2 answers\n" in result.output
+    assert os.path.exists(tmp_path / "io_merged_results.csv")
+
+
+def test_cli_consolidate_and_stats(tmp_path):
+    factors = ["decision_error", "skill_based_errors"]
+    answers = pd.DataFrame(
+        [
+            (document_id, factor, "YES" if document_id % 2 else "NO")
+            for document_id in range(4)
+            for factor in factors
+        ],
+        columns=["document_id", "prompt", "result"],
+    )
+    answers.to_csv(tmp_path / "io_results.csv")
+    manual = answers.assign(result=1)
+    manual.to_csv(tmp_path / "manual_labels.csv", index=False)
+    runner = CliRunner()
+
+    result = runner.invoke(
+        cli, ["consolidate", "io", "--output-dir", str(tmp_path)]
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output == "io: 4 reports, 8 labels, 0 parse errors\n"
+
+    result = runner.invoke(
+        cli,
+        [
+            "stats",
+            "io",
+            "--manual",
+            str(tmp_path / "manual_labels.csv"),
+            "--labels-dir",
+            str(tmp_path),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output == "io: micro F1 0.667, macro F1 0.667\n"
+    metrics = pd.read_csv(tmp_path / "io_metrics.csv", index_col=0)
+    assert metrics.loc["decision_error", "recall"] == 0.5
+
+    # Positive counts per factor, the format of data/raw/manual.csv
+    counts = pd.DataFrame({"prompt": factors, "result": [4, 1]})
+    counts.to_csv(tmp_path / "manual.csv", index=False)
+    result = runner.invoke(
+        cli,
+        [
+            "stats",
+            "io",
+            "--manual",
+            str(tmp_path / "manual.csv"),
+            "--labels-dir",
+            str(tmp_path),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output == "io: macro F1 0.667\n"
+
+
+def test_compiled_templates_check_their_placeholders():
+    template = compile_template("Q {context}\nAgain: {context}")
+    assert compile_template("Q {context}\nAgain: {context}") is template
+    assert template.render("x") == "Q x\nAgain: x"
+    assert template.static_text == "Q \nAgain: "
+    for bad in ["No placeholder", "{context} {question}", "{ context }"]:
+        with pytest.raises(ValueError, match="placeholders"):
+            CompiledTemplate(bad)
+
+
+def test_registry_loads_and_describes_the_prompt_files(monkeypatch):
+    monkeypatch.setattr(
+        models.prompts, "count_tokens", lambda text, model=None: 7
+    )
+    registry = PromptRegistry(os.path.join(ROOT, "prompts"))
+    assert registry.strategies == [
+        "cot",
+        "io",
+        "io_expanded",
+        "io_expanded_merged",
+        "io_merged",
+        "tot",
+    ]
+    assert "io" in registry and "nope" not in registry
+    prompt = registry["cot"]["unsafe_acts_detailed"]
+    assert prompt.factors[1] == "decision_error"
+    assert prompt.render("x") == prompt.template.replace("{context}", "x")
+    [row] = [
+        row for row in registry.metadata() if row["strategy"] == "io_merged"
+    ]
+    assert row["questions"] == 15 and row["static_tokens"] == 7
+
+
+def test_registry_validates_the_prompt_files(tmp_path):
+    (tmp_path / "cot.yaml").write_text(
+        "unsafe_acts_detailed: |\n  1. Is it?\n  2. Is it?\n  {context}\n"
+    )
+    with pytest.raises(ValueError, match="asks questions"):
+        PromptRegistry(str(tmp_path))
+    (tmp_path / "cot.yaml").write_text("unsafe_acts: |\n  Is it? {x}\n")
+    with pytest.raises(ValueError, match="placeholders"):
+        PromptRegistry(str(tmp_path))